@@ -0,0 +1,62 @@
+"""Store benchmark results and compare them with a stored baseline
+
+Results are `{case: {metric: value}}`. Higher throughput is better, for
+every other metric lower is better.
+"""
+import json
+
+
+HIGHER_IS_BETTER = {'throughput'}
+
+
+def load(path):
+    try:
+        with open(path) as stream:
+            return json.load(stream)
+    except FileNotFoundError:
+        return None
+
+
+def save(path, results):
+    with open(path, 'w') as stream:
+        json.dump(results, stream, indent=2, sort_keys=True)
+        stream.write('\n')
+
+
+def change(metric, expected, value):
+    """Relative change of `value`, positive when it got worse"""
+    if not expected:
+        return 0.0
+    relative = (value - expected) / expected
+    return -relative if metric in HIGHER_IS_BETTER else relative
+
+
+def regressions(results, baseline, tolerance):
+    """List `(case, metric, expected, value)` worse than `baseline` by
+    more than `tolerance`, a fraction of the baseline value
+    """
+    found = []
+    for case, metrics in sorted(results.items()):
+        for metric, value in sorted(metrics.items()):
+            expected = baseline.get(case, {}).get(metric)
+            if expected is None or value is None:
+                continue
+            if change(metric, expected, value) > tolerance:
+                found.append((case, metric, expected, value))
+    return found
+
+
+def report(results, baseline=None):
+    print('{:<12} {:<20} {:>12} {:>12} {:>8}'.format(
+        'case', 'metric', 'result', 'baseline', 'worse'
+    ))
+    for case, metrics in sorted(results.items()):
+        for metric, value in sorted(metrics.items()):
+            expected = (baseline or {}).get(case, {}).get(metric)
+            if expected is None:
+                print('{:<12} {:<20} {:>12.2f}'.format(case, metric, value))
+                continue
+            print('{:<12} {:<20} {:>12.2f} {:>12.2f} {:>7.1f}%'.format(
+                case, metric, value, expected,
+                change(metric, expected, value) * 100
+            ))
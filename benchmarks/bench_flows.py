@@ -0,0 +1,293 @@
+"""Throughput and latency of the services' message flows, end to end
+
+Runs products, taxes and `--fanout` indexer containers of one region in
+this process and drives three flows through the broker:
+
+- broadcast: `product_added` events, each handled by every indexer
+- orders: orders consumed by products, as in the master region, spread
+  over `--partitions` partitions
+- taxes: tax requests sent by `RegionRpc` and answered by taxes
+
+Each flow reports throughput, p50 and p99 latency, CPU time per message
+and peak RSS of the process. Latency of events and orders is measured
+from the `sent_at` trace header to the end of the worker handling them,
+of tax requests from sending the request to receiving its reply.
+
+Results are compared with `--baseline` and the run exits with status 1
+when any of them got worse by more than `--tolerance`, or when a flow
+failed to handle all of its messages. `--save-baseline`
+stores results of the run as the new baseline instead. Baselines only
+compare runs on the same machine with the same options.
+
+Runs against the broker in `config.yml` (see `make run-rabbit`), pass
+`--amqp-uri memory://` to use kombu's in-memory transport instead.
+
+Usage: python benchmarks/bench_flows.py [--total N] [--save-baseline]
+"""
+import eventlet
+eventlet.monkey_patch()
+
+import argparse  # noqa: E402
+import os  # noqa: E402
+import resource  # noqa: E402
+import sys  # noqa: E402
+import time  # noqa: E402
+from collections import defaultdict  # noqa: E402
+
+import yaml  # noqa: E402
+from nameko.cli.main import setup_yaml_parser  # noqa: E402
+from nameko.constants import AMQP_URI_CONFIG_KEY  # noqa: E402
+from nameko.events import get_event_exchange  # noqa: E402
+from nameko.extensions import DependencyProvider  # noqa: E402
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import baseline  # noqa: E402
+from src.container import ServiceContainer  # noqa: E402
+from src.messaging import (  # noqa: E402
+    ROUTING_KEY_ORDER_PRODUCT, orders_exchange
+)
+from src.partitions import partition, partition_routing_key  # noqa: E402
+from src.producers import PersistentProducer  # noqa: E402
+from src.selector import percentile  # noqa: E402
+from src.service import (  # noqa: E402
+    IndexerService, ProductsService, TaxesService
+)
+from src.tracing import SENT_AT, trace_headers  # noqa: E402
+
+
+REGION = 'europe'
+
+# seconds from sending to handling, per entrypoint, across all containers
+LATENCIES = defaultdict(list)
+
+
+class FlowFailed(Exception):
+    """A flow did not handle all of its messages"""
+
+
+class Probe(DependencyProvider):
+    """Records latency of workers started by messages with trace headers
+    """
+
+    def worker_result(self, worker_ctx, result=None, exc_info=None):
+        sent_at = worker_ctx.data.get(SENT_AT)
+        if sent_at is not None:
+            LATENCIES[worker_ctx.entrypoint.method_name].append(
+                time.time() - sent_at
+            )
+
+
+class Products(ProductsService):
+    probe = Probe()
+
+
+class Indexer(IndexerService):
+    probe = Probe()
+
+
+def load_config(amqp_uri, partitions):
+    setup_yaml_parser()
+    with open(os.path.join(ROOT, 'config.yml')) as stream:
+        config = yaml.load(stream.read())
+    config['REGION'] = REGION
+    config['WEB_SERVER_ADDRESS'] = '127.0.0.1:0'
+    config['ORDER_BATCH'] = {'MAX_SIZE': 1, 'MAX_WAIT_MS': 0}
+    config['ORDER_PARTITIONS'] = {'COUNT': partitions}
+    if amqp_uri is not None:
+        config[AMQP_URI_CONFIG_KEY] = amqp_uri
+    if config[AMQP_URI_CONFIG_KEY].startswith('memory://'):
+        # the in-memory transport does not support publisher confirms
+        config['REPLY_CONFIRMS'] = False
+        config['REGION_RPC_CONFIRMS'] = False
+    return config
+
+
+def wait_for(entrypoint, count, timeout):
+    with eventlet.Timeout(timeout, False):
+        while len(LATENCIES[entrypoint]) < count:
+            eventlet.sleep(0.01)
+    if len(LATENCIES[entrypoint]) < count:
+        raise FlowFailed(
+            '{} handled {} of {} messages within {} seconds'.format(
+                entrypoint, len(LATENCIES[entrypoint]), count, timeout
+            )
+        )
+    return LATENCIES[entrypoint][:count]
+
+
+def publish_all(producer, messages, concurrency):
+    pool = eventlet.GreenPool(concurrency)
+    for payload, kwargs in messages:
+        pool.spawn_n(
+            producer.publish, payload, headers=trace_headers(REGION),
+            **kwargs
+        )
+    pool.waitall()
+
+
+def broadcast_flow(producer, args):
+    exchange = get_event_exchange('products')
+    publish_all(producer, (
+        (
+            {
+                'id': index, 'name': 'Product {}'.format(index),
+                'price': '100.00', 'quantity': 1000000,
+            },
+            {'exchange': exchange, 'routing_key': 'product_added'}
+        )
+        for index in range(args.total)
+    ), args.concurrency)
+    return wait_for(
+        'handle_product_added', args.total * args.fanout, args.timeout
+    )
+
+
+def orders_flow(producer, args):
+    publish_all(producer, (
+        (
+            {'product_id': index, 'quantity': 1},
+            {
+                'exchange': orders_exchange,
+                'routing_key': partition_routing_key(
+                    ROUTING_KEY_ORDER_PRODUCT,
+                    partition(index, args.partitions), args.partitions
+                )
+            }
+        )
+        for index in range(args.total)
+    ), args.concurrency)
+    return wait_for('consume_order', args.total, args.timeout)
+
+
+def taxes_flow(rpc, args):
+    latencies = []
+    errors = []
+
+    def call(order_id):
+        started = time.perf_counter()
+        try:
+            rpc.call_async(REGION, {'order_id': order_id}).result()
+        except Exception as error:
+            errors.append(error)
+        else:
+            latencies.append(time.perf_counter() - started)
+
+    pool = eventlet.GreenPool(args.concurrency)
+    for order_id in range(args.total):
+        pool.spawn_n(call, order_id)
+    pool.waitall()
+    if errors:
+        raise FlowFailed(
+            '{} of {} tax requests failed, first with {!r}'.format(
+                len(errors), args.total, errors[0]
+            )
+        )
+    return latencies
+
+
+def measure(flow, *flow_args):
+    before = resource.getrusage(resource.RUSAGE_SELF)
+    started = time.perf_counter()
+    latencies = sorted(flow(*flow_args))
+    elapsed = time.perf_counter() - started
+    if not latencies:
+        raise FlowFailed('no messages were handled')
+    after = resource.getrusage(resource.RUSAGE_SELF)
+
+    cpu = (after.ru_utime + after.ru_stime) - (
+        before.ru_utime + before.ru_stime
+    )
+    return {
+        'throughput': len(latencies) / elapsed,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'cpu_us_per_message': cpu / len(latencies) * 1e6,
+        # kilobytes on Linux
+        'max_rss_mb': after.ru_maxrss / 1024,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--amqp-uri')
+    parser.add_argument('--total', type=int, default=5000)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--fanout', type=int, default=3)
+    parser.add_argument('--partitions', type=int, default=8)
+    parser.add_argument('--timeout', type=float, default=120)
+    parser.add_argument(
+        '--baseline',
+        default=os.path.join(ROOT, 'benchmarks', 'baseline.json')
+    )
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    parser.add_argument('--save-baseline', action='store_true')
+    args = parser.parse_args()
+
+    config = load_config(args.amqp_uri, args.partitions)
+    containers = [
+        ServiceContainer(Products, config),
+        ServiceContainer(TaxesService, config),
+    ] + [
+        ServiceContainer(Indexer, config) for _ in range(args.fanout)
+    ]
+    for container in containers:
+        container.start()
+
+    producer = PersistentProducer(config[AMQP_URI_CONFIG_KEY])
+    producer.start()
+    rpc = next(
+        dependency for dependency in containers[0].dependencies
+        if dependency.attr_name == 'taxes_rpc'
+    )
+    # orders need the products added by broadcast to be cached
+    flows = [
+        ('broadcast', broadcast_flow, producer),
+        ('orders', orders_flow, producer),
+        ('taxes', taxes_flow, rpc),
+    ]
+    results = {}
+    failed = {}
+    try:
+        for case, flow, target in flows:
+            try:
+                results[case] = measure(flow, target, args)
+            except FlowFailed as error:
+                failed[case] = error
+    finally:
+        producer.stop()
+        for container in containers:
+            container.stop()
+
+    if failed:
+        baseline.report(results)
+        for case, error in sorted(failed.items()):
+            print('FAILED {}: {}'.format(case, error))
+        sys.exit(1)
+
+    if args.save_baseline:
+        baseline.save(args.baseline, results)
+        baseline.report(results)
+        print('Saved baseline to {}'.format(args.baseline))
+        return
+
+    stored = baseline.load(args.baseline)
+    baseline.report(results, stored)
+    if stored is None:
+        print('No baseline at {}, run with --save-baseline'.format(
+            args.baseline
+        ))
+        return
+
+    regressed = baseline.regressions(results, stored, args.tolerance)
+    for case, metric, expected, value in regressed:
+        print('REGRESSION {} {}: {:.2f} against baseline {:.2f}'.format(
+            case, metric, value, expected
+        ))
+    if regressed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
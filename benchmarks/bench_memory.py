@@ -0,0 +1,109 @@
+"""Compare memory taken by cached products stored as dicts and as records
+
+Each run fills caches configured the way the `Cache` dependency
+configures `CACHE` and `ENCODED`, with a `ProductIndex` following
+`CACHE` as products service keeps one, and stores products through
+`CacheApi.update` with their encoded bodies as indexer does. Products
+are loaded from events with Decimal prices. Resident memory grown
+while filling all three is reported. Every catalogue size and storage
+mode is measured in a fresh process, so runs do not reuse memory freed
+by the previous ones.
+
+Usage: python benchmarks/bench_memory.py [--products N [N ...]]
+"""
+import argparse
+import gc
+import multiprocessing
+import os
+import random
+import sys
+import time
+from decimal import Decimal
+
+sys.path.insert(
+    0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+)
+
+from src.cache import ShardedCache, cache_options  # noqa: E402
+from src.dependencies import Cache, encoded_options  # noqa: E402
+from src.records import compact_product  # noqa: E402
+from src.search import ProductIndex  # noqa: E402
+from src.service import encode_product  # noqa: E402
+
+
+NAMES = ['Tesla', 'Bike', 'Boat', 'Scooter', 'Telescope', 'Kettle']
+
+
+def rss():
+    """Resident memory of this process in bytes, Linux only"""
+    with open('/proc/self/statm') as stream:
+        return int(stream.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def product(index):
+    return {
+        'id': index,
+        # names repeat, but every product decodes its own copy of them
+        'name': '{} {}'.format(random.choice(NAMES), index % 1000),
+        'price': Decimal('{}.{:02d}'.format(
+            random.randint(1, 5000), index % 100
+        )),
+        'quantity': random.randint(0, 1000),
+        'version': random.randint(0, 3) or None,
+    }
+
+
+def fill(count, compact, results):
+    random.seed(0)
+    config = {'MAX_SIZE': count, 'SHARDS': 16}
+    gc.collect()
+    before = rss()
+    cache = ShardedCache(
+        pack=compact_product if compact else None, **cache_options(config)
+    )
+    encoded = ShardedCache(**encoded_options(config, compact))
+    index = ProductIndex()
+    index.attach(cache)
+    api = Cache.CacheApi(cache, encoded, index)
+    started = time.perf_counter()
+    for key in range(count):
+        value = product(key)
+        if value['version'] is None:
+            del value['version']
+        api.update(key, value, encoded=encode_product(value))
+    elapsed = time.perf_counter() - started
+    gc.collect()
+    results.put((rss() - before, elapsed))
+
+
+def measure(count, compact):
+    results = multiprocessing.Queue()
+    process = multiprocessing.Process(
+        target=fill, args=(count, compact, results)
+    )
+    process.start()
+    grown, elapsed = results.get()
+    process.join()
+    return grown, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--products', type=int, nargs='+', default=[1000000, 10000000]
+    )
+    args = parser.parse_args()
+
+    print('{:>10} {:<8} {:>10} {:>14} {:>10}'.format(
+        'products', 'storage', 'memory', 'per product', 'fill'
+    ))
+    for count in args.products:
+        for label, compact in (('dict', False), ('compact', True)):
+            grown, elapsed = measure(count, compact)
+            print('{:>10} {:<8} {:>7.0f} MB {:>8.0f} bytes {:>8.1f} s'.format(
+                count, label, grown / 2 ** 20, grown / count, elapsed
+            ))
+
+
+if __name__ == '__main__':
+    main()
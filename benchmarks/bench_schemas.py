@@ -0,0 +1,145 @@
+"""Compare marshmallow schemas with their compiled fast path equivalents
+
+Payloads mimic what the services see: products arriving as JSON with
+string prices, products read back from cache with Decimal prices, orders
+and tax requests, with a share of invalid payloads mixed in.
+
+Usage: python benchmarks/bench_schemas.py [--number N] [--invalid RATIO]
+"""
+import argparse
+import os
+import random
+import sys
+import timeit
+from decimal import Decimal
+
+from marshmallow import ValidationError
+
+sys.path.insert(
+    0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+)
+
+from src.schemas import (  # noqa: E402
+    Order, Product, Taxes, order_schema, product_schema, taxes_schema
+)
+
+
+def product_payloads(count, invalid):
+    payloads = []
+    for index in range(count):
+        payload = {
+            'id': index,
+            'name': 'Product {}'.format(index),
+            'price': '{}.{:02d}'.format(random.randint(1, 5000), index % 100),
+            'quantity': random.randint(0, 1000),
+        }
+        if random.random() < invalid:
+            del payload[random.choice(list(payload))]
+        payloads.append(payload)
+    return payloads
+
+
+def cached_products(count):
+    return [
+        {
+            'id': index,
+            'name': 'Product {}'.format(index),
+            'price': Decimal(random.randint(100, 500000)) / 100,
+            'quantity': random.randint(0, 1000),
+        }
+        for index in range(count)
+    ]
+
+
+def order_payloads(count, invalid):
+    return [
+        {} if random.random() < invalid else
+        {'product_id': index, 'quantity': random.randint(1, 5)}
+        for index in range(count)
+    ]
+
+
+def taxes_payloads(count, invalid):
+    return [
+        {'order_id': 'x'} if random.random() < invalid else
+        {'order_id': index}
+        for index in range(count)
+    ]
+
+
+def marshmallow_load(schema_cls):
+    def load(payload):
+        try:
+            return schema_cls(strict=True).load(payload).data
+        except ValidationError:
+            pass
+    return load
+
+
+def compiled_load(schema):
+    def load(payload):
+        try:
+            return schema.load(payload)
+        except ValidationError:
+            pass
+    return load
+
+
+def run(cases, number):
+    print('{:<24} {:>14} {:>14} {:>9}'.format(
+        'case', 'marshmallow', 'compiled', 'speedup'
+    ))
+    for name, payloads, slow, fast in cases:
+        results = []
+        for func in (slow, fast):
+            elapsed = min(timeit.repeat(
+                lambda: [func(payload) for payload in payloads],
+                number=number, repeat=3
+            ))
+            results.append(elapsed / (number * len(payloads)) * 1e6)
+        print('{:<24} {:>11.2f} us {:>11.2f} us {:>8.1f}x'.format(
+            name, results[0], results[1], results[0] / results[1]
+        ))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--number', type=int, default=5)
+    parser.add_argument('--size', type=int, default=2000)
+    parser.add_argument('--invalid', type=float, default=0.05)
+    args = parser.parse_args()
+
+    random.seed(0)
+    products = product_payloads(args.size, args.invalid)
+    cached = cached_products(args.size)
+    orders = order_payloads(args.size, args.invalid)
+    taxes = taxes_payloads(args.size, args.invalid)
+
+    run([
+        (
+            'Product load', products,
+            marshmallow_load(Product), compiled_load(product_schema)
+        ),
+        (
+            'Product dump', cached,
+            lambda product: Product(strict=True).dump(product).data,
+            product_schema.dump
+        ),
+        (
+            'Product dumps', cached,
+            lambda product: Product(strict=True).dumps(product).data,
+            product_schema.dumps
+        ),
+        (
+            'Order load', orders,
+            marshmallow_load(Order), compiled_load(order_schema)
+        ),
+        (
+            'Taxes load', taxes,
+            marshmallow_load(Taxes), compiled_load(taxes_schema)
+        ),
+    ], args.number)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""Compare bytes per message and encode/decode cost of message serializers
+
+Bodies mimic messages published on the `orders` exchange and product
+event broadcasts: single products, batches of added products, orders,
+tax replies and cache digest answers. Each one is encoded with JSON,
+compact and compact compressed above `--compress-above` bytes, the way
+kombu encodes and decodes message bodies.
+
+Usage: python benchmarks/bench_serialization.py [--batch-size N]
+"""
+import argparse
+import os
+import random
+import sys
+import timeit
+
+from kombu.serialization import dumps, loads
+
+sys.path.insert(
+    0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+)
+
+from src import serialization  # noqa: E402
+
+
+def product(index):
+    return {
+        'id': index,
+        'name': 'Product {}'.format(index),
+        'price': '{}.{:02d}'.format(random.randint(1, 5000), index % 100),
+        'quantity': random.randint(0, 1000),
+    }
+
+
+def bodies(batch_size):
+    return [
+        ('product_added', product(1)),
+        ('products_added', [product(index) for index in range(batch_size)]),
+        ('product_updated', {'id': 1, 'version': 7, 'quantity': 99}),
+        ('order', {'product_id': 1, 'quantity': 1}),
+        ('tax reply', {
+            'result': {
+                'tax': 'You do not owe taxes in region asia for order id 1'
+            },
+            'error': None
+        }),
+        ('digest answer', {'buckets': [
+            [bucket, random.getrandbits(64)] for bucket in range(64)
+        ]}),
+    ]
+
+
+def time_per_call(func):
+    """Best of 3 rounds of at least 0.2 seconds each, in microseconds"""
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    return min(timer.repeat(number=number, repeat=3)) / number * 1e6
+
+
+def measure(body, serializer):
+    content_type, encoding, data = dumps(body, serializer=serializer)
+    encode = time_per_call(lambda: dumps(body, serializer=serializer))
+    decode = time_per_call(
+        lambda: loads(data, content_type, encoding, accept=[content_type])
+    )
+    return len(data), encode, decode
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--compress-above', type=int, default=1024)
+    args = parser.parse_args()
+
+    random.seed(0)
+    variants = [
+        ('json', 'json'),
+        ('compact', serialization.COMPACT),
+        ('compact+zlib', serialization.compact_serializer(
+            args.compress_above
+        )),
+    ]
+    print('{:<16} {:<14} {:>9} {:>12} {:>12}'.format(
+        'message', 'serializer', 'bytes', 'encode', 'decode'
+    ))
+    for name, body in bodies(args.batch_size):
+        for label, serializer in variants:
+            size, encode, decode = measure(body, serializer)
+            print('{:<16} {:<14} {:>9} {:>9.2f} us {:>9.2f} us'.format(
+                name, label, size, encode, decode
+            ))
+
+
+if __name__ == '__main__':
+    main()
@@ -9,7 +9,8 @@ setup(
     install_requires=[
         'nameko==2.5.3',
         'marshmallow==2.9.1',
-        'eventlet==0.20.1'
+        'eventlet==0.20.1',
+        'msgpack==1.0.0'
     ],
     extras_require={
         'dev': [
@@ -0,0 +1,302 @@
+import json
+import logging
+import time
+from collections import Counter, deque
+from functools import wraps
+
+import eventlet
+from kombu import Queue
+from nameko.amqp import get_connection
+from nameko.constants import AMQP_URI_CONFIG_KEY
+from nameko.extensions import SharedExtension
+from nameko.web.handlers import HttpRequestHandler
+from werkzeug.wrappers import Response
+
+from .metrics import METRICS
+from .partitions import partition_options, partition_queue
+
+
+logger = logging.getLogger(__name__)
+
+
+QUEUE_DEPTH_INTERVAL = 1
+
+SHED = METRICS.counter(
+    'http_requests_shed_total', 'Requests rejected by admission control',
+    ('entrypoint', 'reason')
+)
+
+
+class LatencyWindow:
+    """Mean of latencies observed within the last `window` seconds
+
+    Without recent observations the mean is unknown, so a backlog which
+    made requests get rejected is not held against them forever.
+    """
+
+    def __init__(self, window=5):
+        self.window = window
+        self._samples = deque()
+        self._total = 0.0
+
+    def record(self, latency, now=None):
+        now = time.monotonic() if now is None else now
+        self._samples.append((now, latency))
+        self._total += latency
+        self._expire(now)
+
+    def _expire(self, now):
+        samples = self._samples
+        while samples and samples[0][0] <= now - self.window:
+            self._total -= samples.popleft()[1]
+        if not samples:
+            # drop rounding errors accumulated while the window was busy
+            self._total = 0.0
+
+    def mean(self, now=None):
+        self._expire(time.monotonic() if now is None else now)
+        if not self._samples:
+            return None
+        return self._total / len(self._samples)
+
+
+# latency of publishing messages and events from this process
+PUBLISH_LATENCY = LatencyWindow()
+
+
+def record_publish_latency(publish):
+    """Decorate `publish` to observe its duration into `PUBLISH_LATENCY`
+    """
+    @wraps(publish)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return publish(*args, **kwargs)
+        finally:
+            PUBLISH_LATENCY.record(time.perf_counter() - started)
+    return wrapper
+
+
+class AdmissionController:
+    """Decides whether requests to one entrypoint should be handled
+
+    Requests are rejected with `429 Too Many Requests` while
+    `max_in_flight` of them are being handled, and with `503 Service
+    Unavailable` while publishing takes longer than `max_publish_latency`
+    seconds on average or more than `max_queue_depth` messages wait in
+    the watched queues. Every limit is optional.
+    """
+
+    def __init__(
+        self, max_in_flight=None, max_publish_latency=None,
+        max_queue_depth=None, queues=(), retry_after=1
+    ):
+        self.max_in_flight = max_in_flight
+        self.max_publish_latency = max_publish_latency
+        self.max_queue_depth = max_queue_depth
+        self.queues = list(queues) if max_queue_depth is not None else []
+        self.retry_after = retry_after
+        self.in_flight = 0
+        self.queue_depth = None
+        self.admitted = 0
+        self.shed = Counter()
+
+    def admit(self, publish_latency=None):
+        """Return None if a request is admitted, `(status, reason)` if not
+        """
+        reason = status = None
+        if (
+            self.max_in_flight is not None and
+            self.in_flight >= self.max_in_flight
+        ):
+            status, reason = 429, 'in_flight'
+        elif (
+            self.max_publish_latency is not None and
+            publish_latency is not None and
+            publish_latency > self.max_publish_latency
+        ):
+            status, reason = 503, 'publish_latency'
+        elif (
+            self.max_queue_depth is not None and
+            self.queue_depth is not None and
+            self.queue_depth > self.max_queue_depth
+        ):
+            status, reason = 503, 'queue_depth'
+
+        if reason is None:
+            self.admitted += 1
+            return None
+        self.shed[reason] += 1
+        return status, reason
+
+    def stats(self):
+        return {
+            'in_flight': self.in_flight,
+            'queue_depth': self.queue_depth,
+            'admitted': self.admitted,
+            'shed': dict(self.shed),
+        }
+
+
+def _optional(convert, value):
+    if value is None or value == '':
+        return None
+    return convert(value)
+
+
+def admission_options(options, config=None):
+    """Translate settings of one entrypoint in `ADMISSION` config section
+
+    Values may come through as strings when they are populated from
+    environment variables, `QUEUES` as a comma separated list.
+
+    `PARTITIONS` names the section of `config` which splits `QUEUES`
+    into partitions (see `src.partitions`), every partition of them is
+    watched then.
+    """
+    options = options or {}
+    latency_ms = _optional(float, options.get('MAX_PUBLISH_LATENCY_MS'))
+    queues = options.get('QUEUES') or ()
+    if isinstance(queues, str):
+        queues = [queue.strip() for queue in queues.split(',')]
+    if options.get('PARTITIONS'):
+        count = partition_options(
+            (config or {}).get(options['PARTITIONS'])
+        )['count']
+        queues = [
+            partition_queue(Queue(queue), index, count).name
+            for queue in queues if queue
+            for index in range(count)
+        ]
+    return {
+        'max_in_flight': _optional(int, options.get('MAX_IN_FLIGHT')),
+        'max_publish_latency': (
+            None if latency_ms is None else latency_ms / 1000
+        ),
+        'max_queue_depth': _optional(int, options.get('MAX_QUEUE_DEPTH')),
+        'queues': [queue for queue in queues if queue],
+        'retry_after': _optional(int, options.get('RETRY_AFTER')) or 1,
+    }
+
+
+# controllers of this process by entrypoint method name
+CONTROLLERS = {}
+
+
+def admission_stats():
+    return {
+        method_name: controller.stats()
+        for method_name, controller in CONTROLLERS.items()
+    }
+
+
+class Admission(SharedExtension):
+    """Admission controllers of a container's HTTP entrypoints
+
+    Entrypoints listed by method name in the `ADMISSION` config section
+    get a controller, shared by all containers of the process. Depths of
+    queues watched by controllers are polled every
+    `QUEUE_DEPTH_INTERVAL` seconds, they are only as accurate as that.
+    """
+
+    _gt = None
+
+    def controller(self, method_name):
+        options = (self.container.config.get('ADMISSION') or {}).get(
+            method_name
+        )
+        if not options:
+            return None
+        controller = CONTROLLERS.get(method_name)
+        if controller is None:
+            controller = CONTROLLERS[method_name] = AdmissionController(
+                **admission_options(options, self.container.config)
+            )
+        return controller
+
+    def start(self):
+        watching = [
+            controller for controller in CONTROLLERS.values()
+            if controller.queues
+        ]
+        if watching:
+            self._gt = self.container.spawn_managed_thread(
+                lambda: self._poll(watching)
+            )
+
+    def stop(self):
+        self.kill()
+
+    def kill(self):
+        if self._gt is not None:
+            self._gt.kill()
+            self._gt = None
+
+    def _poll(self, controllers):
+        amqp_uri = self.container.config[AMQP_URI_CONFIG_KEY]
+        while True:
+            try:
+                with get_connection(amqp_uri) as connection:
+                    channel = connection.default_channel
+                    for controller in controllers:
+                        controller.queue_depth = sum(
+                            Queue(name, channel=channel).queue_declare(
+                                passive=True
+                            ).message_count
+                            for name in controller.queues
+                        )
+            except Exception:
+                logger.warning('Failed to poll queue depths', exc_info=True)
+                for controller in controllers:
+                    controller.queue_depth = None
+            eventlet.sleep(QUEUE_DEPTH_INTERVAL)
+
+
+class AdmittedHttpRequestHandler(HttpRequestHandler):
+    """HTTP entrypoint rejecting requests its `AdmissionController` does
+    not admit, with a `Retry-After` header
+
+    Entrypoints without `ADMISSION` settings handle every request.
+    Rejected requests are counted in `http_requests_shed_total`.
+    """
+
+    admission = Admission()
+
+    def setup(self):
+        super(AdmittedHttpRequestHandler, self).setup()
+        self.controller = self.admission.controller(self.method_name)
+
+    def handle_request(self, request):
+        controller = self.controller
+        if controller is None:
+            return super(AdmittedHttpRequestHandler, self).handle_request(
+                request
+            )
+
+        rejection = controller.admit(PUBLISH_LATENCY.mean())
+        if rejection is not None:
+            status, reason = rejection
+            SHED.inc((self.method_name, reason))
+            return Response(
+                json.dumps({
+                    'error': (
+                        'TOO_MANY_REQUESTS' if status == 429
+                        else 'SERVICE_UNAVAILABLE'
+                    ),
+                    'message': 'Request rejected, {} over limit'.format(
+                        reason.replace('_', ' ')
+                    )
+                }),
+                status=status,
+                headers={'Retry-After': str(controller.retry_after)}
+            )
+
+        controller.in_flight += 1
+        try:
+            return super(AdmittedHttpRequestHandler, self).handle_request(
+                request
+            )
+        finally:
+            controller.in_flight -= 1
+
+http = AdmittedHttpRequestHandler.decorator
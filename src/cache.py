@@ -0,0 +1,403 @@
+import time
+from collections import OrderedDict
+from collections.abc import MutableMapping
+
+from eventlet.event import Event
+
+
+class CacheStats:
+    """Hit, miss and eviction counters shared by all shards of a cache"""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def as_dict(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'hit_ratio': (self.hits / lookups) if lookups else 0.0,
+        }
+
+
+class LRUEngine:
+    """Size bounded engine evicting least recently used entries first
+
+    `on_remove(key, value)` is called for every entry the engine drops
+    on its own, i.e. evicted or expired ones.
+    """
+
+    def __init__(self, stats, max_size=None, ttl=None, on_remove=None):
+        self.stats = stats
+        self.max_size = max_size
+        self.on_remove = on_remove
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __iter__(self):
+        return iter(list(self._data))
+
+    def peek(self, key):
+        return self._data[key]
+
+    def get(self, key):
+        value = self._data[key]
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        self._data[key] = value
+        self._data.move_to_end(key)
+        self._enforce_size()
+
+    def delete(self, key):
+        del self._data[key]
+
+    def clear(self):
+        self._data.clear()
+
+    def _value(self, stored):
+        return stored
+
+    def _enforce_size(self):
+        if self.max_size is None:
+            return
+        while len(self._data) > self.max_size:
+            key, value = self._data.popitem(last=False)
+            value = self._value(value)
+            self.stats.evictions += 1
+            if self.on_remove is not None:
+                self.on_remove(key, value)
+
+
+class TTLEngine(LRUEngine):
+    """Size bounded engine expiring entries `ttl` seconds after a write
+
+    Entries are kept in write order, so expired entries are always at
+    the front and can be purged without scanning the whole shard.
+    """
+
+    def __init__(self, stats, max_size=None, ttl=None, on_remove=None):
+        super(TTLEngine, self).__init__(
+            stats, max_size=max_size, on_remove=on_remove
+        )
+        if not ttl:
+            raise ValueError('TTL engine requires a positive `ttl`')
+        self.ttl = ttl
+
+    def peek(self, key):
+        expires_at, value = self._data[key]
+        if expires_at <= time.monotonic():
+            del self._data[key]
+            self.stats.expirations += 1
+            if self.on_remove is not None:
+                self.on_remove(key, value)
+            raise KeyError(key)
+        return value
+
+    def get(self, key):
+        return self.peek(key)
+
+    def set(self, key, value):
+        now = time.monotonic()
+        self._data[key] = (now + self.ttl, value)
+        self._data.move_to_end(key)
+        self._purge_expired(now)
+        self._enforce_size()
+
+    def __iter__(self):
+        self._purge_expired(time.monotonic())
+        return super(TTLEngine, self).__iter__()
+
+    def _value(self, stored):
+        return stored[1]
+
+    def _purge_expired(self, now):
+        data = self._data
+        while data:
+            key = next(iter(data))
+            expires_at, value = data[key]
+            if expires_at > now:
+                break
+            del data[key]
+            self.stats.expirations += 1
+            if self.on_remove is not None:
+                self.on_remove(key, value)
+
+
+ENGINES = {
+    'lru': LRUEngine,
+    'ttl': TTLEngine,
+}
+
+
+class ShardedCache(MutableMapping):
+    """Bounded key-value cache split across a number of independent shards
+
+    Keys are assigned to shards by hash, each shard is an instance of one
+    of `ENGINES` holding an equal part of `max_size`. Lookups through
+    `get` are counted as hits or misses in `stats`, while plain mapping
+    access (`cache[key]`) is left uncounted and does not refresh recency.
+
+    Once `track_changes` is called every write and delete is recorded
+    until collected with `drain_changes`, evictions are not recorded.
+
+    Once `track_evictions` is called keys of evicted and expired entries
+    are remembered until they are written or deleted, so `was_evicted`
+    tells keys the cache dropped from ones it never had.
+
+    Listeners added with `add_listener` are called as `listener(key, old,
+    new)` on every change of an entry, including evictions and
+    expirations. `old` is None for new keys and `new` is None for removed
+    ones. Values must not be mutated in place while they are cached, or
+    listeners can not tell what they changed from.
+
+    With `pack` every value is stored, and passed to listeners, as
+    `pack(value)` returns it, e.g. in a more compact form.
+    """
+
+    def __init__(
+        self, engine='lru', max_size=None, ttl=None, shards=1, pack=None
+    ):
+        self.stats = CacheStats()
+        self._changes = None
+        self._evicted = None
+        self._listeners = []
+        self.configure(
+            engine=engine, max_size=max_size, ttl=ttl, shards=shards,
+            pack=pack
+        )
+
+    def configure(
+        self, engine='lru', max_size=None, ttl=None, shards=1, pack=None
+    ):
+        """(Re)build shards, keeping as many existing entries as fit"""
+        if engine not in ENGINES:
+            raise ValueError('Unknown cache engine: {}'.format(engine))
+        if shards < 1:
+            raise ValueError('Cache requires at least one shard')
+
+        options = (engine, max_size, ttl, shards, pack)
+        if options == getattr(self, '_options', None):
+            return
+
+        existing = list(self.items()) if hasattr(self, '_shards') else []
+
+        shard_size = None
+        if max_size:
+            shard_size = max(1, -(-max_size // shards))
+
+        self.engine = engine
+        self.max_size = max_size
+        self.ttl = ttl
+        self.pack = pack
+        self._options = options
+        self._shards = [
+            ENGINES[engine](
+                self.stats, max_size=shard_size, ttl=ttl,
+                on_remove=self._removed
+            )
+            for _ in range(shards)
+        ]
+        # entries are moved rather than written, listeners only learn
+        # about the ones which no longer fit
+        for key, value in existing:
+            if pack is not None:
+                value = pack(value)
+            self._shard(key).set(key, value)
+            if self._changes is not None:
+                self._changes[key] = True
+
+    def _shard(self, key):
+        return self._shards[hash(key) % len(self._shards)]
+
+    def get(self, key, default=None):
+        try:
+            value = self._shard(key).get(key)
+        except KeyError:
+            self.stats.misses += 1
+            return default
+        self.stats.hits += 1
+        return value
+
+    def get_many(self, keys, default=None):
+        """Return list of values for `keys`, `default` for missing ones"""
+        get = self.get
+        return [get(key, default) for key in keys]
+
+    def __getitem__(self, key):
+        return self._shard(key).peek(key)
+
+    def __setitem__(self, key, value):
+        if self.pack is not None:
+            value = self.pack(value)
+        shard = self._shard(key)
+        if self._listeners:
+            old = self._peek(shard, key)
+            shard.set(key, value)
+            self._notify(key, old, value)
+        else:
+            shard.set(key, value)
+        if self._evicted:
+            self._evicted.discard(key)
+        if self._changes is not None:
+            self._changes[key] = True
+
+    def __delitem__(self, key):
+        shard = self._shard(key)
+        if self._listeners:
+            old = shard.peek(key)
+            shard.delete(key)
+            self._notify(key, old, None)
+        else:
+            shard.delete(key)
+        if self._evicted:
+            self._evicted.discard(key)
+        if self._changes is not None:
+            self._changes[key] = False
+
+    def __iter__(self):
+        for shard in self._shards:
+            for key in shard:
+                yield key
+
+    def __len__(self):
+        return sum(len(shard) for shard in self._shards)
+
+    def clear(self):
+        if self._changes is not None:
+            self._changes.update((key, False) for key in self)
+        removed = list(self.items()) if self._listeners else []
+        for shard in self._shards:
+            shard.clear()
+        if self._evicted:
+            self._evicted.clear()
+        for key, value in removed:
+            self._notify(key, value, None)
+
+    def add_listener(self, listener):
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        self._listeners.remove(listener)
+
+    def _peek(self, shard, key):
+        try:
+            return shard.peek(key)
+        except KeyError:
+            return None
+
+    def _removed(self, key, value):
+        if self._evicted is not None:
+            self._evicted.add(key)
+        if self._listeners:
+            self._notify(key, value, None)
+
+    def _notify(self, key, old, new):
+        for listener in self._listeners:
+            listener(key, old, new)
+
+    def track_evictions(self):
+        if self._evicted is None:
+            self._evicted = set()
+
+    def was_evicted(self, key):
+        """Whether `key` was evicted or expired and not written since"""
+        return bool(self._evicted) and key in self._evicted
+
+    def track_changes(self):
+        if self._changes is None:
+            self._changes = {}
+
+    def drain_changes(self):
+        """Return `{key: written}` for keys changed since the last call
+
+        `written` is False for keys which have been deleted.
+        """
+        if self._changes is None:
+            return {}
+        changes, self._changes = self._changes, {}
+        return changes
+
+
+_MISSING = object()
+
+
+class ResultCache:
+    """TTL bound cache of call results which coalesces identical calls
+
+    `get_or_call(key, func)` returns the cached result for `key` or calls
+    `func` to produce it. While a call for a key is running, others asking
+    for the same key wait for its outcome instead of calling `func`
+    themselves. Only successful results are cached, errors are passed to
+    everyone waiting for the call and then forgotten.
+
+    With no `ttl` results are not cached, but calls are still coalesced.
+    """
+
+    def __init__(self, ttl=None, max_size=None, shards=1):
+        self.cache = None
+        if ttl:
+            self.cache = ShardedCache(
+                engine='ttl', ttl=ttl, max_size=max_size, shards=shards
+            )
+        self.coalesced = 0
+        self._pending = {}
+
+    def get_or_call(self, key, func):
+        if self.cache is not None:
+            result = self.cache.get(key, _MISSING)
+            if result is not _MISSING:
+                return result
+
+        pending = self._pending.get(key)
+        if pending is not None:
+            self.coalesced += 1
+            return pending.wait()
+
+        pending = self._pending[key] = Event()
+        try:
+            result = func()
+        except Exception as exc:
+            pending.send_exception(exc)
+            raise
+        else:
+            if self.cache is not None:
+                self.cache[key] = result
+            pending.send(result)
+            return result
+        finally:
+            del self._pending[key]
+
+    def stats(self):
+        stats = {'coalesced': self.coalesced, 'in_flight': len(self._pending)}
+        if self.cache is not None:
+            stats.update(self.cache.stats.as_dict())
+            stats['size'] = len(self.cache)
+        return stats
+
+
+def cache_options(config):
+    """Translate the `CACHE` config section into `ShardedCache` options
+
+    Values may come through as strings when they are populated from
+    environment variables, so they are coerced here. Zero or empty
+    `MAX_SIZE` and `TTL` mean unbounded.
+    """
+    config = config or {}
+    return {
+        'engine': str(config.get('ENGINE') or 'lru').lower(),
+        'max_size': int(config.get('MAX_SIZE') or 0) or None,
+        'ttl': float(config.get('TTL') or 0) or None,
+        'shards': int(config.get('SHARDS') or 1),
+    }
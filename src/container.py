@@ -1,6 +1,14 @@
 import logging
+import time
 
+from eventlet.semaphore import Semaphore
 from nameko.containers import ServiceContainer as NamekoServiceContainer
+from nameko.messaging import Publisher
+
+from .dependencies import as_bool
+from .metrics import (
+    METRICS, PUBLISH_TIME, STARTUP_TIME, WorkerTimer, timed
+)
 
 
 logger = logging.getLogger(__name__)
@@ -17,8 +25,25 @@ class ServiceContainer(NamekoServiceContainer):
     about its location by setting `SERVICE_CONTAINER_CLS` config value
     to the location of this class:
     `SERVICE_CONTAINER_CLS: src.container.ServiceContainer`
+
+    Entrypoints listed by method name in `ENTRYPOINT_SETTINGS` section
+    with `MAX_WORKERS` run at most that many workers at a time. Workers
+    over the limit would wait for their turn while taking a slot of the
+    container's `max_workers`, so the limit is enforced before spawning
+    them where possible: consumers do not prefetch more messages than
+    their `MAX_WORKERS` (see `src.messaging.QueueConsumer`) and batch
+    consumers hold batches back until a worker is free. Only workers of
+    other entrypoints, e.g. HTTP requests, wait in the pool.
+
+    With `METRICS.ENABLED` set, every worker is timed by a `WorkerTimer`:
+    how long it waited to run, how long its service method took and
+    whether it failed. Publishers it gets injected are timed as well.
+    While disabled, workers run exactly as they would in Nameko's
+    container. Startup time of the container is reported either way.
     """
 
+    _worker_limits = {}
+
     def start(self):
         blacklist = self.config.get('ENTRYPOINT_BLACKLIST') or ()
 
@@ -30,4 +55,93 @@ class ServiceContainer(NamekoServiceContainer):
                     entrypoint.method_name
                 )
 
+        self._worker_limits = {
+            method_name: Semaphore(settings['max_workers'])
+            for method_name, settings in entrypoint_settings(
+                self.config
+            ).items()
+            if settings['max_workers']
+        }
+
+        if as_bool((self.config.get('METRICS') or {}).get('ENABLED')):
+            METRICS.enabled = True
+
+        started = time.perf_counter()
         super(ServiceContainer, self).start()
+        elapsed = time.perf_counter() - started
+        STARTUP_TIME.set((self.service_name,), elapsed)
+        logger.info('Started %s in %.3f seconds', self.service_name, elapsed)
+
+    def spawn_worker(
+        self, entrypoint, args, kwargs, context_data=None, handle_result=None
+    ):
+        if METRICS.enabled:
+            handle_result = WorkerTimer(
+                handle_result, (self.service_name, entrypoint.method_name)
+            )
+        return super(ServiceContainer, self).spawn_worker(
+            entrypoint, args, kwargs,
+            context_data=context_data, handle_result=handle_result
+        )
+
+    def _run_worker(self, worker_ctx, handle_result):
+        limit = self._worker_limits.get(worker_ctx.entrypoint.method_name)
+        if limit is None:
+            return self._run_timed_worker(worker_ctx, handle_result)
+        with limit:
+            return self._run_timed_worker(worker_ctx, handle_result)
+
+    def _run_timed_worker(self, worker_ctx, handle_result):
+        if not isinstance(handle_result, WorkerTimer):
+            return super(ServiceContainer, self)._run_worker(
+                worker_ctx, handle_result
+            )
+        worker_ctx.timer = handle_result
+        with handle_result.running():
+            return super(ServiceContainer, self)._run_worker(
+                worker_ctx, handle_result
+            )
+
+    def _inject_dependencies(self, worker_ctx):
+        super(ServiceContainer, self)._inject_dependencies(worker_ctx)
+        timer = getattr(worker_ctx, 'timer', None)
+        if timer is None:
+            return
+
+        service = worker_ctx.service
+        for provider in self.dependencies:
+            if isinstance(provider, Publisher):
+                setattr(service, provider.attr_name, timed(PUBLISH_TIME)(
+                    getattr(service, provider.attr_name)
+                ))
+
+        method_name = worker_ctx.entrypoint.method_name
+        setattr(service, method_name, timer.time_method(
+            getattr(service, method_name)
+        ))
+
+
+def _optional_int(value):
+    if value is None or value == '':
+        return None
+    return int(value)
+
+
+def entrypoint_settings(config):
+    """Read `ENTRYPOINT_SETTINGS` config section
+
+    Returns `{method_name: settings}` with `prefetch_count`, `max_workers`
+    and `priority` of every listed entrypoint, None where not set.
+    Values may come through as strings when they are populated from
+    environment variables.
+    """
+    section = config.get('ENTRYPOINT_SETTINGS') or {}
+    return {
+        method_name: {
+            'prefetch_count': _optional_int(options.get('PREFETCH_COUNT')),
+            'max_workers': _optional_int(options.get('MAX_WORKERS')),
+            'priority': _optional_int(options.get('PRIORITY')),
+        }
+        for method_name, options in section.items()
+        if options
+    }
@@ -1,25 +1,211 @@
+import logging
+from types import MappingProxyType
+
 from nameko.extensions import DependencyProvider
 
+from .cache import ShardedCache, cache_options
+from .metrics import METRICS, sample
+from .records import compact_product
+from .search import ProductIndex
+from .snapshot import CacheSnapshot, snapshot_options
+
+
+logger = logging.getLogger(__name__)
+
+
+CACHE = ShardedCache()
 
-CACHE = {}
+ENCODED = ShardedCache()
+
+SNAPSHOT = CacheSnapshot(CACHE)
+
+INDEX = ProductIndex()
 
 
 class Cache(DependencyProvider):
+    """Access to the process wide product cache
+
+    All services running in the same process share `CACHE`. Its engine,
+    size bound and number of shards are taken from the `CACHE` section
+    of the service's config file when the container is set up.
+
+    `CACHE` is the only copy of products a region has, so keys of
+    products evicted to keep it within its bounds are remembered and
+    `was_evicted` tells them from products which do not exist.
+
+    Next to each value an encoded representation of it (e.g. response
+    body) can be stored in `ENCODED`. It is only returned while the value
+    it was encoded from is still the one cached under the same key and
+    it is dropped whenever the key is updated without a new encoding.
+
+    When `CACHE.SNAPSHOT_PATH` is configured, the cache is restored from
+    the snapshot file during `setup`. Nameko sets up every extension of
+    a container before starting any of them, so the snapshot is loaded
+    before HTTP entrypoints start accepting requests. Loading does not
+    yield to other greenthreads, so other containers in the process
+    cannot start serving from a half loaded cache either.
+
+    With `CACHE.COMPACT` set, products are stored in `CACHE` as
+    `ProductRecord`, which read like the dicts they were stored as.
+    Encoded bodies would then take more memory than the records, so
+    `ENCODED` only keeps `CACHE.ENCODED_MAX_SIZE` of them, 10000 unless
+    configured, and others are encoded again when requested.
+
+    With `search` enabled products in `CACHE` are indexed by price,
+    quantity and name in `INDEX` (see `ProductIndex`) from then on,
+    whichever service of the process writes them.
+
+    `CacheApi` holds no per worker state, all workers share one.
+    """
 
     class CacheApi:
-        def __init__(self, cache):
+        def __init__(self, cache, encoded, index=None):
             self.cache = cache
+            self.encoded = encoded
+            self.index = index
 
-        def update(self, key, value):
+        def update(self, key, value, encoded=None):
             self.cache[key] = value
+            if encoded is None:
+                self.encoded.pop(key, None)
+            else:
+                # the value as stored, which may have been packed
+                self.encoded[key] = (self.cache[key], encoded)
+
+        def compare_and_set(self, key, expected, value, encoded=None):
+            """Update `key` only if `expected` is still the cached value
+
+            Returns whether the value was updated.
+            """
+            if self.cache.get(key) is not expected:
+                return False
+            self.update(key, value, encoded)
+            return True
+
+        def update_many(self, items, encode=None):
+            for key, value in items:
+                self.update(key, value, encode(value) if encode else None)
 
         def get(self, key):
-            return self.cache.get(key)
+            value = self.cache.get(key)
+            if value is None:
+                logger.debug('Cache miss for key: %s', key)
+            return value
+
+        def was_evicted(self, key):
+            return self.cache.was_evicted(key)
+
+        def get_encoded(self, key):
+            """Return `(value, encoded)`, `encoded` is None if not stored
+            """
+            value = self.get(key)
+            if value is None:
+                return None, None
+            entry = self.encoded.get(key)
+            if entry is None or entry[0] is not value:
+                return value, None
+            return value, entry[1]
+
+        def set_encoded(self, key, value, encoded):
+            self.encoded[key] = (value, encoded)
+
+        def get_many(self, keys):
+            return self.cache.get_many(keys)
+
+        def search(self, **criteria):
+            """Return `(products, more)`, see `ProductIndex.search`"""
+            return self.index.search(**criteria)
+
+        def stats(self):
+            stats = self.cache.stats.as_dict()
+            stats['size'] = len(self.cache)
+            stats['max_size'] = self.cache.max_size
+            return stats
+
+    def __init__(self, search=False):
+        self.search = search
+
+    def setup(self):
+        METRICS.add_collector('cache', collect_cache_metrics)
+
+        config = self.container.config.get('CACHE')
+        compact = as_bool((config or {}).get('COMPACT'))
+        CACHE.configure(
+            pack=compact_product if compact else None,
+            **cache_options(config)
+        )
+        CACHE.track_evictions()
+        ENCODED.configure(**encoded_options(config, compact))
+
+        options = snapshot_options(config)
+        if options['path']:
+            SNAPSHOT.configure(**options)
+            SNAPSHOT.load()
+
+        if self.search:
+            INDEX.attach(CACHE)
+
+        self.api = self.CacheApi(
+            CACHE, ENCODED, INDEX if self.search else None
+        )
+
+    def start(self):
+        if SNAPSHOT.enabled:
+            SNAPSHOT.start()
+
+    def stop(self):
+        if SNAPSHOT.enabled:
+            SNAPSHOT.stop()
 
     def get_dependency(self, worker_ctx):
-        return self.CacheApi(CACHE)
+        return self.api
+
+
+def collect_cache_metrics():
+    stats = CACHE.stats
+    return [
+        sample('cache_hits_total', 'counter', 'Cache hits', stats.hits),
+        sample('cache_misses_total', 'counter', 'Cache misses', stats.misses),
+        sample(
+            'cache_evictions_total', 'counter', 'Cache evictions',
+            stats.evictions
+        ),
+        sample(
+            'cache_expirations_total', 'counter', 'Cache expirations',
+            stats.expirations
+        ),
+        sample('cache_size', 'gauge', 'Cached entries', len(CACHE)),
+    ]
+
+
+def encoded_options(config, compact):
+    """`ShardedCache` options of `ENCODED`, which is bounded by
+    `CACHE.ENCODED_MAX_SIZE`, the size of `CACHE` unless compact
+    """
+    options = cache_options(config)
+    max_size = int((config or {}).get('ENCODED_MAX_SIZE') or 0)
+    if max_size or compact:
+        options['max_size'] = max_size or 10000
+    return options
+
+
+def as_bool(value, default=False):
+    """Interpret config flag which may be populated from an env variable,
+    `default` when it is not set or empty
+    """
+    if value is None or value == '':
+        return default
+    if isinstance(value, str):
+        return value.strip().lower() in ('1', 'true', 'yes', 'on')
+    return bool(value)
 
 
 class Config(DependencyProvider):
+    """Read only view of the container's config, shared by all workers
+    """
+
+    def setup(self):
+        self.view = MappingProxyType(self.container.config)
+
     def get_dependency(self, worker_ctx):
-        return self.container.config.copy()
+        return self.view
@@ -0,0 +1,212 @@
+import hashlib
+import json
+from functools import reduce
+from operator import xor
+
+
+def _digest(data):
+    return int.from_bytes(
+        hashlib.md5(data.encode('utf-8')).digest()[:8], 'big'
+    )
+
+
+class CacheDigest:
+    """Hash tree digest of a cache kept up to date on every write
+
+    Keys are spread across `buckets` buckets by md5 of their repr, which
+    is the same in every process. The digest of a bucket is XOR of the
+    digests of its entries, so adding or removing an entry does not
+    rehash the rest of the bucket. Every `fanout` consecutive buckets
+    form a range whose digest is XOR of their bucket digests.
+
+    Entries are digested in the JSON serializable form returned by
+    `encode`, which has to be the same in every region for equal values.
+    Keys of each bucket are kept, so entries of a divergent bucket are
+    listed without scanning the cache.
+    """
+
+    def __init__(self, encode=None, buckets=4096, fanout=64):
+        self.cache = None
+        self.configure(encode, buckets, fanout)
+
+    def configure(self, encode, buckets=4096, fanout=64):
+        """(Re)build digest, redigesting the attached cache if changed"""
+        options = (encode, buckets, fanout)
+        if options == getattr(self, '_options', None):
+            return
+        self._options = options
+        self.encode = encode
+        self.buckets = buckets
+        self.fanout = fanout
+        self._digests = [0] * buckets
+        self._keys = [set() for _ in range(buckets)]
+        # keys missing on the other side in the last round, see `repair`
+        self._missing = {}
+
+        cache, self.cache = self.cache, None
+        if cache is not None:
+            cache.remove_listener(self.changed)
+            self.attach(cache)
+
+    def attach(self, cache):
+        """Digest current entries of `cache` and follow its changes"""
+        if self.cache is cache:
+            return
+        for key, value in cache.items():
+            self.changed(key, None, value)
+        cache.add_listener(self.changed)
+        self.cache = cache
+
+    def bucket(self, key):
+        return _digest(repr(key)) % self.buckets
+
+    def changed(self, key, old, new):
+        bucket = self.bucket(key)
+        if old is not None:
+            self._digests[bucket] ^= self._entry_digest(key, old)
+            self._keys[bucket].discard(key)
+        if new is not None:
+            self._digests[bucket] ^= self._entry_digest(key, new)
+            self._keys[bucket].add(key)
+
+    def _entry_digest(self, key, value):
+        return _digest(json.dumps([key, self.encode(value)], sort_keys=True))
+
+    @property
+    def layout(self):
+        return [self.buckets, self.fanout]
+
+    def ranges(self):
+        digests, fanout = self._digests, self.fanout
+        return [
+            reduce(xor, digests[start:start + fanout], 0)
+            for start in range(0, self.buckets, fanout)
+        ]
+
+    def bucket_digests(self, ranges):
+        """Return `[bucket, digest]` pairs of all buckets in `ranges`"""
+        return [
+            [bucket, self._digests[bucket]]
+            for index in ranges
+            for bucket in range(
+                index * self.fanout,
+                min((index + 1) * self.fanout, self.buckets)
+            )
+        ]
+
+    def entries(self, buckets):
+        """Return `[key, encoded]` pairs of all entries in `buckets`"""
+        entries = []
+        for bucket in buckets:
+            for key in list(self._keys[bucket]):
+                try:
+                    value = self.cache[key]
+                except KeyError:
+                    continue
+                entries.append([key, self.encode(value)])
+        return entries
+
+    def answer(self, request):
+        """Serve a reconciliation request sent by `repair` of a replica
+
+        Either lists buckets of ranges whose digests differ from ones in
+        the request, entries of requested buckets, or which of requested
+        keys the attached cache evicted.
+        """
+        if request.get('layout') != self.layout:
+            raise ValueError('Digest layout {} does not match {}'.format(
+                request.get('layout'), self.layout
+            ))
+        if 'ranges' in request:
+            local = self.ranges()
+            return {'buckets': self.bucket_digests([
+                index for index, digest in enumerate(request['ranges'])
+                if local[index] != digest
+            ])}
+        if 'keys' in request:
+            return {'evicted': [
+                key for key in request['keys'] if self.cache.was_evicted(key)
+            ]}
+        return {'entries': self.entries(request['buckets'])}
+
+    def repair(self, call, decode, buckets_per_call=16, version=None):
+        """Make attached cache match the one `call` sends requests to
+
+        `call(request)` passes the request to `answer` of the other
+        side's digest. Range digests are compared first, then digests of
+        buckets in divergent ranges, and only entries of divergent buckets
+        are transferred.
+
+        Entries missing on the other side are deleted only when they are
+        still missing, at the same version, in the next round, so ones
+        which reached this side first are not deleted before the other
+        side receives them. Entries the other side evicted are kept.
+
+        With `version`, a function returning the version of a value,
+        transferred entries which are not newer than the cached ones are
+        left alone, they were read before updates which already arrived.
+        Entries the cache evicted are not restored, a bounded cache would
+        only evict them again.
+
+        Returns `(divergent buckets, entries repaired, entries deleted)`.
+        """
+        remote = call({'layout': self.layout, 'ranges': self.ranges()})
+        divergent = [
+            bucket for bucket, digest in remote['buckets']
+            if self._digests[bucket] != digest
+        ]
+
+        repaired = deleted = 0
+        missing = []
+        for start in range(0, len(divergent), buckets_per_call):
+            chunk = divergent[start:start + buckets_per_call]
+            remote = call({'layout': self.layout, 'buckets': chunk})
+
+            remote_keys = set()
+            for key, encoded in remote['entries']:
+                remote_keys.add(key)
+                try:
+                    cached = self.cache[key]
+                except KeyError:
+                    if self.cache.was_evicted(key):
+                        continue
+                    cached = None
+                if cached is not None and self.encode(cached) == encoded:
+                    continue
+                value = decode(encoded)
+                if (
+                    cached is not None and version is not None and
+                    version(value) <= version(cached)
+                ):
+                    continue
+                self.cache[key] = value
+                repaired += 1
+
+            for bucket in chunk:
+                missing.extend(
+                    key for key in self._keys[bucket]
+                    if key not in remote_keys
+                )
+
+        evicted = set()
+        if missing:
+            evicted = set(call({
+                'layout': self.layout, 'keys': missing
+            })['evicted'])
+
+        previous, self._missing = self._missing, {}
+        for key in missing:
+            if key in evicted:
+                continue
+            try:
+                cached = self.cache[key]
+            except KeyError:
+                continue
+            current = None if version is None else version(cached)
+            if key in previous and previous[key] == current:
+                del self.cache[key]
+                deleted += 1
+            else:
+                self._missing[key] = current
+
+        return len(divergent), repaired, deleted
@@ -1,15 +1,50 @@
+import json
+import time
+import uuid
+from collections import OrderedDict
+from copy import copy
+from functools import partial
+
+import eventlet
+from eventlet.event import Event
 from kombu import Exchange, Queue
-from kombu.common import maybe_declare
-from nameko.amqp import get_connection, get_producer
-from nameko.constants import AMQP_URI_CONFIG_KEY, DEFAULT_SERIALIZER
-from nameko.exceptions import serialize
+from nameko.constants import (
+    AMQP_URI_CONFIG_KEY, DEFAULT_RETRY_POLICY, SERIALIZER_CONFIG_KEY
+)
+from nameko.events import EventDispatcher as NamekoEventDispatcher
+from nameko.events import EventHandler as NamekoEventHandler
+from nameko.events import get_event_exchange
+from nameko.exceptions import ContainerBeingKilled, deserialize, serialize
+from nameko.extensions import DependencyProvider, SharedExtension
 from nameko.messaging import Consumer as NamekoConsumer
+from nameko.messaging import Publisher as NamekoPublisher
+from nameko.messaging import QueueConsumer as NamekoQueueConsumer
+from nameko.standalone.events import event_dispatcher
 
-REGIONS = ['europe', 'asia', 'america']
+from .admission import record_publish_latency
+from .cache import ResultCache
+from .container import entrypoint_settings
+from .dependencies import as_bool
+from .metrics import METRICS, REPLY_TIME
+from .partitions import (
+    partition, partition_options, partition_queue, partition_routing_key
+)
+from .producers import PersistentProducer
+from .selector import RegionSelector, selector_options
+from .serialization import accepted, message_serializer
+from .topology import Topology, is_declared, region_queues, regions
+from .tracing import (
+    TRACE_ID, TraceHeaders, header_name, record_transit, trace_headers,
+    worker_trace_id
+)
 
 ROUTING_KEY_ORDER_PRODUCT = 'order_product'
 ROUTING_KEY_CALCULATE_TAXES = 'calculate_taxes'
 ROUTING_KEY_CALCULATE_TAXES_REPLY = 'calculate_taxes_reply'
+ROUTING_KEY_CACHE_DIGEST = 'cache_digest'
+ROUTING_KEY_CACHE_DIGEST_REPLY = 'cache_digest_reply'
+
+NEAREST = 'nearest'
 
 orders_exchange = Exchange(name='orders')
 
@@ -20,14 +55,400 @@ order_queue = Queue(
 )
 
 
-class ReplyConsumer(NamekoConsumer):
+class QueueConsumer(NamekoQueueConsumer):
+    """Queue consumer applying `ENTRYPOINT_SETTINGS` to each consumer
+
+    Every entrypoint gets a broker side consumer with its own
+    `PREFETCH_COUNT`, or its `MAX_WORKERS` if only that is set, and with
+    `PRIORITY` passed as `x-priority` consumer argument. Entrypoints
+    without settings prefetch as many messages as the container's
+    `max_workers` allows.
+
+    A worker is spawned for every message received, so an entrypoint
+    may not prefetch more messages than its `MAX_WORKERS`, unless it
+    holds them back until a worker is free by itself (`limits_workers`).
+    Otherwise workers over the limit would wait in slots of the
+    container's worker pool, see `src.container.ServiceContainer`.
+
+    RabbitMQ applies `basic.qos` to consumers started after it, so each
+    consumer is started right after its qos is set. Queues already
+    declared by `Topology` are not declared again.
+
+    Transit times of received messages carrying trace headers (see
+    `src.tracing`) are recorded while metrics are enabled.
+
+    Messages are accepted in any serializer of `src.serialization`, so
+    services keep understanding each other while `MESSAGES.SERIALIZER`
+    is being changed region by region.
+    """
+
+    @property
+    def accept(self):
+        return self.container.accept + [
+            serializer for serializer in accepted()
+            if serializer not in self.container.accept
+        ]
+
+    def register_provider(self, provider):
+        options = entrypoint_settings(self.container.config).get(
+            provider.method_name, {}
+        )
+        prefetch_count = options.get('prefetch_count')
+        max_workers = options.get('max_workers')
+        if (
+            prefetch_count and max_workers and prefetch_count > max_workers and
+            not getattr(provider, 'limits_workers', False)
+        ):
+            raise ValueError(
+                'PREFETCH_COUNT {} of {} exceeds its MAX_WORKERS {}'.format(
+                    prefetch_count, provider.method_name, max_workers
+                )
+            )
+        super(QueueConsumer, self).register_provider(provider)
+
+    def _on_message(self, body, message):
+        record_transit(message.headers, self.container.config['REGION'])
+        super(QueueConsumer, self)._on_message(body, message)
+
+    def get_consumers(self, consumer_cls, channel):
+        settings = entrypoint_settings(self.container.config)
+
+        for provider in self._providers:
+            options = settings.get(provider.method_name, {})
+
+            queues = provider.queues
+            if options.get('priority') is not None:
+                queues = [copy(queue) for queue in queues]
+                for queue in queues:
+                    queue.consumer_arguments = dict(
+                        queue.consumer_arguments or {},
+                        **{'x-priority': options['priority']}
+                    )
+
+            prefetch_count = options.get('prefetch_count')
+            if prefetch_count is None:
+                prefetch_count = options.get('max_workers')
+
+            consumer = consumer_cls(
+                queues=queues,
+                callbacks=[self._on_message, provider.handle_message],
+                accept=self.accept,
+                auto_declare=not all(
+                    is_declared(self.amqp_uri, queue) for queue in queues
+                )
+            )
+            consumer.qos(prefetch_count=prefetch_count or self.prefetch_count)
+            consumer.consume()
+
+            self._consumers[provider] = consumer
+
+        return self._consumers.values()
+
+
+class DeclaresQueue:
+    """Declares `queues` consumed by an entrypoint through the container's
+    `Topology`, which subclasses may `add` more entities to in setup
+    """
+
+    topology = Topology()
+
+    @property
+    def queues(self):
+        return [self.queue]
+
+    def setup(self):
+        super(DeclaresQueue, self).setup()
+        self.topology.add(*self.queues)
+
+    def start(self):
+        self.topology.declare()
+        super(DeclaresQueue, self).start()
+
+
+class Consumer(DeclaresQueue, NamekoConsumer):
+    queue_consumer = QueueConsumer()
+
+consume = Consumer.decorator
+
+
+class EventHandler(DeclaresQueue, NamekoEventHandler):
+    queue_consumer = QueueConsumer()
+
+event_handler = EventHandler.decorator
+
+
+# options of nameko publishers which the buffering producer does not take,
+# it retries a failed batch once by itself
+_UNBUFFERED_OPTIONS = ('retry', 'retry_policy', 'use_confirms')
+
+
+def _buffered_kwargs(kwargs):
+    return {
+        key: value for key, value in kwargs.items()
+        if key not in _UNBUFFERED_OPTIONS
+    }
+
+
+def publishing_options(config):
+    """Translate the `PUBLISHING` config section
+
+    Values may come through as strings when they are populated from
+    environment variables. `WAIT` and `CONFIRMS` are enabled unless set
+    otherwise, empty `MAX_BATCH` and `MAX_QUEUED` mean unbounded.
+    """
+    config = config or {}
+
+    def flag(key):
+        value = config.get(key)
+        return True if value is None or value == '' else as_bool(value)
+
+    return {
+        'buffered': as_bool(config.get('BUFFERED')),
+        'wait': flag('WAIT'),
+        'confirms': flag('CONFIRMS'),
+        'max_batch': int(config.get('MAX_BATCH') or 0) or None,
+        'linger': float(config.get('LINGER_MS') or 0) / 1000,
+        'max_queued': int(config.get('MAX_QUEUED') or 0) or None,
+    }
+
+
+class BufferedPublishing(SharedExtension):
+    """Producer shared by publishers and event dispatchers of a container
+    when `PUBLISHING.BUFFERED` is set
+
+    Messages are queued, up to `MAX_QUEUED` of them, and published by a
+    background greenthread in batches of up to `MAX_BATCH` messages,
+    collected for at most `LINGER_MS`, over one channel with one confirm
+    round trip per batch (see `PersistentProducer`).
+
+    Callers wait for their message to be published and confirmed unless
+    `WAIT` is disabled or they pass `wait=False`, in which case publishing
+    errors are only logged. The producer is stopped after all workers
+    and dependencies of the container, publishing everything queued.
+    """
+
+    producer = None
+    wait = True
+
+    @property
+    def buffered(self):
+        return self.producer is not None
+
+    def setup(self):
+        config = self.container.config
+        options = publishing_options(config.get('PUBLISHING'))
+        if not options.pop('buffered') or self.producer is not None:
+            return
+        self.wait = options.pop('wait')
+        self.producer = PersistentProducer(
+            config[AMQP_URI_CONFIG_KEY],
+            serializer=message_serializer(config), **options
+        )
+
+    def start(self):
+        if self.producer is not None:
+            self.producer.start()
+
+    def stop(self):
+        if self.producer is not None:
+            self.producer.stop()
+
+    def publish(self, msg, wait=None, **kwargs):
+        # untimed, publishers are timed by the container already
+        return self.producer.enqueue(
+            msg, wait=self.wait if wait is None else wait,
+            **_buffered_kwargs(kwargs)
+        )
+
+
+class Publisher(TraceHeaders, NamekoPublisher):
+    """Publisher stamping messages with trace headers, whose queue or
+    exchange is declared through the container's `Topology`
+
+    Messages are serialized with `MESSAGES.SERIALIZER`. How long
+    publishing takes is observed for admission control.
+
+    With `PUBLISHING.BUFFERED` messages are published through
+    `BufferedPublishing` and `publish` takes a `wait` argument.
+    """
+
+    topology = Topology()
+    publishing = BufferedPublishing()
+
+    serializer = None
+
+    def setup(self):
+        self.serializer = message_serializer(self.container.config)
+        self.topology.add(self.queue or self.exchange)
+
+    def start(self):
+        self.topology.declare()
+
+    def get_dependency(self, worker_ctx):
+        if not self.publishing.buffered:
+            return record_publish_latency(
+                super(Publisher, self).get_dependency(worker_ctx)
+            )
+
+        exchange = self.exchange
+        if exchange is None and self.queue is not None:
+            exchange = self.queue.exchange
+
+        @record_publish_latency
+        def publish(msg, wait=None, **kwargs):
+            return self.publishing.publish(
+                msg, wait=wait, exchange=exchange,
+                headers=self.get_message_headers(worker_ctx), **kwargs
+            )
+        return publish
+
+
+class PartitionedPublisher(Publisher):
+    """Publisher spreading messages over partitions of `queue`
+
+    The config section named by `partitions_key` sets the number of
+    partitions in `COUNT`, each of which is a queue of its own named
+    `<queue name>.<partition>`. Messages go to the partition chosen by
+    consistent hash of `key(message)`, so all messages of a key end up
+    in the same partition. A single partition is `queue` itself.
+    """
+
+    def __init__(self, queue, partitions_key, key):
+        super(PartitionedPublisher, self).__init__(queue=queue)
+        self.partitions_key = partitions_key
+        self.key = key
+
+    def setup(self):
+        config = self.container.config
+        self.serializer = message_serializer(config)
+        self.count = partition_options(
+            config.get(self.partitions_key)
+        )['count']
+        self.topology.add(*(
+            partition_queue(self.queue, index, self.count)
+            for index in range(self.count)
+        ))
+
+    def get_dependency(self, worker_ctx):
+        publish = super(PartitionedPublisher, self).get_dependency(
+            worker_ctx
+        )
+
+        def publish_partitioned(msg, **kwargs):
+            index = partition(self.key(msg), self.count)
+            publish(msg, routing_key=partition_routing_key(
+                self.queue.routing_key, index, self.count
+            ), **kwargs)
+        return publish_partitioned
+
+
+class EventDispatcher(TraceHeaders, NamekoEventDispatcher):
+    """Event dispatcher stamping every event with trace headers when it is
+    dispatched, whose exchange is declared through `Topology`
+
+    Nameko's dispatcher computes headers once per worker, which would
+    date all events of a worker back to its start.
+
+    Events are serialized with `MESSAGES.SERIALIZER`, how long
+    dispatching takes is observed for admission control.
+
+    With `PUBLISHING.BUFFERED` events are published through
+    `BufferedPublishing` and `dispatch` takes a `wait` argument.
+    """
+
+    topology = Topology()
+    publishing = BufferedPublishing()
+
+    def setup(self):
+        config = self.container.config
+        self.service_name = self.container.service_name
+        self.config = dict(config, **{
+            SERIALIZER_CONFIG_KEY: message_serializer(config)
+        })
+        self.exchange = get_event_exchange(self.service_name)
+        self.topology.add(self.exchange)
+
+    def start(self):
+        self.topology.declare()
+
+    def get_dependency(self, worker_ctx):
+        if self.publishing.buffered:
+            @record_publish_latency
+            def dispatch(event_type, event_data, wait=None):
+                return self.publishing.publish(
+                    event_data, wait=wait, exchange=self.exchange,
+                    routing_key=event_type,
+                    headers=self.get_message_headers(worker_ctx),
+                    **self.kwargs
+                )
+            return dispatch
+
+        @record_publish_latency
+        def dispatch(event_type, event_data):
+            dispatcher = event_dispatcher(
+                self.config, headers=self.get_message_headers(worker_ctx),
+                **self.kwargs
+            )
+            dispatcher(self.service_name, event_type, event_data)
+        return dispatch
+
+
+class ReplyPublishing(SharedExtension):
+    """Producer sending replies of `ReplyConsumer` entrypoints of a
+    container
+
+    Replies are published with publisher confirms, confirmed in batches
+    across concurrent replies, unless `REPLY_CONFIRMS` config value is
+    disabled. Like `BufferedPublishing`, the producer is stopped after
+    all workers of the container finished, so their replies are sent.
+    """
+
+    producer = None
+
+    def setup(self):
+        if self.producer is not None:
+            return
+        config = self.container.config
+        self.producer = PersistentProducer(
+            config[AMQP_URI_CONFIG_KEY],
+            serializer=message_serializer(config),
+            confirms=as_bool(config.get('REPLY_CONFIRMS'), default=True)
+        )
+
+    def start(self):
+        self.producer.start()
+
+    def stop(self):
+        self.producer.stop()
+
+    def publish(self, msg, **kwargs):
+        return self.producer.publish(msg, **kwargs)
+
+
+class ReplyConsumer(Consumer):
     """Custom implementation of Nameko Consumer
 
     Consumes messages from queue in current region and sends a reply
     to a federated queue defined in `reply_to` message property.
+
+    Replies are sent through the container's `ReplyPublishing`. Like
+    Nameko's publishers it uses publisher confirms unless
+    `REPLY_CONFIRMS` config value is disabled.
+
+    Requests are consumed from `fed.<region>_<routing_key>`, queues for
+    requests and replies are bound in all `REGIONS`.
+
+    Replies carry trace headers with the trace id of their request.
     """
 
-    def __init__(self, **kwargs):
+    publishing = ReplyPublishing()
+
+    def __init__(
+        self, routing_key=ROUTING_KEY_CALCULATE_TAXES,
+        reply_routing_key=ROUTING_KEY_CALCULATE_TAXES_REPLY, **kwargs
+    ):
+        self.routing_key = routing_key
+        self.reply_routing_key = reply_routing_key
         super(ReplyConsumer, self).__init__(None, kwargs)
 
     def handle_result(self, message, worker_ctx, result=None, exc_info=None):
@@ -36,7 +457,6 @@ class ReplyConsumer(NamekoConsumer):
         return result, exc_info
 
     def setup(self):
-        super(ReplyConsumer, self).setup()
         config = self.container.config
 
         """Declare consumer queue for this service in current region"""
@@ -44,76 +464,292 @@ class ReplyConsumer(NamekoConsumer):
             exchange=orders_exchange,
             routing_key='{}_{}'.format(
                 config['REGION'],
-                ROUTING_KEY_CALCULATE_TAXES
+                self.routing_key
             ),
             name='fed.{}_{}'.format(
-                config['REGION'], ROUTING_KEY_CALCULATE_TAXES
+                config['REGION'], self.routing_key
             )
         )
+        super(ReplyConsumer, self).setup()
 
         """Bind federated queues in all regions to
             `orders` exchange with correct routing key.
         """
-        with get_connection(config[AMQP_URI_CONFIG_KEY]) as connection:
-
-            maybe_declare(orders_exchange, connection)
-
-            self._bind_queues_in_for_all_regions(
-                ROUTING_KEY_CALCULATE_TAXES, connection
-            )
-            self._bind_queues_in_for_all_regions(
-                ROUTING_KEY_CALCULATE_TAXES_REPLY, connection
-            )
+        for routing_key in (self.routing_key, self.reply_routing_key):
+            self.topology.add(*region_queues(
+                orders_exchange, routing_key, regions(config)
+            ))
 
     def send_response(self, message, result, exc_info):
 
-        config = self.container.config
-
         error = None
         if exc_info is not None:
             error = serialize(exc_info[1])
 
-        with get_producer(config[AMQP_URI_CONFIG_KEY]) as producer:
+        routing_key = message.properties.get('reply_to')
+        correlation_id = message.properties.get('correlation_id')
 
-            routing_key = message.properties.get('reply_to')
+        msg = {'result': result, 'error': error}
 
-            msg = {'result': result, 'error': error}
-
-            producer.publish(
-                msg,
-                exchange=orders_exchange,
-                serializer=DEFAULT_SERIALIZER,
-                routing_key=routing_key
+        self.publishing.publish(
+            msg,
+            exchange=orders_exchange,
+            routing_key=routing_key,
+            correlation_id=correlation_id,
+            headers=trace_headers(
+                self.container.config['REGION'],
+                (message.headers or {}).get(header_name(TRACE_ID))
             )
+        )
 
         return result, error
 
-    def _bind_queues_in_for_all_regions(self, routing_key, connection):
-        for region in REGIONS:
-                maybe_declare(Queue(
-                    exchange=orders_exchange,
-                    routing_key='{}_{}'.format(
-                        region, routing_key
-                    ),
-                    name='fed.{}_{}'.format(
-                        region, routing_key
-                    )
-                ), connection)
-
 consume_and_reply = ReplyConsumer.decorator
 
 
-class DynamicConsumer(NamekoConsumer):
+class _Lane:
+    """Messages of one `BatchConsumer` lane waiting for their batch"""
+
+    def __init__(self, key):
+        self.key = key
+        self.batch = []
+        self.timer = None
+        self.running = False
+
+
+class BatchConsumer(Consumer):
+    """Consumer handing messages to its entrypoint in batches
+
+    Messages are collected until `MAX_SIZE` of them are waiting or
+    `MAX_WAIT_MS` milliseconds passed since the first of them arrived.
+    Then a single worker is spawned with the list of their payloads.
+    Every message of a batch is acknowledged only after the worker
+    has finished.
+
+    Batch size and wait time are read from the config section named by
+    `config_key`, by default every message is handled on its own.
+    A batch can not be larger than the number of messages the broker
+    delivers unacknowledged, which is `PREFETCH_COUNT` of the entrypoint
+    in `ENTRYPOINT_SETTINGS`, otherwise its `MAX_WORKERS` or the
+    container's `max_workers`.
+
+    Messages are batched in lanes, `_lane_key` of a message tells which.
+    Workers of one lane run one at a time if `sequential` is set, and
+    messages arriving meanwhile form its next batch. Idle lanes are
+    dropped.
+
+    With `MAX_WORKERS` of the entrypoint set, batches ready while that
+    many workers run wait in their lanes, in the order they got ready,
+    instead of spawning workers which would wait for their turn in the
+    container's worker pool. The next batches are spawned outside of the
+    worker which finished, so workers never wait for a free slot of the
+    pool while holding one. Stopping waits for all batches to be handled.
+    """
+
+    sequential = False
+    limits_workers = True
+
+    def __init__(self, queue, config_key, **kwargs):
+        super(BatchConsumer, self).__init__(queue, **kwargs)
+        self.config_key = config_key
+
+    def setup(self):
+        super(BatchConsumer, self).setup()
+        options = self.container.config.get(self.config_key) or {}
+        self.max_size = int(options.get('MAX_SIZE') or 1)
+        self.max_wait = float(options.get('MAX_WAIT_MS') or 0) / 1000
+        self.max_workers = entrypoint_settings(self.container.config).get(
+            self.method_name, {}
+        ).get('max_workers')
+        self._lanes = {}
+        # lanes with a batch ready while `max_workers` workers run
+        self._waiting = OrderedDict()
+        self._running = 0
+        self._drained = None
+
+    def stop(self):
+        super(BatchConsumer, self).stop()
+        self._drained = Event()
+        for lane in list(self._lanes.values()):
+            self._flush(lane)
+        self._check_drained()
+        self._drained.wait()
+
+    def _check_drained(self):
+        if (
+            self._drained is not None and not self._drained.ready() and
+            not self._running and not self._lanes
+        ):
+            self._drained.send()
+
+    def _lane_key(self, body, message):
+        return None
+
+    def handle_message(self, body, message):
+        key = self._lane_key(body, message)
+        lane = self._lanes.get(key)
+        if lane is None:
+            lane = self._lanes[key] = _Lane(key)
+
+        lane.batch.append((body, message))
+        if len(lane.batch) >= self.max_size:
+            self._flush(lane)
+        elif lane.timer is None:
+            lane.timer = eventlet.spawn_after(self.max_wait, self._flush, lane)
+
+    def handle_result(
+        self, lane, messages, worker_ctx, result=None, exc_info=None
+    ):
+        for message in messages:
+            self.handle_message_processed(message, result, exc_info)
+        eventlet.spawn_n(self._hand_off, lane)
+        return result, exc_info
+
+    def _hand_off(self, lane):
+        self._running -= 1
+        for waiting in list(self._waiting.values()):
+            self._flush(waiting)
+        if self.sequential:
+            lane.running = False
+            self._flush(lane)
+        self._check_drained()
+
+    def _flush(self, lane):
+        if lane.timer is not None:
+            lane.timer.cancel()
+            lane.timer = None
+
+        if lane.running:
+            return
+        if not lane.batch:
+            self._lanes.pop(lane.key, None)
+            return
+        if self.max_workers and self._running >= self.max_workers:
+            self._waiting[lane.key] = lane
+            return
+        self._waiting.pop(lane.key, None)
+        batch = lane.batch[:self.max_size]
+        lane.batch = lane.batch[self.max_size:]
+
+        payloads = [body for body, _ in batch]
+        messages = [message for _, message in batch]
+        context_data = self.unpack_message_headers(
+            self.container.worker_ctx_cls, messages[0]
+        )
+        lane.running = self.sequential
+        self._running += 1
+        try:
+            self.container.spawn_worker(
+                self, (payloads,), {},
+                context_data=context_data,
+                handle_result=partial(self.handle_result, lane, messages)
+            )
+        except ContainerBeingKilled:
+            lane.running = False
+            self._running -= 1
+            for message in messages:
+                self.queue_consumer.requeue_message(message)
+
+consume_batch = BatchConsumer.decorator
+
+
+class PartitionedConsumer(BatchConsumer):
+    """Batch consumer of partitions of `queue`, see `PartitionedPublisher`
+
+    The config section named by `partitions_key` sets the number of
+    partitions in `COUNT` and the ones consumed here in `OWNED`, all by
+    default. Messages of one `key(payload)`, the key they are
+    partitioned by, form a lane handled by one worker at a time, so they
+    are handled strictly in order while other keys, of the same
+    partition or not, are handled in parallel. Every partition must be
+    owned by a single process, or order is lost between them.
+    """
+
+    sequential = True
+
+    def __init__(self, queue, config_key, partitions_key, key, **kwargs):
+        super(PartitionedConsumer, self).__init__(queue, config_key, **kwargs)
+        self.partitions_key = partitions_key
+        self.key = key
+
+    @property
+    def queues(self):
+        return self._queues
+
+    def setup(self):
+        options = partition_options(
+            self.container.config.get(self.partitions_key)
+        )
+        self._queues = [
+            partition_queue(self.queue, index, options['count'])
+            for index in options['owned']
+        ]
+        super(PartitionedConsumer, self).setup()
+
+    def _lane_key(self, body, message):
+        return self.key(body)
+
+consume_partitioned = PartitionedConsumer.decorator
+
+
+class InflightRequests(SharedExtension):
+    """Requests sent by `RegionRpc` still waiting for their reply
+
+    Shared by all `RegionRpc` providers and `DynamicConsumer` entrypoints
+    of a container, keyed by the request's correlation id. Nameko only
+    shares extensions which are truthy, so it must not define `__len__`.
+    """
+
+    def __init__(self):
+        super(InflightRequests, self).__init__()
+        self._waiting = {}
+
+    def register(self, correlation_id, event=None):
+        """Wait for reply to `correlation_id`
+
+        Several requests may share an `event`, only the first of their
+        replies is passed to it, later ones are treated as unawaited.
+        Event is sent `(received_at, correlation_id, body)`.
+        """
+        if event is None:
+            event = Event()
+        self._waiting[correlation_id] = event
+        return event
+
+    def discard(self, correlation_id):
+        self._waiting.pop(correlation_id, None)
+
+    def resolve(self, correlation_id, body):
+        """Pass reply to its waiting request, False if nobody waits for it
+        """
+        event = self._waiting.pop(correlation_id, None)
+        if event is None or event.ready():
+            return False
+        event.send((time.monotonic(), correlation_id, body))
+        return True
+
+
+class DynamicConsumer(Consumer):
     """
     Alternative implementation of nameko.messaging.Consumer
     to allow for dynamic reply queue name declaration.
+
+    Replies to requests sent with `RegionRpc` from the same container are
+    handed directly to the waiting caller. Only replies nobody is waiting
+    for (e.g. ones which arrived after the caller gave up) spawn a worker.
     """
-    def __init__(self, **kwargs):
+
+    inflight = InflightRequests()
+
+    def __init__(
+        self, reply_routing_key=ROUTING_KEY_CALCULATE_TAXES_REPLY, **kwargs
+    ):
+        self.reply_routing_key = reply_routing_key
         super(DynamicConsumer, self).__init__(None, kwargs)
 
     def setup(self):
         reply_queue_name = "{}_{}".format(
-            self.container.config['REGION'], ROUTING_KEY_CALCULATE_TAXES_REPLY
+            self.container.config['REGION'], self.reply_routing_key
         )
         queue = Queue(
             exchange=orders_exchange,
@@ -123,4 +759,199 @@ class DynamicConsumer(NamekoConsumer):
         self.queue = queue
         super(DynamicConsumer, self).setup()
 
+    def handle_message(self, body, message):
+        correlation_id = message.properties.get('correlation_id')
+        if correlation_id and self.inflight.resolve(correlation_id, body):
+            self.queue_consumer.ack_message(message)
+            return
+        super(DynamicConsumer, self).handle_message(body, message)
+
 consume_reply = DynamicConsumer.decorator
+
+
+class RegionRpcTimeout(Exception):
+    pass
+
+
+class RegionRpcReply:
+    """Reply to one or more requests, of which the first reply wins"""
+
+    def __init__(self, inflight, selector, timeout, origin=None):
+        self.inflight = inflight
+        self.selector = selector
+        self.origin = origin
+        self.timeout = timeout
+        self.event = Event()
+        self.requests = {}
+
+    def add_request(self, correlation_id, region):
+        self.inflight.register(correlation_id, self.event)
+        self.requests[correlation_id] = (region, time.monotonic())
+
+    def wait(self, timeout):
+        """Wait up to `timeout` seconds, return whether reply arrived"""
+        with eventlet.Timeout(timeout, False):
+            self.event.wait()
+        return self.event.ready()
+
+    def result(self, timeout=None):
+        """Wait for the reply, raise remote error or `RegionRpcTimeout`
+        """
+        timeout = self.timeout if timeout is None else timeout
+        try:
+            with eventlet.Timeout(timeout, RegionRpcTimeout(
+                'No reply within {} seconds'.format(timeout)
+            )):
+                received_at, correlation_id, body = self.event.wait()
+        except RegionRpcTimeout:
+            for region, _ in self.requests.values():
+                self.selector.record_error(region)
+            raise
+        finally:
+            for correlation_id_ in self.requests:
+                self.inflight.discard(correlation_id_)
+
+        region, sent_at = self.requests[correlation_id]
+        self.selector.record(region, received_at - sent_at)
+        if METRICS.enabled:
+            REPLY_TIME.observe(
+                (self.origin, region), received_at - sent_at
+            )
+
+        if body.get('error') is not None:
+            raise deserialize(body['error'])
+        return body.get('result')
+
+
+class RegionRpc(DependencyProvider):
+    """Request/reply client for entrypoints served by `ReplyConsumer`
+
+    `call(region, payload)` publishes a request to `fed.<region>_<routing
+    key>` stamped with a new correlation id and `<this region>_<reply
+    routing key>` as `reply_to`, then waits for the reply. All requests
+    from this region share the federated reply queue, which must be
+    consumed by a `consume_reply` entrypoint of the same service.
+    It passes every reply to the caller waiting on its correlation id.
+
+    Calls wait for at most `timeout` seconds, `REGION_RPC_TIMEOUT` config
+    value by default.
+
+    Round trip times and timeouts of calls feed a `RegionSelector`
+    configured by the `REGION_SELECTOR` config section. Calling region
+    `NEAREST` sends the request to the best ranked region and, with
+    `HEDGE_PERCENTILE` set, duplicates it to the second best one when no
+    reply arrived within that percentile of the first one's round trip
+    times. Whichever reply comes first is returned. Round trip times are
+    also observed into `REPLY_TIME` while metrics are enabled.
+
+    Requests carry trace headers with the trace id of the calling worker.
+    Like Nameko's publishers, they are published with confirms, unless
+    `REGION_RPC_CONFIRMS` is disabled, and retried on connection errors
+    with Nameko's default retry policy.
+
+    When `result_cache` names a config section with `TTL` and `MAX_SIZE`,
+    results of `call` are cached per region and payload, and identical
+    calls made while one is already waiting for its reply are coalesced
+    into a single request.
+    """
+
+    inflight = InflightRequests()
+
+    class RpcApi:
+        def __init__(self, rpc, worker_ctx):
+            self.rpc = rpc
+            self.worker_ctx = worker_ctx
+
+        def call_async(self, region, payload):
+            return self.rpc.call_async(
+                region, payload, trace_id=worker_trace_id(self.worker_ctx)
+            )
+
+        def call(self, region, payload, timeout=None):
+            return self.rpc.results.get_or_call(
+                (region, json.dumps(payload, sort_keys=True)),
+                lambda: self.call_async(region, payload).result(timeout)
+            )
+
+        def stats(self):
+            stats = self.rpc.results.stats()
+            stats.update(self.rpc.selector.stats())
+            return stats
+
+    def __init__(
+        self, routing_key, reply_routing_key, timeout=None, result_cache=None
+    ):
+        self.routing_key = routing_key
+        self.reply_routing_key = reply_routing_key
+        self.timeout = timeout
+        self.result_cache = result_cache
+
+    def setup(self):
+        config = self.container.config
+        self.region = config['REGION']
+        self.reply_to = '{}_{}'.format(
+            config['REGION'], self.reply_routing_key
+        )
+        if self.timeout is None:
+            self.timeout = float(config.get('REGION_RPC_TIMEOUT') or 5)
+        options = config.get(self.result_cache) or {}
+        self.results = ResultCache(
+            ttl=float(options.get('TTL') or 0),
+            max_size=int(options.get('MAX_SIZE') or 0) or None
+        )
+        self.producer = PersistentProducer(
+            config[AMQP_URI_CONFIG_KEY], serializer=message_serializer(config),
+            confirms=as_bool(config.get('REGION_RPC_CONFIRMS'), default=True),
+            retry_policy=DEFAULT_RETRY_POLICY
+        )
+        self.selector = RegionSelector(
+            regions(config), **selector_options(config.get('REGION_SELECTOR'))
+        )
+
+    def start(self):
+        self.producer.start()
+
+    def stop(self):
+        self.producer.stop()
+
+    def call_async(self, region, payload, reply=None, trace_id=None):
+        """Send request, or add one more request to an existing `reply`
+        """
+        if region == NEAREST:
+            return self.call_nearest_async(payload, trace_id)
+        if reply is None:
+            reply = RegionRpcReply(
+                self.inflight, self.selector, self.timeout, self.region
+            )
+        correlation_id = uuid.uuid4().hex
+        reply.add_request(correlation_id, region)
+        try:
+            self.producer.publish(
+                payload,
+                exchange=orders_exchange,
+                routing_key='{}_{}'.format(region, self.routing_key),
+                reply_to=self.reply_to,
+                correlation_id=correlation_id,
+                headers=trace_headers(self.region, trace_id)
+            )
+        except Exception:
+            self.inflight.discard(correlation_id)
+            self.selector.record_error(region)
+            raise
+        return reply
+
+    def call_nearest_async(self, payload, trace_id=None):
+        regions = self.selector.ranked()
+        reply = self.call_async(regions[0], payload, trace_id=trace_id)
+        delay = self.selector.hedge_delay(regions[0])
+        if delay is not None and delay < self.timeout and len(regions) > 1:
+            if not reply.wait(delay):
+                self.selector.hedged += 1
+                self.call_async(
+                    regions[1], payload, reply=reply, trace_id=trace_id
+                )
+            reply.timeout -= delay
+        return reply
+
+    def get_dependency(self, worker_ctx):
+        return self.RpcApi(self, worker_ctx)
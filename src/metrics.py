@@ -0,0 +1,332 @@
+import time
+from bisect import bisect_left
+from collections import deque
+from contextlib import contextmanager
+from functools import wraps
+
+from eventlet.corolocal import local
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+DEFAULT_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+)
+
+WORKER_LABELS = ('service', 'entrypoint')
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace(
+        '\n', r'\n'
+    )
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(name, _escape(value))
+        for name, value in zip(names, values)
+    ) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.sum += value
+        self.count += 1
+        index = bisect_left(self.buckets, value)
+        if index < len(self.counts):
+            self.counts[index] += 1
+
+
+class Summary:
+    """Quantiles over the last `window` observations"""
+
+    def __init__(self, window):
+        self.samples = deque(maxlen=window)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.samples.append(value)
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, quantile):
+        samples = sorted(self.samples)
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, int(quantile * len(samples)))]
+
+
+class Metric:
+    """Counter, gauge, histogram or summary with a value per combination
+    of labels
+    """
+
+    def __init__(
+        self, name, kind, help, label_names=(), buckets=None,
+        quantiles=(0.5, 0.9, 0.99), window=1000
+    ):
+        self.name = name
+        self.kind = kind
+        self.help = help
+        self.label_names = tuple(label_names)
+        self.buckets = buckets or DEFAULT_BUCKETS
+        self.quantiles = quantiles
+        self.window = window
+        self.values = {}
+
+    def inc(self, labels=(), amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def set(self, labels=(), value=0):
+        self.values[labels] = value
+
+    def observe(self, labels=(), value=0.0):
+        observed = self.values.get(labels)
+        if observed is None:
+            if self.kind == 'summary':
+                observed = Summary(self.window)
+            else:
+                observed = Histogram(self.buckets)
+            self.values[labels] = observed
+        observed.observe(value)
+
+    def render(self):
+        lines = [
+            '# HELP {} {}'.format(self.name, self.help),
+            '# TYPE {} {}'.format(self.name, self.kind),
+        ]
+        for labels, value in sorted(self.values.items()):
+            if self.kind == 'histogram':
+                names = self.label_names + ('le',)
+                cumulative = 0
+                for bound, count in zip(value.buckets, value.counts):
+                    cumulative += count
+                    lines.append('{}_bucket{} {}'.format(
+                        self.name,
+                        _format_labels(
+                            names, labels + (_format_value(bound),)
+                        ),
+                        cumulative
+                    ))
+                lines.append('{}_bucket{} {}'.format(
+                    self.name, _format_labels(names, labels + ('+Inf',)),
+                    value.count
+                ))
+            elif self.kind == 'summary':
+                names = self.label_names + ('quantile',)
+                for quantile in self.quantiles:
+                    lines.append('{}{} {}'.format(
+                        self.name,
+                        _format_labels(names, labels + (quantile,)),
+                        _format_value(value.quantile(quantile))
+                    ))
+            else:
+                lines.append('{}{} {}'.format(
+                    self.name, _format_labels(self.label_names, labels),
+                    _format_value(value)
+                ))
+                continue
+
+            suffix = _format_labels(self.label_names, labels)
+            lines.append('{}_sum{} {}'.format(
+                self.name, suffix, _format_value(value.sum)
+            ))
+            lines.append('{}_count{} {}'.format(
+                self.name, suffix, value.count
+            ))
+        return lines
+
+
+class MetricsRegistry:
+    """Process wide metrics rendered in Prometheus text format
+
+    Instrumentation checks `enabled` before doing anything else, so it
+    costs a single attribute lookup while metrics are disabled.
+    Collectors added with `add_collector` return metrics built from
+    state kept elsewhere when the registry is rendered.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self._metrics = []
+        self._collectors = {}
+
+    def counter(self, name, help, label_names=()):
+        return self._add(Metric(name, 'counter', help, label_names))
+
+    def gauge(self, name, help, label_names=()):
+        return self._add(Metric(name, 'gauge', help, label_names))
+
+    def histogram(self, name, help, label_names=(), buckets=None):
+        return self._add(
+            Metric(name, 'histogram', help, label_names, buckets)
+        )
+
+    def summary(self, name, help, label_names=(), window=1000):
+        return self._add(
+            Metric(name, 'summary', help, label_names, window=window)
+        )
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def add_collector(self, name, collector):
+        self._collectors[name] = collector
+
+    def reset(self):
+        for metric in self._metrics:
+            metric.values.clear()
+
+    def render(self):
+        metrics = list(self._metrics)
+        for collector in self._collectors.values():
+            metrics.extend(collector())
+        lines = []
+        for metric in metrics:
+            if metric.values:
+                lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+def sample(name, kind, help, value):
+    """Single unlabelled metric, for collectors"""
+    metric = Metric(name, kind, help)
+    metric.set((), value)
+    return metric
+
+
+METRICS = MetricsRegistry()
+
+QUEUE_WAIT = METRICS.histogram(
+    'worker_queue_wait_seconds',
+    'Time between spawning a worker and running it', WORKER_LABELS
+)
+HANDLER_TIME = METRICS.histogram(
+    'worker_handler_seconds', 'Time spent in service method', WORKER_LABELS
+)
+SERIALIZATION_TIME = METRICS.histogram(
+    'serialization_seconds', 'Time spent loading and dumping schemas',
+    WORKER_LABELS + ('operation',)
+)
+PUBLISH_TIME = METRICS.histogram(
+    'publish_seconds', 'Time spent publishing messages', WORKER_LABELS
+)
+WORKERS = METRICS.counter(
+    'workers_total', 'Workers run to completion', WORKER_LABELS
+)
+WORKER_ERRORS = METRICS.counter(
+    'worker_errors_total', 'Workers whose service method raised',
+    WORKER_LABELS
+)
+WORKERS_IN_FLIGHT = METRICS.gauge(
+    'workers_in_flight', 'Workers currently running', WORKER_LABELS
+)
+STARTUP_TIME = METRICS.gauge(
+    'container_startup_seconds',
+    'Time it took to set up and start all extensions of a container',
+    ('service',)
+)
+
+
+TRANSIT_TIME = METRICS.summary(
+    'message_transit_seconds',
+    'Time between publishing a message and receiving it, by the regions '
+    'it was published and consumed in', ('origin', 'destination')
+)
+REPLY_TIME = METRICS.summary(
+    'region_rpc_reply_seconds',
+    'Time between sending a request to a region and receiving its reply',
+    ('origin', 'destination')
+)
+
+
+_context = local()
+
+
+def current_labels():
+    """Labels of the worker running in the current greenthread"""
+    return getattr(_context, 'labels', ('', ''))
+
+
+def timed(metric, *extra_labels):
+    """Decorate function to observe its duration into `metric`
+
+    Durations are labelled by the worker calling the function.
+    """
+    def decorate(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not METRICS.enabled:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                metric.observe(
+                    current_labels() + extra_labels,
+                    time.perf_counter() - start
+                )
+        return wrapper
+    return decorate
+
+
+class WorkerTimer:
+    """Times one worker, passed to the container in place of its
+    `handle_result`, which is called through
+    """
+
+    def __init__(self, handle_result, labels):
+        self.handle_result = handle_result
+        self.labels = labels
+        self.spawned_at = time.perf_counter()
+
+    @contextmanager
+    def running(self):
+        labels = self.labels
+        QUEUE_WAIT.observe(labels, time.perf_counter() - self.spawned_at)
+        WORKERS_IN_FLIGHT.inc(labels)
+        _context.labels = labels
+        try:
+            yield
+        finally:
+            WORKERS_IN_FLIGHT.inc(labels, -1)
+            WORKERS.inc(labels)
+
+    def time_method(self, method):
+        labels = self.labels
+
+        @wraps(method)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            except Exception:
+                WORKER_ERRORS.inc(labels)
+                raise
+            finally:
+                HANDLER_TIME.observe(labels, time.perf_counter() - start)
+        return wrapper
+
+    def __call__(self, worker_ctx, result=None, exc_info=None):
+        if self.handle_result is None:
+            return result, exc_info
+        return self.handle_result(worker_ctx, result, exc_info)
@@ -0,0 +1,63 @@
+import hashlib
+
+from kombu import Queue
+
+
+def jump_hash(key, buckets):
+    """Jump consistent hash of 64 bit integer `key` into `buckets`
+
+    Growing the number of buckets from n to n + 1 moves only 1 / (n + 1)
+    of keys, all of them into the new bucket (Lamping and Veach, 2014).
+    """
+    bucket, jump = -1, 0
+    while jump < buckets:
+        bucket = jump
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        jump = int((bucket + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return bucket
+
+
+def partition(key, count):
+    """Partition of `count` that `key` belongs to"""
+    digest = hashlib.md5(str(key).encode('utf-8')).digest()
+    return jump_hash(int.from_bytes(digest[:8], 'big'), count)
+
+
+def partition_routing_key(routing_key, index, count):
+    if count == 1:
+        return routing_key
+    return '{}.{}'.format(routing_key, index)
+
+
+def partition_queue(queue, index, count):
+    """Queue of partition `index` of `queue` split in `count` partitions
+
+    A single partition is `queue` itself.
+    """
+    if count == 1:
+        return queue
+    return Queue(
+        exchange=queue.exchange,
+        routing_key=partition_routing_key(queue.routing_key, index, count),
+        name='{}.{}'.format(queue.name, index)
+    )
+
+
+def partition_options(config):
+    """Translate a partitions config section
+
+    `COUNT` is the number of partitions, 1 by default. `OWNED` lists
+    partitions consumed by this process, as a list or comma separated
+    string, all of them when empty.
+    """
+    config = config or {}
+    count = int(config.get('COUNT') or 1)
+    owned = config.get('OWNED')
+    if isinstance(owned, str):
+        owned = owned.split(',')
+    owned = sorted({int(index) for index in owned or () if str(index).strip()})
+    if any(index < 0 or index >= count for index in owned):
+        raise ValueError('Owned partitions {} out of range of {}'.format(
+            owned, count
+        ))
+    return {'count': count, 'owned': owned or list(range(count))}
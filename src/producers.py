@@ -0,0 +1,238 @@
+import logging
+import socket
+import time
+
+import eventlet
+from eventlet.event import Event
+from eventlet.queue import Empty, LightQueue
+from kombu import Connection, Producer
+
+from .metrics import PUBLISH_TIME, timed
+
+
+logger = logging.getLogger(__name__)
+
+
+class PublishConfirmError(Exception):
+    pass
+
+
+_STOP = object()
+
+
+class PersistentProducer:
+    """Long lived producer publishing over one connection and channel
+
+    `publish` may be called from any number of greenthreads. Messages are
+    queued and a single writer greenthread publishes everything queued
+    since its previous round back to back, so concurrent callers share
+    the channel instead of acquiring one each.
+
+    With `confirms` enabled the channel is put in publisher confirm mode
+    and the writer waits once per round for the broker to acknowledge
+    all messages published in it, so one confirm round trip is paid per
+    batch of concurrent messages rather than per message. `publish`
+    returns once its message has been confirmed.
+
+    A round failing on a connection error is retried on a fresh
+    connection, which means a message may be delivered twice. It is
+    retried once right away by default, `retry_policy` takes kombu's
+    `max_retries`, `interval_start`, `interval_step` and `interval_max`
+    to retry the way `Producer.publish(retry=True)` does.
+
+    Rounds publish at most `max_batch` messages. With `linger` seconds
+    the writer waits that long for a round to fill up before publishing
+    it, trading latency for fewer, larger batches. With `max_queued`
+    callers block while that many messages wait to be published.
+    """
+
+    def __init__(
+        self, amqp_uri, serializer='json', confirms=False, confirm_timeout=5,
+        max_batch=None, linger=0, max_queued=None, retry_policy=None
+    ):
+        self.amqp_uri = amqp_uri
+        self.serializer = serializer
+        self.confirms = confirms
+        self.confirm_timeout = confirm_timeout
+        self.max_batch = max_batch
+        self.linger = linger
+        self.retry_policy = retry_policy or {
+            'max_retries': 1, 'interval_start': 0, 'interval_step': 0
+        }
+        self._connection = None
+        self._producer = None
+        self._queue = LightQueue(max_queued)
+        self._gt = None
+        self._unconfirmed = set()
+        self._nacked = False
+        self._published = 0
+
+    def start(self):
+        if self._gt is None:
+            self._gt = eventlet.spawn(self._run)
+
+    def stop(self):
+        """Publish everything already queued, then close the connection"""
+        if self._gt is None:
+            return
+        self._queue.put(_STOP)
+        self._gt.wait()
+        self._gt = None
+        self._close()
+
+    @timed(PUBLISH_TIME)
+    def publish(self, msg, **kwargs):
+        return self.enqueue(msg, **kwargs)
+
+    def enqueue(self, msg, wait=True, **kwargs):
+        """Queue message to be published, same as `publish` but untimed
+
+        With `wait` the message has been published, and confirmed if
+        confirms are enabled, once this returns. Otherwise it returns
+        right away and errors publishing the message are only logged.
+        """
+        kwargs.setdefault('serializer', self.serializer)
+        done = Event() if wait else None
+        self._queue.put((msg, kwargs, done))
+        if done is not None:
+            return done.wait()
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.linger
+        while self.max_batch is None or len(batch) < self.max_batch:
+            if self._queue.qsize():
+                item = self._queue.get()
+            else:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except Empty:
+                    break
+            batch.append(item)
+            if item is _STOP:
+                break
+        return batch
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch = self._collect()
+            if _STOP in batch:
+                stopping = True
+                batch = [item for item in batch if item is not _STOP]
+            if batch:
+                self._publish_batch(batch)
+
+    def _retry_intervals(self):
+        policy = self.retry_policy
+        interval = policy.get('interval_start', 2)
+        for _ in range(policy['max_retries']):
+            yield min(interval, policy.get('interval_max', 30))
+            interval += policy.get('interval_step', 2)
+
+    def _publish_batch(self, batch):
+        failed = {}
+        intervals = self._retry_intervals()
+        while True:
+            try:
+                failed = self._publish_round(batch)
+            except Exception as exc:
+                self._close()
+                interval = next(intervals, None)
+                if interval is not None and self._is_connection_error(exc):
+                    logger.warning('Retrying publish after error: %s', exc)
+                    eventlet.sleep(interval)
+                    continue
+                failed = dict.fromkeys(range(len(batch)), exc)
+            break
+
+        for index, (_, kwargs, done) in enumerate(batch):
+            if done is None:
+                if index in failed:
+                    logger.error(
+                        'Failed to publish message to %s: %s',
+                        kwargs.get('routing_key'), failed[index]
+                    )
+            elif index in failed:
+                done.send_exception(failed[index])
+            else:
+                done.send(None)
+
+    def _publish_round(self, batch):
+        """Publish batch, return errors of messages that could not be sent
+        """
+        producer = self._get_producer()
+        failed = {}
+        for index, (msg, kwargs, _) in enumerate(batch):
+            try:
+                producer.publish(msg, **kwargs)
+            except Exception as exc:
+                if self._is_connection_error(exc):
+                    raise
+                failed[index] = exc
+                continue
+            if self.confirms:
+                self._published += 1
+                self._unconfirmed.add(self._published)
+        if self.confirms:
+            self._wait_for_confirms()
+        return failed
+
+    def _wait_for_confirms(self):
+        deadline = time.monotonic() + self.confirm_timeout
+        while self._unconfirmed:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise PublishConfirmError('Timed out waiting for confirms')
+            try:
+                self._connection.drain_events(timeout=remaining)
+            except socket.timeout:
+                continue
+        if self._nacked:
+            self._nacked = False
+            raise PublishConfirmError('Message was rejected by broker')
+
+    def _on_ack(self, delivery_tag, multiple):
+        if multiple:
+            self._unconfirmed = {
+                tag for tag in self._unconfirmed if tag > delivery_tag
+            }
+        else:
+            self._unconfirmed.discard(delivery_tag)
+
+    def _on_nack(self, delivery_tag, multiple):
+        self._nacked = True
+        self._on_ack(delivery_tag, multiple)
+
+    def _get_producer(self):
+        if self._producer is None:
+            self._connection = Connection(self.amqp_uri)
+            channel = self._connection.channel()
+            if self.confirms:
+                channel.confirm_select()
+                channel.events['basic_ack'].add(self._on_ack)
+                channel.events['basic_nack'].add(self._on_nack)
+                self._published = 0
+                self._unconfirmed = set()
+            self._producer = Producer(channel)
+        return self._producer
+
+    def _is_connection_error(self, exc):
+        if isinstance(exc, (socket.error, EOFError)):
+            return True
+        connection = self._connection
+        return connection is not None and isinstance(
+            exc, tuple(connection.connection_errors)
+        )
+
+    def _close(self):
+        connection = self._connection
+        self._producer = self._connection = None
+        if connection is not None:
+            try:
+                connection.release()
+            except Exception:
+                logger.debug('Error closing connection', exc_info=True)
@@ -0,0 +1,161 @@
+import logging
+import time
+
+from nameko.extensions import DependencyProvider
+from nameko.timer import Timer
+
+from .dependencies import CACHE
+from .digest import CacheDigest
+
+
+logger = logging.getLogger(__name__)
+
+
+class ReconcileStats:
+    """Outcome of reconciliation rounds run in this process"""
+
+    def __init__(self):
+        self.rounds = 0
+        self.failures = 0
+        self.divergent_buckets = 0
+        self.repaired = 0
+        self.deleted = 0
+        self.synced_at = None
+
+    def record(self, started_at, divergent, repaired, deleted):
+        self.rounds += 1
+        self.divergent_buckets = divergent
+        self.repaired += repaired
+        self.deleted += deleted
+        self.synced_at = started_at
+
+    def as_dict(self):
+        lag = None
+        if self.synced_at is not None:
+            lag = time.monotonic() - self.synced_at
+        return {
+            'rounds': self.rounds,
+            'failures': self.failures,
+            'divergent_buckets': self.divergent_buckets,
+            'repaired': self.repaired,
+            'deleted': self.deleted,
+            'lag': lag,
+        }
+
+
+DIGEST = CacheDigest()
+
+STATS = ReconcileStats()
+
+
+def reconcile_options(config):
+    """Translate the `RECONCILE` config section, zero interval disables"""
+    config = config or {}
+    return {
+        'master_region': config.get('MASTER_REGION') or 'europe',
+        'interval': float(config.get('INTERVAL') or 0),
+        'buckets': int(config.get('BUCKETS') or 4096),
+        'fanout': int(config.get('FANOUT') or 64),
+    }
+
+
+class Reconciler(DependencyProvider):
+    """Anti-entropy reconciliation of `CACHE` with the master region
+
+    Events keeping caches of regions in sync are delivered unreliably,
+    so a region's cache may miss updates. With `RECONCILE.INTERVAL` set,
+    a `CacheDigest` of `CACHE` is maintained in every region. Replicas
+    periodically compare it with the master's (see `reconcile_timer`)
+    and fetch entries of divergent buckets only, so the cost of a round
+    depends on the size of the difference rather than of the catalogue.
+
+    `encode` and `decode` convert cached values to and from the form
+    they are digested and transferred in, `version` returns the version
+    of a value, so entries are only repaired by newer ones.
+
+    `lag` in stats is the number of seconds since the start of the last
+    completed round, after which the cache was known to be in sync.
+
+    All workers share one `ReconcileApi`.
+    """
+
+    class ReconcileApi:
+        def __init__(self, digest, stats, decode, version=None):
+            self.digest = digest
+            self._stats = stats
+            self.decode = decode
+            self.version = version
+
+        def answer(self, request):
+            return self.digest.answer(request)
+
+        def reconcile(self, call):
+            started_at = time.monotonic()
+            try:
+                divergent, repaired, deleted = self.digest.repair(
+                    call, self.decode, version=self.version
+                )
+            except Exception:
+                self._stats.failures += 1
+                raise
+            self._stats.record(started_at, divergent, repaired, deleted)
+            if divergent:
+                logger.info(
+                    'Reconciled %s divergent buckets: %s entries repaired, '
+                    '%s deleted', divergent, repaired, deleted
+                )
+            return divergent, repaired, deleted
+
+        def stats(self):
+            return self._stats.as_dict()
+
+    def __init__(self, encode, decode, version=None):
+        self.encode = encode
+        self.decode = decode
+        self.version = version
+
+    def setup(self):
+        options = reconcile_options(self.container.config.get('RECONCILE'))
+        if options['interval']:
+            DIGEST.configure(
+                self.encode, buckets=options['buckets'],
+                fanout=options['fanout']
+            )
+            DIGEST.attach(CACHE)
+        self.api = self.ReconcileApi(
+            DIGEST, STATS, self.decode, self.version
+        )
+
+    def get_dependency(self, worker_ctx):
+        return self.api
+
+
+class ReconcileTimer(Timer):
+    """Timer firing every `RECONCILE.INTERVAL` seconds outside of master
+
+    Does not run at all in `RECONCILE.MASTER_REGION` or when the interval
+    is not set.
+    """
+
+    def __init__(self, **kwargs):
+        super(ReconcileTimer, self).__init__(None, **kwargs)
+
+    def setup(self):
+        config = self.container.config
+        options = reconcile_options(config.get('RECONCILE'))
+        if config['REGION'] != options['master_region']:
+            self.interval = options['interval']
+
+    def start(self):
+        if self.interval:
+            super(ReconcileTimer, self).start()
+
+    def stop(self):
+        if self.gt is not None:
+            super(ReconcileTimer, self).stop()
+
+    def kill(self):
+        if self.gt is not None:
+            super(ReconcileTimer, self).kill()
+
+reconcile_timer = ReconcileTimer.decorator
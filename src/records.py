@@ -0,0 +1,81 @@
+import sys
+from collections.abc import Mapping
+from decimal import Decimal
+
+
+_FIELDS = frozenset(('id', 'name', 'price', 'quantity', 'version'))
+
+
+class ProductRecord(Mapping):
+    """Read only product taking a fraction of the memory of a dict
+
+    Fields are kept in slots rather than a hash table, the price as an
+    integer number of units of its last digit with the exponent of that
+    digit, so `Decimal('100.50')` is stored as 10050 and -2 and read back
+    exactly, trailing zeros included. Names are interned.
+
+    Records behave as dicts of `id`, `name`, `price`, `quantity` and,
+    when the product has one, `version`. They compare equal to dicts of
+    the same items and `dict(record, quantity=1)` makes an updated copy.
+    """
+
+    __slots__ = ('id', 'name', 'quantity', 'version', '_units', '_exponent')
+
+    def __init__(self, id, name, price, quantity, version=None):
+        if not isinstance(price, Decimal):
+            price = Decimal(str(price))
+        sign, digits, exponent = price.as_tuple()
+        if not isinstance(exponent, int):
+            raise ValueError('Price {} is not finite'.format(price))
+        self.id = id
+        self.name = sys.intern(name)
+        self.quantity = quantity
+        self.version = version
+        self._units = int(price.scaleb(-exponent))
+        self._exponent = exponent
+
+    @property
+    def price(self):
+        return Decimal(self._units).scaleb(self._exponent)
+
+    def __getitem__(self, key):
+        if key == 'price':
+            return self.price
+        if key in _FIELDS:
+            value = getattr(self, key)
+            if value is not None or key != 'version':
+                return value
+        raise KeyError(key)
+
+    def __iter__(self):
+        yield 'id'
+        yield 'name'
+        yield 'price'
+        yield 'quantity'
+        if self.version is not None:
+            yield 'version'
+
+    def __len__(self):
+        return 4 if self.version is None else 5
+
+    def __reduce__(self):
+        return (ProductRecord, (
+            self.id, self.name, self.price, self.quantity, self.version
+        ))
+
+    def __repr__(self):
+        return 'ProductRecord({!r})'.format(dict(self))
+
+
+def compact_product(value):
+    """Return `value` as `ProductRecord` if it is a product dict
+
+    Anything else, e.g. a dict with fields records do not have, is
+    returned as it is.
+    """
+    if type(value) is not dict or not value.keys() <= _FIELDS:
+        return value
+    try:
+        return ProductRecord(**value)
+    except (TypeError, ValueError, ArithmeticError):
+        return value
@@ -1,4 +1,10 @@
-from marshmallow import Schema, fields
+import decimal
+import json
+
+from marshmallow import Schema, fields, missing, validate
+
+from .metrics import SERIALIZATION_TIME, timed
+from .records import ProductRecord
 
 
 class Product(Schema):
@@ -8,6 +14,31 @@ class Product(Schema):
     quantity = fields.Int(required=True)
 
 
+class ProductDelta(Schema):
+    id = fields.Int(required=True)
+    version = fields.Int(required=True)
+    name = fields.String()
+    price = fields.Decimal(as_string=True)
+    quantity = fields.Int()
+
+
+class ProductIds(Schema):
+    ids = fields.List(fields.Int(), required=True)
+
+
+class ProductSearch(Schema):
+    min_price = fields.Decimal()
+    max_price = fields.Decimal()
+    min_quantity = fields.Int()
+    max_quantity = fields.Int()
+    prefix = fields.String()
+    sort = fields.String(
+        missing='price', validate=validate.OneOf(['price', 'quantity', 'name'])
+    )
+    offset = fields.Int(missing=0, validate=validate.Range(min=0))
+    limit = fields.Int(missing=50, validate=validate.Range(min=1, max=1000))
+
+
 class Order(Schema):
     product_id = fields.Int(required=True)
     quantity = fields.Int(required=True)
@@ -15,3 +46,144 @@ class Order(Schema):
 
 class Taxes(Schema):
     order_id = fields.Int(required=True)
+
+
+class _Fallback(Exception):
+    """Value is not on the fast path, let marshmallow handle it"""
+
+
+def _int(value):
+    if type(value) is int:
+        return value
+    raise _Fallback()
+
+
+def _string(value):
+    if type(value) is str:
+        return value
+    raise _Fallback()
+
+
+def _decimal(value):
+    if type(value) not in (str, int, float, decimal.Decimal):
+        raise _Fallback()
+    num = decimal.Decimal(str(value))
+    if not num.is_finite():
+        raise _Fallback()
+    return num
+
+
+def _decimal_string(value):
+    return str(_decimal(value))
+
+
+def _compile_field(field):
+    """Return `(load, dump)` conversions of `field`, None if only
+    marshmallow can handle it
+    """
+    if (
+        field.validators or field.load_from or field.dump_to or
+        field.attribute or field.load_only or field.dump_only or
+        field.missing is not missing
+    ):
+        return None
+
+    if isinstance(field, fields.Integer):
+        return _int, _int
+    if isinstance(field, fields.String):
+        return _string, _string
+    if isinstance(field, fields.Decimal) and field.places is None:
+        dump = _decimal_string if field.as_string else _decimal
+        return _decimal, dump
+    return None
+
+
+class CompiledSchema:
+    """Fast path equivalent of a strict marshmallow schema
+
+    Field conversions are resolved once when the schema is compiled.
+    Well formed input, i.e. a dict or `ProductRecord` holding every field
+    with a value of the exact type the field produces, is converted
+    directly. Anything else
+    is handed to the marshmallow schema itself, so results and validation
+    errors are always the same as `schema_cls(strict=True)` would give.
+
+    Schemas with fields the fast path does not support, e.g. ones with
+    validators or defaults, are always handled by marshmallow.
+
+    Unlike marshmallow, methods return data directly rather than
+    a `(data, errors)` result, errors are raised as `ValidationError`.
+    """
+
+    def __init__(self, schema_cls):
+        self.schema_cls = schema_cls
+        # marshmallow schemas only keep state for the duration of a call,
+        # which never yields to other greenthreads, so they are reused
+        self._schemas = {
+            many: schema_cls(strict=True, many=many) for many in (False, True)
+        }
+        compiled = [
+            (name, _compile_field(field))
+            for name, field in schema_cls().fields.items()
+        ]
+        if all(conversions for _, conversions in compiled):
+            self._loaders = tuple(
+                (name, load) for name, (load, _) in compiled
+            )
+            self._dumpers = tuple(
+                (name, dump) for name, (_, dump) in compiled
+            )
+        else:
+            self._loaders = self._dumpers = None
+
+    @timed(SERIALIZATION_TIME, 'load')
+    def load(self, data, many=False):
+        return self._load(data, many)
+
+    @timed(SERIALIZATION_TIME, 'loads')
+    def loads(self, json_data, many=False):
+        return self._load(json.loads(json_data), many)
+
+    @timed(SERIALIZATION_TIME, 'dump')
+    def dump(self, obj, many=False):
+        return self._dump(obj, many)
+
+    @timed(SERIALIZATION_TIME, 'dumps')
+    def dumps(self, obj, many=False):
+        return json.dumps(self._dump(obj, many))
+
+    def _load(self, data, many):
+        try:
+            if many:
+                if type(data) is not list:
+                    raise _Fallback()
+                return [self._convert(item, self._loaders) for item in data]
+            return self._convert(data, self._loaders)
+        except (_Fallback, KeyError, decimal.InvalidOperation):
+            return self._schemas[many].load(data).data
+
+    def _dump(self, obj, many):
+        try:
+            if many:
+                if type(obj) is not list:
+                    raise _Fallback()
+                return [self._convert(item, self._dumpers) for item in obj]
+            return self._convert(obj, self._dumpers)
+        except (_Fallback, KeyError, decimal.InvalidOperation):
+            return self._schemas[many].dump(obj).data
+
+    @staticmethod
+    def _convert(data, converters):
+        if converters is None:
+            raise _Fallback()
+        if type(data) is not dict and type(data) is not ProductRecord:
+            raise _Fallback()
+        return {name: convert(data[name]) for name, convert in converters}
+
+
+product_schema = CompiledSchema(Product)
+order_schema = CompiledSchema(Order)
+taxes_schema = CompiledSchema(Taxes)
+product_delta_schema = CompiledSchema(ProductDelta)
+product_ids_schema = CompiledSchema(ProductIds)
+product_search_schema = CompiledSchema(ProductSearch)
@@ -0,0 +1,293 @@
+import heapq
+from bisect import bisect_left, bisect_right, insort
+from decimal import Decimal
+from itertools import accumulate, islice
+
+
+class SortedIndex:
+    """Keys of cached entries sorted by one of their fields
+
+    Entries are kept as `(value, key)` tuples in a list of sorted chunks
+    of up to `2 * LOAD` entries, with the last entry of every chunk in a
+    list of its own. Keys whose value falls in a range are found by
+    bisecting both lists and listed in order of value, then key. Adding
+    or removing an entry only moves entries of its chunk, so it takes
+    logarithmic time however many entries there are.
+    """
+
+    LOAD = 500
+
+    def __init__(self):
+        self.clear()
+
+    def __len__(self):
+        return self._len
+
+    def build(self, entries):
+        """Replace all entries by `(value, key)` tuples of `entries`"""
+        entries = sorted(entries)
+        self._chunks = [
+            entries[start:start + self.LOAD]
+            for start in range(0, len(entries), self.LOAD)
+        ]
+        self._maxes = [chunk[-1] for chunk in self._chunks]
+        self._len = len(entries)
+        self._offsets = None
+
+    def add(self, key, value):
+        entry = (value, key)
+        chunks, maxes = self._chunks, self._maxes
+        if not chunks:
+            chunks.append([entry])
+            maxes.append(entry)
+        else:
+            index = bisect_left(maxes, entry)
+            if index == len(maxes):
+                index -= 1
+                chunks[index].append(entry)
+                maxes[index] = entry
+            else:
+                insort(chunks[index], entry)
+            chunk = chunks[index]
+            if len(chunk) > 2 * self.LOAD:
+                chunks[index:index + 1] = [
+                    chunk[:self.LOAD], chunk[self.LOAD:]
+                ]
+                maxes[index:index + 1] = [chunk[self.LOAD - 1], chunk[-1]]
+        self._len += 1
+        self._offsets = None
+
+    def remove(self, key, value):
+        entry = (value, key)
+        chunks, maxes = self._chunks, self._maxes
+        index = bisect_left(maxes, entry)
+        if index == len(maxes):
+            return
+        chunk = chunks[index]
+        position = bisect_left(chunk, entry)
+        if chunk[position] != entry:
+            return
+        del chunk[position]
+        if not chunk:
+            del chunks[index]
+            del maxes[index]
+        elif position == len(chunk):
+            maxes[index] = chunk[-1]
+        self._len -= 1
+        self._offsets = None
+
+    def clear(self):
+        self._chunks = []
+        self._maxes = []
+        self._len = 0
+        # number of entries before every chunk, counted when needed
+        self._offsets = None
+
+    def _locate(self, entry, right=False):
+        """`(chunk, position)` of first entry above, or from, `entry`"""
+        bisect = bisect_right if right else bisect_left
+        index = bisect(self._maxes, entry)
+        if index == len(self._maxes):
+            return index, 0
+        return index, bisect(self._chunks[index], entry)
+
+    def _bounds(self, low=None, high=None):
+        start = (0, 0) if low is None else self._locate((low,))
+        # every tuple starting with `high` sorts below `(high, _MAX)`
+        end = (len(self._chunks), 0) if high is None else self._locate(
+            (high, _MAX), right=True
+        )
+        return start, end
+
+    def _position(self, index, position):
+        if self._offsets is None:
+            self._offsets = [0] + list(
+                accumulate(len(chunk) for chunk in self._chunks)
+            )
+        return self._offsets[index] + position
+
+    def _at(self, position):
+        self._position(0, 0)
+        index = bisect_right(self._offsets, position) - 1
+        if index >= len(self._chunks):
+            return len(self._chunks), 0
+        return index, position - self._offsets[index]
+
+    def count(self, low=None, high=None):
+        """Number of entries whose value is within inclusive bounds"""
+        start, end = self._bounds(low, high)
+        return max(0, self._position(*end) - self._position(*start))
+
+    def irange(self, low=None, high=None, skip=0):
+        """Iterate `(value, key)` with value within inclusive bounds,
+        leaving out the first `skip` of them
+
+        Entries are read a chunk at a time and the next chunk is looked up
+        from the last entry read, so the index may change while iterating,
+        e.g. when reading entries expires them.
+        """
+        index, position = self._bounds(low)[0]
+        if skip:
+            index, position = self._at(self._position(index, position) + skip)
+        while index < len(self._chunks):
+            entries = self._chunks[index][position:]
+            for entry in entries:
+                if high is not None and entry[0] > high:
+                    return
+                yield entry
+            index, position = self._locate(entries[-1], right=True)
+
+
+class _Max:
+    """Sorts above any key"""
+
+    def __lt__(self, other):
+        return False
+
+    def __gt__(self, other):
+        return True
+
+    def __eq__(self, other):
+        return isinstance(other, _Max)
+
+
+_MAX = _Max()
+
+# highest code point, a string of a prefix followed by it sorts above
+# every other string starting with the prefix
+_PREFIX_END = '\U0010ffff'
+
+
+def _price(product):
+    price = product.get('price')
+    return None if price is None else Decimal(str(price))
+
+
+def _quantity(product):
+    return product.get('quantity')
+
+
+def _name(product):
+    name = product.get('name')
+    return None if name is None else name.casefold()
+
+
+FIELDS = {'price': _price, 'quantity': _quantity, 'name': _name}
+
+
+class ProductIndex:
+    """Secondary indexes of cached products by price, quantity and name
+
+    Indexes are updated on every change of the attached cache, the same
+    way `CacheDigest` follows it. Names are indexed case insensitively,
+    so a name prefix is a range of the name index.
+
+    A search bisects every index it has bounds for and walks the one
+    with fewest entries in range, checking the other bounds against each
+    product. When results are sorted by that same index they are listed
+    as they are walked and the walk stops after a page, skipping to
+    `offset` by position when there are no other bounds to check.
+    Otherwise only the products up to the end of the page are kept in a
+    heap while walking, so the cost of a search depends on the size of
+    its most selective range rather than of the catalogue.
+    """
+
+    def __init__(self):
+        self.cache = None
+        self.indexes = {field: SortedIndex() for field in FIELDS}
+
+    def attach(self, cache):
+        """Index current entries of `cache` and follow its changes"""
+        if self.cache is cache:
+            return
+        if self.cache is not None:
+            self.cache.remove_listener(self.changed)
+        entries = {field: [] for field in FIELDS}
+        for key, value in cache.items():
+            for field, get in FIELDS.items():
+                field_value = get(value)
+                if field_value is not None:
+                    entries[field].append((field_value, key))
+        for field, index in self.indexes.items():
+            index.build(entries[field])
+        cache.add_listener(self.changed)
+        self.cache = cache
+
+    def changed(self, key, old, new):
+        for field, get in FIELDS.items():
+            old_value = None if old is None else get(old)
+            new_value = None if new is None else get(new)
+            if old_value == new_value:
+                continue
+            index = self.indexes[field]
+            if old_value is not None:
+                index.remove(key, old_value)
+            if new_value is not None:
+                index.add(key, new_value)
+
+    def search(
+        self, min_price=None, max_price=None, min_quantity=None,
+        max_quantity=None, prefix=None, sort='price', offset=0, limit=50
+    ):
+        """Return `(products, more)`, page of products within all bounds
+        sorted by `sort` field, and whether there are more of them
+        """
+        if sort not in FIELDS:
+            raise ValueError('Unknown sort field: {}'.format(sort))
+        bounds = {}
+        if min_price is not None or max_price is not None:
+            bounds['price'] = (
+                None if min_price is None else Decimal(str(min_price)),
+                None if max_price is None else Decimal(str(max_price))
+            )
+        if min_quantity is not None or max_quantity is not None:
+            bounds['quantity'] = (min_quantity, max_quantity)
+        if prefix:
+            prefix = prefix.casefold()
+            bounds['name'] = (prefix, prefix + _PREFIX_END)
+        bounds.setdefault(sort, (None, None))
+
+        walked = min(
+            bounds, key=lambda field: self.indexes[field].count(*bounds[field])
+        )
+        checks = [
+            (FIELDS[field], low, high)
+            for field, (low, high) in bounds.items()
+            if field != walked and (low is not None or high is not None)
+        ]
+
+        skip = offset if walked == sort and not checks else 0
+        products = (
+            product for product in (
+                self._get(key) for _, key in
+                self.indexes[walked].irange(*bounds[walked], skip=skip)
+            )
+            if product is not None and all(
+                _within(get(product), low, high)
+                for get, low, high in checks
+            )
+        )
+        if walked == sort:
+            start = offset - skip
+            page = list(islice(products, start, start + limit + 1))
+        else:
+            get = FIELDS[sort]
+            page = heapq.nsmallest(
+                offset + limit + 1, products,
+                key=lambda product: (get(product), product['id'])
+            )[offset:]
+        return page[:limit], len(page) > limit
+
+    def _get(self, key):
+        try:
+            return self.cache[key]
+        except KeyError:
+            return None
+
+
+def _within(value, low, high):
+    if value is None:
+        return False
+    if low is not None and value < low:
+        return False
+    return high is None or value <= high
@@ -0,0 +1,176 @@
+import math
+import time
+from bisect import bisect_left, insort
+from collections import deque
+
+
+class RegionHealth:
+    """Round trip times and failures of requests to one region
+
+    Only outcomes of the last `window` seconds are kept, at most
+    `max_samples` of the most recent ones. Round trip times are also
+    kept sorted as they are recorded and expired, so percentiles are
+    read without sorting the window.
+    """
+
+    def __init__(self, window, max_samples=1000):
+        self.window = window
+        self.max_samples = max_samples
+        self._samples = deque()
+        self._rtts = []
+        self._errors = 0
+
+    def record(self, rtt, now):
+        self._samples.append((now, rtt))
+        if rtt is None:
+            self._errors += 1
+        else:
+            insort(self._rtts, rtt)
+        if len(self._samples) > self.max_samples:
+            self._drop()
+
+    def _drop(self):
+        _, rtt = self._samples.popleft()
+        if rtt is None:
+            self._errors -= 1
+        else:
+            del self._rtts[bisect_left(self._rtts, rtt)]
+
+    def _expire(self, now):
+        samples = self._samples
+        while samples and samples[0][0] <= now - self.window:
+            self._drop()
+
+    def expires_at(self):
+        """When the oldest sample expires, None without samples"""
+        if not self._samples:
+            return None
+        return self._samples[0][0] + self.window
+
+    def rtts(self, now):
+        """Sorted round trip times, not to be modified"""
+        self._expire(now)
+        return self._rtts
+
+    def error_rate(self, now):
+        self._expire(now)
+        if not self._samples:
+            return 0.0
+        return self._errors / len(self._samples)
+
+
+def percentile(values, percent):
+    """Nearest-rank percentile of sorted `values`, None if empty"""
+    if not values:
+        return None
+    rank = max(1, int(math.ceil(percent / 100 * len(values))))
+    return values[rank - 1]
+
+
+class RegionSelector:
+    """Ranks regions by rolling round trip latency and error rate
+
+    Regions failing more than `max_error_rate` of their requests within
+    the window are unhealthy and ranked after all healthy ones. Healthy
+    regions are ranked by median round trip time, regions without recent
+    samples first, so they get probed again once their samples expired.
+
+    `hedge_delay(region)` is the `hedge_percentile` round trip time of
+    `region`, after which a request still waiting for its reply should be
+    duplicated to the next region. It is None when hedging is disabled
+    or there are no samples to base it on.
+
+    The ranking is kept until a sample is recorded or expires.
+    """
+
+    def __init__(
+        self, regions, window=60, max_error_rate=0.5, hedge_percentile=None,
+        max_samples=1000
+    ):
+        self.regions = list(regions)
+        self.max_error_rate = max_error_rate
+        self.hedge_percentile = hedge_percentile
+        self.hedged = 0
+        self._health = {
+            region: RegionHealth(window, max_samples) for region in regions
+        }
+        self._ranking = None
+        self._ranked_until = None
+
+    def record(self, region, rtt):
+        self._health[region].record(rtt, time.monotonic())
+        self._ranking = None
+
+    def record_error(self, region):
+        self._health[region].record(None, time.monotonic())
+        self._ranking = None
+
+    def ranked(self):
+        now = time.monotonic()
+        if self._ranking is None or (
+            self._ranked_until is not None and now >= self._ranked_until
+        ):
+            self._ranking = self._rank(now)
+            self._ranked_until = min(
+                (
+                    expires_at for expires_at in (
+                        health.expires_at() for health in
+                        self._health.values()
+                    )
+                    if expires_at is not None
+                ),
+                default=None
+            )
+        return list(self._ranking)
+
+    def _rank(self, now):
+        def score(region):
+            health = self._health[region]
+            unhealthy = health.error_rate(now) > self.max_error_rate
+            median = percentile(health.rtts(now), 50)
+            return unhealthy, median is not None, median or 0
+
+        return sorted(self.regions, key=score)
+
+    def nearest(self):
+        return self.ranked()[0]
+
+    def hedge_delay(self, region):
+        if not self.hedge_percentile:
+            return None
+        return percentile(
+            self._health[region].rtts(time.monotonic()),
+            self.hedge_percentile
+        )
+
+    def stats(self):
+        now = time.monotonic()
+        regions = {}
+        for region, health in self._health.items():
+            rtts = health.rtts(now)
+            error_rate = health.error_rate(now)
+            regions[region] = {
+                'samples': len(rtts),
+                'p50': percentile(rtts, 50),
+                'p95': percentile(rtts, 95),
+                'error_rate': error_rate,
+                'healthy': error_rate <= self.max_error_rate,
+            }
+        return {'hedged': self.hedged, 'regions': regions}
+
+
+def selector_options(config):
+    """Translate the `REGION_SELECTOR` config section, zero or empty
+    `HEDGE_PERCENTILE` disables hedging while zero `MAX_ERROR_RATE`
+    makes any failure unhealthy
+    """
+    config = config or {}
+    max_error_rate = config.get('MAX_ERROR_RATE', 0.5)
+    return {
+        'window': float(config.get('WINDOW') or 60),
+        'max_error_rate': float(
+            0.5 if max_error_rate in (None, '') else max_error_rate
+        ),
+        'hedge_percentile': float(config.get('HEDGE_PERCENTILE') or 0),
+        'max_samples': int(config.get('MAX_SAMPLES') or 1000),
+    }
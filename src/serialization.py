@@ -0,0 +1,89 @@
+import zlib
+from decimal import Decimal
+from functools import partial
+
+import msgpack
+from kombu.serialization import register
+
+
+COMPACT = 'compact'
+CONTENT_TYPE = 'application/x-compact'
+
+_PLAIN = b'\x00'
+_ZLIB = b'\x01'
+
+
+def _default(value):
+    # same as JSON, where Decimal prices travel as strings
+    if isinstance(value, Decimal):
+        return str(value)
+    raise TypeError('Cannot serialize {!r}'.format(value))
+
+
+def compact_dumps(body, compress_above=0):
+    """Encode `body` as msgpack, zlib compressed when longer than
+    `compress_above` bytes, 0 disables compression
+
+    The first byte of the result tells whether the rest is compressed.
+    """
+    packed = msgpack.packb(body, default=_default, use_bin_type=True)
+    if compress_above and len(packed) > compress_above:
+        return _ZLIB + zlib.compress(packed)
+    return _PLAIN + packed
+
+
+def compact_loads(data):
+    data = bytes(data)
+    packed = data[1:]
+    if data[:1] == _ZLIB:
+        packed = zlib.decompress(packed)
+    return msgpack.unpackb(packed, raw=False, strict_map_key=False)
+
+
+def compact_serializer(compress_above=0):
+    """Name of the compact serializer compressing bodies longer than
+    `compress_above` bytes, registered with kombu when first asked for
+
+    Every threshold is a serializer of its own, so containers of one
+    process may publish with different ones. All of them share the
+    content type and decoder, compression is told by the first byte.
+    """
+    if not compress_above:
+        return COMPACT
+    name = '{}+zlib{}'.format(COMPACT, compress_above)
+    register(
+        name, partial(compact_dumps, compress_above=compress_above),
+        compact_loads, content_type=CONTENT_TYPE, content_encoding='binary'
+    )
+    return name
+
+
+register(
+    COMPACT, compact_dumps, compact_loads,
+    content_type=CONTENT_TYPE, content_encoding='binary'
+)
+
+
+def accepted():
+    """Serializers messages are accepted in, whichever one they are
+    published with
+    """
+    return ['json', COMPACT]
+
+
+def message_serializer(config):
+    """Return serializer configured by `MESSAGES` config section
+
+    `SERIALIZER` is `json` by default or `compact`, which encodes bodies
+    with msgpack. `COMPRESS_ABOVE` enables compression of compact bodies
+    longer than that many bytes.
+    """
+    options = config.get('MESSAGES') or {}
+    serializer = options.get('SERIALIZER') or 'json'
+    if serializer not in accepted():
+        raise ValueError(
+            'Unsupported message serializer {}'.format(serializer)
+        )
+    if serializer == COMPACT:
+        return compact_serializer(int(options.get('COMPRESS_ABOVE') or 0))
+    return serializer
@@ -1,41 +1,214 @@
+import hashlib
 import json
 import logging
+from collections import OrderedDict
+from operator import itemgetter
 
 from marshmallow import ValidationError
-from nameko.events import EventDispatcher, event_handler, BROADCAST
-
-from nameko.messaging import Publisher, consume
-from nameko.web.handlers import http
+from nameko.events import BROADCAST
+from nameko.exceptions import RemoteError
+from werkzeug.http import quote_etag
 
+from .admission import admission_stats, http
 from .dependencies import Cache, Config
 from .messaging import (
-    consume_and_reply, consume_reply, order_queue,
-    orders_exchange, ROUTING_KEY_CALCULATE_TAXES,
-    ROUTING_KEY_CALCULATE_TAXES_REPLY, ROUTING_KEY_ORDER_PRODUCT
+    consume_and_reply, consume_partitioned, consume_reply, event_handler,
+    EventDispatcher, order_queue, NEAREST, PartitionedPublisher, RegionRpc,
+    RegionRpcTimeout, ROUTING_KEY_CACHE_DIGEST,
+    ROUTING_KEY_CACHE_DIGEST_REPLY, ROUTING_KEY_CALCULATE_TAXES,
+    ROUTING_KEY_CALCULATE_TAXES_REPLY
+)
+from .metrics import CONTENT_TYPE, METRICS
+from .reconcile import Reconciler, reconcile_options, reconcile_timer
+from .schemas import (
+    order_schema, product_delta_schema, product_ids_schema, product_schema,
+    product_search_schema, taxes_schema
 )
-from .schemas import Order, Product, Taxes
+from .topology import regions
+
+
+def encode_product(product):
+    """ Return `(etag, body)` of product's ready to send JSON response
+    """
+    body = product_schema.dumps(product).encode('utf-8')
+    return hashlib.sha1(body).hexdigest(), body
+
+
+def dump_versioned(product):
+    """ Return product's JSON serializable form including its version
+    """
+    return dict(
+        product_schema.dump(product), version=product.get('version', 0)
+    )
+
+
+def load_versioned(data):
+    product = product_schema.load(data)
+    product['version'] = data['version']
+    return product
+
+
+def product_version(product):
+    return product.get('version', 0)
+
+
+EVICTED = {
+    'error': 'EVICTED',
+    'message': 'Product was evicted from cache'
+}
 
 
 class ProductsService:
     name = 'products'
 
-    cache = Cache()
+    cache = Cache(search=True)
     config = Config()
     dispatch = EventDispatcher()
-    order_product_publisher = Publisher(queue=order_queue)
-    calculate_taxes_publisher = Publisher(exchange=orders_exchange)
+    order_product_publisher = PartitionedPublisher(
+        order_queue, 'ORDER_PARTITIONS', key=itemgetter('product_id')
+    )
+    taxes_rpc = RegionRpc(
+        ROUTING_KEY_CALCULATE_TAXES, ROUTING_KEY_CALCULATE_TAXES_REPLY,
+        result_cache='TAX_RESULT_CACHE'
+    )
+    reconciler = Reconciler(
+        dump_versioned, load_versioned, product_version
+    )
 
     @http('GET', '/products/<int:product_id>')
     def get_product(self, request, product_id):
         """ Get product from local cache
+
+        Responds with product's pre-encoded body stored by the indexer,
+        or `304 Not Modified` if it matches request's `If-None-Match`.
+        Products evicted from the bounded cache are `503 Service
+        Unavailable` rather than not found.
         """
-        product = self.cache.get(product_id)
+        product, encoded = self.cache.get_encoded(product_id)
         if not product:
+            if self.cache.was_evicted(product_id):
+                return 503, json.dumps(EVICTED)
             return 404, json.dumps({
                 'error': 'NOT_FOUND',
                 'message': 'Product not found'
             })
-        return Product(strict=True).dumps(self.cache.get(product_id)).data
+        if encoded is None:
+            encoded = encode_product(product)
+            self.cache.set_encoded(product_id, product, encoded)
+
+        etag, body = encoded
+        headers = {'ETag': quote_etag(etag)}
+        if etag in request.if_none_match:
+            return 304, headers, ''
+        return 200, headers, body
+
+    @http('GET', '/products')
+    def get_products(self, request):
+        """ Get many products from local cache in one call
+
+        Product ids are passed as a comma separated `ids` query parameter,
+        e.g. `/products?ids=1,2,3`.
+        """
+        ids = request.args.get('ids')
+        payload = {} if ids is None else {'ids': ids.split(',')}
+        return self._lookup_products(
+            lambda schema: schema.load(payload)
+        )
+
+    @http('POST', '/products/lookup')
+    def lookup_products(self, request):
+        """ Get many products from local cache in one call
+
+        Same as `get_products` with ids passed in request body as
+        `{"ids": [1, 2, 3]}`, for lists too long for a query string.
+        """
+        return self._lookup_products(
+            lambda schema: schema.loads(request.get_data(as_text=True))
+        )
+
+    def _lookup_products(self, load):
+        try:
+            ids = load(product_ids_schema)['ids']
+        except ValidationError as err:
+            return 400, json.dumps({
+                'error': 'BAD_REQUEST',
+                'message': err.messages
+            })
+
+        max_ids = int(self.config.get('PRODUCT_LOOKUP_MAX_IDS') or 5000)
+        if len(ids) > max_ids:
+            return 400, json.dumps({
+                'error': 'BAD_REQUEST',
+                'message': {
+                    'ids': ['Longer than maximum length {}.'.format(max_ids)]
+                }
+            })
+
+        ids = list(OrderedDict.fromkeys(ids))
+        products, errors = [], []
+        for product_id, product in zip(ids, self.cache.get_many(ids)):
+            if product is None and self.cache.was_evicted(product_id):
+                errors.append(dict(EVICTED, id=product_id))
+            elif product is None:
+                errors.append({
+                    'id': product_id,
+                    'error': 'NOT_FOUND',
+                    'message': 'Product not found'
+                })
+            else:
+                products.append(product)
+
+        return json.dumps({
+            'products': product_schema.dump(products, many=True),
+            'errors': errors
+        })
+
+    @http('GET', '/products/search')
+    def search_products(self, request):
+        """ Search products in local cache by price, quantity and name
+
+        Query parameters `min_price`, `max_price`, `min_quantity` and
+        `max_quantity` are inclusive bounds, `prefix` matches start of
+        the name regardless of case, e.g. low stock products are
+        `/products/search?max_quantity=5`. Products are sorted by `sort`
+        (`price`, `quantity` or `name`) and paged by `offset` and
+        `limit`, `next_offset` is null on the last page.
+        """
+        try:
+            criteria = product_search_schema.load(request.args.to_dict())
+        except ValidationError as err:
+            return 400, json.dumps({
+                'error': 'BAD_REQUEST',
+                'message': err.messages
+            })
+
+        products, more = self.cache.search(**criteria)
+        return json.dumps({
+            'products': product_schema.dump(products, many=True),
+            'next_offset': (
+                criteria['offset'] + len(products) if more else None
+            )
+        })
+
+    @http('GET', '/stats')
+    def get_stats(self, request):
+        """ Expose local cache counters (hits, misses, evictions, size),
+        cache reconciliation lag and repairs and requests admitted and
+        shed by admission control
+        """
+        return json.dumps({
+            'cache': self.cache.stats(),
+            'tax_results': self.taxes_rpc.stats(),
+            'reconcile': self.reconciler.stats(),
+            'admission': admission_stats()
+        })
+
+    @http('GET', '/metrics')
+    def get_metrics(self, request):
+        """ Expose worker timings and cache counters in Prometheus text
+        format, worker timings are only collected with `METRICS.ENABLED`
+        """
+        return 200, {'Content-Type': CONTENT_TYPE}, METRICS.render()
 
     @http('POST', '/products')
     def add_product(self, request):
@@ -44,17 +217,44 @@ class ProductsService:
         This endpoint can be called in any region and will dispatch event
         which will be handled by indexer's `handle_product_added`
         in all regions
+
+        Requests may be rejected by admission control, see `ADMISSION`
+        config section.
+        """
+        try:
+            payload = product_schema.loads(request.get_data(as_text=True))
+        except ValidationError as err:
+            return 400, json.dumps({
+                'error': 'BAD_REQUEST',
+                'message': err.messages
+            })
+        self.dispatch('product_added', product_schema.dump(payload))
+        return 200, ''
+
+    @http('POST', '/products/batch')
+    def add_products(self, request):
+        """ Add a list of products to cache in every region
+
+        Products are dispatched in `products_added` events of at most
+        `PRODUCT_BATCH_CHUNK_SIZE` products, which are handled by
+        indexer's `handle_products_added` in all regions.
         """
         try:
-            payload = Product(strict=True).loads(
-                request.get_data(as_text=True)
-            ).data
+            payload = product_schema.loads(
+                request.get_data(as_text=True), many=True
+            )
         except ValidationError as err:
             return 400, json.dumps({
                 'error': 'BAD_REQUEST',
                 'message': err.messages
             })
-        self.dispatch('product_added', Product(strict=True).dump(payload).data)
+
+        products = product_schema.dump(payload, many=True)
+        chunk_size = int(self.config.get('PRODUCT_BATCH_CHUNK_SIZE') or 500)
+        for start in range(0, len(products), chunk_size):
+            self.dispatch(
+                'products_added', products[start:start + chunk_size]
+            )
         return 200, ''
 
     @http('POST', '/orders')
@@ -65,64 +265,138 @@ class ProductsService:
         published on a federated `fed.order_product` queue that is only
         consumed in `europe` region where master database and service with
         write permissions to it lives.
+
+        With `ORDER_PARTITIONS.COUNT` set, the queue is split into that
+        many `fed.order_product.<partition>` queues and the partition is
+        chosen by product id.
+
+        Requests may be rejected by admission control before anything is
+        published, see `ADMISSION` config section.
         """
         try:
-            payload = Order(strict=True).loads(
-                request.get_data(as_text=True)
-            ).data
+            payload = order_schema.loads(request.get_data(as_text=True))
         except ValidationError as err:
             return 400, json.dumps({
                 'error': 'BAD_REQUEST',
                 'message': err.messages
             })
 
-        self.order_product_publisher(
-            payload, routing_key=ROUTING_KEY_ORDER_PRODUCT
-        )
+        self.order_product_publisher(payload)
         return 200, ''
 
-    @consume(queue=order_queue)
-    def consume_order(self, payload):
-        """ Consumes order payloads
+    @consume_partitioned(
+        queue=order_queue, config_key='ORDER_BATCH',
+        partitions_key='ORDER_PARTITIONS', key=itemgetter('product_id')
+    )
+    def consume_order(self, payloads):
+        """ Consumes batches of order payloads
 
         For our example, this consumer is only enabled in `europe` region.
         `asia` and `america` regions have this consumer disabled by setting
         `ENTRYPOINT_BLACKLIST` config value to `consume_order`.
         Custom implementation of ServiceContainer (container.py) uses this
         value to blacklist specific entrypoints.
+
+        Orders of a product are handled in order, one batch at a time,
+        while other products are handled in parallel.
+        `ORDER_PARTITIONS.OWNED` lists partitions consumed by this process,
+        so they can be spread over several processes.
+
+        Orders are delivered in batches sized by `ORDER_BATCH` config,
+        each batch holds orders of a single product. Their quantities are
+        summed up, so the product is written once and one
+        `product_updated` event is dispatched for it per batch.
+
+        Every write bumps product's `version`, `product_updated` carries
+        the new version and changed fields only.
         """
-        logging.info("Consuming order")
-        product = self.cache.get(payload['product_id'])
-        product['quantity'] -= payload['quantity']
+        logging.info("Consuming {} orders".format(len(payloads)))
+        quantities = OrderedDict()
+        for payload in payloads:
+            product_id = payload['product_id']
+            quantities[product_id] = (
+                quantities.get(product_id, 0) + payload['quantity']
+            )
 
-        # Write to master database here...
+        products = []
+        for product_id, quantity in quantities.items():
+            product = self.cache.get(product_id)
+            if product is None and self.cache.was_evicted(product_id):
+                logging.error(
+                    "Cannot apply orders of product {} evicted from cache, "
+                    "raise CACHE.MAX_SIZE to keep the whole catalogue"
+                    .format(product_id)
+                )
+                continue
+            if product is None:
+                logging.warning(
+                    "Dropping orders of unknown product {}".format(product_id)
+                )
+                continue
+            products.append(dict(
+                product,
+                quantity=product['quantity'] - quantity,
+                version=product.get('version', 0) + 1
+            ))
 
-        self.dispatch(
-            'product_updated', Product(strict=True).dump(product).data
+        self.cache.update_many(
+            (product['id'], product) for product in products
         )
 
+        # Write to master database here...
+
+        for product in products:
+            self.dispatch('product_updated', {
+                'id': product['id'],
+                'version': product['version'],
+                'quantity': product['quantity']
+            })
+
     @http('POST', '/tax/<string:remote_region>')
     def calculate_tax(self, request, remote_region):
-        """ Send tax calculation request to desired region.
+        """ Calculate tax in desired region and return the result.
+
+        Request is sent to `remote_region` and its reply comes back on the
+        federated reply queue consumed by `consume_tax_calculation`,
+        which hands it over to this worker. Results are cached for
+        `TAX_RESULT_CACHE.TTL` seconds and concurrent identical requests
+        share a single round trip.
+
+        `remote_region` may be `nearest` to let the region with the lowest
+        recent latency and error rate handle the request, see
+        `REGION_SELECTOR` config section.
         """
+        if (
+            remote_region not in regions(self.config) and
+            remote_region != NEAREST
+        ):
+            return 404, json.dumps({
+                'error': 'NOT_FOUND',
+                'message': 'Unknown region {}'.format(remote_region)
+            })
 
-        this_regions = self.config['REGION']
         payload = {'order_id': 1}
 
-        self.calculate_taxes_publisher(
-            payload,
-            routing_key="{}_{}".format(
-                remote_region, ROUTING_KEY_CALCULATE_TAXES
-            ),
-            reply_to="{}_{}".format(
-                this_regions, ROUTING_KEY_CALCULATE_TAXES_REPLY
-            )
-        )
-        return 200, ''
+        try:
+            result = self.taxes_rpc.call(remote_region, payload)
+        except RegionRpcTimeout as exc:
+            return 504, json.dumps({
+                'error': 'GATEWAY_TIMEOUT',
+                'message': str(exc)
+            })
+        except RemoteError as exc:
+            return 502, json.dumps({
+                'error': 'BAD_GATEWAY',
+                'message': str(exc)
+            })
+        return 200, json.dumps(result)
 
     @consume_reply()
     def consume_tax_calculation(self, payload):
         """ Consume tax calculation responses coming back from any regions.
+
+        Replies awaited by `calculate_tax` never reach this entrypoint,
+        only the ones which arrived too late.
         """
         logging.info(payload)
 
@@ -131,6 +405,13 @@ class IndexerService:
     name = 'indexer'
 
     cache = Cache()
+    config = Config()
+    reconciler = Reconciler(
+        dump_versioned, load_versioned, product_version
+    )
+    digest_rpc = RegionRpc(
+        ROUTING_KEY_CACHE_DIGEST, ROUTING_KEY_CACHE_DIGEST_REPLY
+    )
 
     @event_handler(
         'products', 'product_added',
@@ -138,10 +419,23 @@ class IndexerService:
     )
     def handle_product_added(self, payload):
         logging.info("Handling product added: {}".format(payload))
-        payload = Product(strict=True).load(payload).data
+        payload = product_schema.load(payload)
         self.cache.update(
             payload['id'],
-            payload
+            payload,
+            encoded=encode_product(payload)
+        )
+
+    @event_handler(
+        'products', 'products_added',
+        handler_type=BROADCAST, reliable_delivery=False
+    )
+    def handle_products_added(self, payload):
+        logging.info("Handling {} products added".format(len(payload)))
+        payload = product_schema.load(payload, many=True)
+        self.cache.update_many(
+            ((product['id'], product) for product in payload),
+            encode=encode_product
         )
 
     @event_handler(
@@ -149,15 +443,77 @@ class IndexerService:
         handler_type=BROADCAST, reliable_delivery=False
     )
     def handle_product_updated(self, payload):
-        logging.info("Handling product updated: {}".format(payload))
-        payload = Product(strict=True).load(payload).data
-        product = self.cache.get(payload['id'])
-        product.update(payload)
-        self.cache.update(
-            payload['id'],
-            payload
+        """ Apply versioned delta of a product
+
+        Federation may deliver updates late, twice or out of order.
+        Deltas are applied on top of the cached product only when their
+        version is newer than the cached one, stale and duplicate ones
+        are dropped.
+        """
+        logging.info("Handling product updated: %s", payload)
+        delta = product_delta_schema.load(payload)
+        product = self.cache.get(delta['id'])
+        if product is None and self.cache.was_evicted(delta['id']):
+            logging.warning(
+                "Dropping update of product {} evicted from cache".format(
+                    delta['id']
+                )
+            )
+            return
+        if product is None:
+            logging.warning(
+                "Dropping update of unknown product {}".format(delta['id'])
+            )
+            return
+
+        version = product.get('version', 0)
+        if delta['version'] <= version:
+            logging.info(
+                "Dropping stale update {} of product {} at version {}".format(
+                    delta['version'], delta['id'], version
+                )
+            )
+            return
+        if delta['version'] > version + 1:
+            logging.warning(
+                "Missed updates of product {} between versions {} and {}"
+                .format(delta['id'], version, delta['version'])
+            )
+
+        updated = dict(product, **delta)
+        self.cache.compare_and_set(
+            delta['id'], product, updated, encoded=encode_product(updated)
         )
 
+    @reconcile_timer()
+    def reconcile_cache(self):
+        """ Repair differences between this region's cache and master's
+
+        Runs every `RECONCILE.INTERVAL` seconds in all regions but
+        `RECONCILE.MASTER_REGION`, whose `serve_cache_digest` is asked
+        for digests and entries of divergent key ranges.
+        """
+        master_region = reconcile_options(
+            self.config.get('RECONCILE')
+        )['master_region']
+        self.reconciler.reconcile(
+            lambda request: self.digest_rpc.call_async(
+                master_region, request
+            ).result()
+        )
+
+    @consume_and_reply(
+        ROUTING_KEY_CACHE_DIGEST, ROUTING_KEY_CACHE_DIGEST_REPLY
+    )
+    def serve_cache_digest(self, payload):
+        return self.reconciler.answer(payload)
+
+    @consume_reply(ROUTING_KEY_CACHE_DIGEST_REPLY)
+    def consume_cache_digest(self, payload):
+        """ Consume cache digest replies which arrived too late
+        """
+        logging.info("Late cache digest reply")
+
 
 class TaxesService:
     name = 'taxes'
@@ -173,9 +529,9 @@ class TaxesService:
         for the details of implementation
         """
 
-        request = Taxes(strict=True).load(payload).data
+        request = taxes_schema.load(payload)
         this_region = self.config['REGION']
-        logging.info("Received request in {}".format(this_region))
+        logging.info("Received request in %s", this_region)
         return {
             'tax': 'You do not owe taxes in region {} for order id {}'.format(
                 this_region, request['order_id']
@@ -0,0 +1,209 @@
+import logging
+import os
+import pickle
+import time
+
+import eventlet
+from eventlet.semaphore import Semaphore
+
+
+logger = logging.getLogger(__name__)
+
+
+FRAME_SIZE = 10000
+
+
+class CacheSnapshot:
+    """Periodic, incremental snapshots of a `ShardedCache` to a local file
+
+    The snapshot file is a stream of pickled frames, each one a dict of
+    cache entries where `None` marks a deleted key. Every `interval`
+    seconds a frame holding only the keys changed since the previous one
+    is appended to the file. After `compact_every` appended frames the
+    file is rewritten from the current cache contents so it does not
+    grow without bound.
+
+    Loading streams frames back one by one, so a snapshot of millions of
+    entries is restored without holding more than one frame in memory
+    on top of the cache itself.
+
+    Stopping waits for a write in progress, so a compaction is not cut
+    off between writing the new file and moving it into place. Files
+    left behind by compactions which were cut off anyway, e.g. when the
+    process was killed, are removed by `load`.
+    """
+
+    def __init__(self, cache):
+        self.cache = cache
+        self.path = None
+        self.interval = None
+        self.compact_every = None
+        self.loaded = False
+        self._increments = 0
+        self._users = 0
+        self._gt = None
+        self._writing = Semaphore()
+
+    @property
+    def enabled(self):
+        return bool(self.path)
+
+    def configure(self, path, interval=5, compact_every=100):
+        self.path = path
+        self.interval = interval
+        self.compact_every = compact_every
+
+    def load(self):
+        """Restore cache entries from the snapshot file, once per process
+
+        Returns number of frames applied.
+        """
+        if self.loaded:
+            return 0
+        self.loaded = True
+        self.cache.track_changes()
+
+        temp_path = self._temp_path()
+        if os.path.exists(temp_path):
+            logger.warning(
+                'Removing unfinished cache snapshot compaction %s', temp_path
+            )
+            os.remove(temp_path)
+
+        if not os.path.exists(self.path):
+            logger.info('No cache snapshot found at %s', self.path)
+            return 0
+
+        started = time.monotonic()
+        frames = 0
+        with open(self.path, 'rb') as stream:
+            unpickler = pickle.Unpickler(stream)
+            while True:
+                try:
+                    frame = unpickler.load()
+                except EOFError:
+                    break
+                except Exception:
+                    logger.warning(
+                        'Ignoring corrupted tail of cache snapshot %s',
+                        self.path, exc_info=True
+                    )
+                    break
+                self._apply(frame)
+                frames += 1
+
+        # entries we have just loaded are already on disk
+        self.cache.drain_changes()
+
+        logger.info(
+            'Loaded %s cache entries from %s frames of %s in %.2fs',
+            len(self.cache), frames, self.path, time.monotonic() - started
+        )
+        return frames
+
+    def write(self):
+        """Append changes since the last write, compacting when due"""
+        if self._increments >= self.compact_every:
+            self.compact()
+            return
+
+        changes = self.cache.drain_changes()
+        if not changes:
+            return
+
+        frame = {}
+        for key, written in changes.items():
+            if not written:
+                frame[key] = None
+                continue
+            try:
+                frame[key] = self.cache[key]
+            except KeyError:
+                # evicted since written, nothing to restore
+                continue
+
+        with open(self.path, 'ab') as stream:
+            self._dump(frame, stream)
+            self._sync(stream)
+        self._increments += 1
+
+    def compact(self):
+        """Rewrite the snapshot file from current cache contents
+
+        Yields to other greenthreads between frames. Changes made in the
+        meantime are recorded and written with the next increment.
+        """
+        self.cache.drain_changes()
+
+        temp_path = self._temp_path()
+        with open(temp_path, 'wb') as stream:
+            frame = {}
+            for key in list(self.cache):
+                try:
+                    frame[key] = self.cache[key]
+                except KeyError:
+                    continue
+                if len(frame) >= FRAME_SIZE:
+                    self._dump(frame, stream)
+                    frame = {}
+                    eventlet.sleep()
+            if frame:
+                self._dump(frame, stream)
+            self._sync(stream)
+
+        os.replace(temp_path, self.path)
+        self._increments = 0
+
+    def start(self):
+        """Start periodic snapshots, shared by all containers in process"""
+        self._users += 1
+        if self._gt is None:
+            self._gt = eventlet.spawn(self._run)
+
+    def stop(self):
+        """Write final increment once the last container stops"""
+        self._users = max(0, self._users - 1)
+        if self._users or self._gt is None:
+            return
+        with self._writing:
+            self._gt.kill()
+        self._gt = None
+        self.write()
+
+    def _run(self):
+        while True:
+            eventlet.sleep(self.interval)
+            try:
+                with self._writing:
+                    self.write()
+            except Exception:
+                logger.exception('Failed to write cache snapshot')
+
+    def _temp_path(self):
+        return '{}.tmp'.format(self.path)
+
+    def _apply(self, frame):
+        for key, value in frame.items():
+            if value is None:
+                self.cache.pop(key, None)
+            else:
+                self.cache[key] = value
+
+    @staticmethod
+    def _dump(frame, stream):
+        pickle.dump(frame, stream, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def _sync(stream):
+        stream.flush()
+        os.fsync(stream.fileno())
+
+
+def snapshot_options(config):
+    """Translate `SNAPSHOT_*` keys of the `CACHE` config section"""
+    config = config or {}
+    return {
+        'path': config.get('SNAPSHOT_PATH') or None,
+        'interval': float(config.get('SNAPSHOT_INTERVAL') or 5),
+        'compact_every': int(config.get('SNAPSHOT_COMPACT_EVERY') or 100),
+    }
@@ -0,0 +1,111 @@
+import logging
+import time
+
+from eventlet.semaphore import Semaphore
+from kombu import Queue
+from nameko.amqp import get_connection
+from nameko.constants import AMQP_URI_CONFIG_KEY
+from nameko.extensions import SharedExtension
+
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_REGIONS = ('europe', 'asia', 'america')
+
+# entities declared by this process, per broker
+DECLARED = {}
+
+
+def regions(config):
+    """Regions listed in `REGIONS` config value
+
+    The value is a list or a comma separated string, when it is
+    populated from an environment variable.
+    """
+    value = config.get('REGIONS') or DEFAULT_REGIONS
+    if isinstance(value, str):
+        value = value.split(',')
+    return [region.strip() for region in value if region.strip()]
+
+
+def region_queues(exchange, routing_key, regions):
+    """Federated `fed.<region>_<routing_key>` queues of all `regions`"""
+    return [
+        Queue(
+            exchange=exchange,
+            routing_key='{}_{}'.format(region, routing_key),
+            name='fed.{}_{}'.format(region, routing_key)
+        )
+        for region in regions
+    ]
+
+
+def _key(entity):
+    if isinstance(entity, Queue):
+        exchange = entity.exchange.name if entity.exchange else None
+        return 'queue', entity.name, exchange, entity.routing_key
+    return 'exchange', entity.name
+
+
+def is_declared(amqp_uri, entity):
+    return _key(entity) in DECLARED.get(amqp_uri, ())
+
+
+class Topology(SharedExtension):
+    """Declares exchanges and queues of all extensions of a container
+
+    Extensions `add` entities they need during setup and call `declare`
+    when they start. The first call declares everything added so far
+    over a single connection, later ones wait for it to finish.
+
+    Declarations are pipelined: all but the last one are sent without
+    waiting for the broker's reply, the last one waits and fails if any
+    of them failed, since a failed declaration closes the channel.
+    Entities this process has already declared on the same broker are
+    skipped, so containers started after the first one declare nothing.
+    Exchanges and queues are durable, so they outlive broker restarts.
+
+    Entities stay pending until their declaration succeeded, so when
+    declaring fails, e.g. while the broker is down, the next call
+    declares them again.
+    """
+
+    def __init__(self):
+        self._pending = []
+        self._lock = Semaphore()
+
+    def add(self, *entities):
+        self._pending.extend(entities)
+
+    def declare(self):
+        with self._lock:
+            amqp_uri = self.container.config[AMQP_URI_CONFIG_KEY]
+            declared = DECLARED.setdefault(amqp_uri, set())
+
+            entities = {}
+            for entity in self._pending:
+                key = _key(entity)
+                if key not in declared:
+                    entities.setdefault(key, entity)
+            if not entities:
+                self._pending = []
+                return
+
+            started = time.perf_counter()
+            with get_connection(amqp_uri) as connection:
+                channel = connection.default_channel
+                *sent, last = entities.values()
+                for entity in sent:
+                    entity(channel).declare(nowait=True)
+                last(channel).declare()
+            declared.update(entities)
+            self._pending = [
+                entity for entity in self._pending
+                if _key(entity) not in declared
+            ]
+
+            logger.info(
+                'Declared %s exchanges and queues in %.3f seconds',
+                len(entities), time.perf_counter() - started
+            )
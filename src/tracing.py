@@ -0,0 +1,62 @@
+import time
+import uuid
+
+from nameko.messaging import HEADER_PREFIX
+
+from .metrics import METRICS, TRANSIT_TIME
+
+
+TRACE_ID = 'trace_id'
+ORIGIN_REGION = 'origin_region'
+SENT_AT = 'sent_at'
+
+
+def header_name(key):
+    return '{}.{}'.format(HEADER_PREFIX, key)
+
+
+def trace_headers(region, trace_id=None):
+    """Headers stamping a message published in `region` now
+
+    `sent_at` is wall clock time, so transit times measured between
+    regions are only as accurate as their clocks are in sync.
+    """
+    return {
+        header_name(TRACE_ID): trace_id or uuid.uuid4().hex,
+        header_name(ORIGIN_REGION): region,
+        header_name(SENT_AT): time.time(),
+    }
+
+
+def worker_trace_id(worker_ctx):
+    """Trace id of the message which started the worker
+
+    Workers not started by a traced message start a new trace, shared by
+    all messages they publish.
+    """
+    trace_id = worker_ctx.data.get(TRACE_ID)
+    if trace_id is None:
+        trace_id = worker_ctx.data[TRACE_ID] = uuid.uuid4().hex
+    return trace_id
+
+
+def record_transit(headers, region):
+    """Observe transit time of a message received in `region`"""
+    if not METRICS.enabled or not headers:
+        return
+    sent_at = headers.get(header_name(SENT_AT))
+    origin = headers.get(header_name(ORIGIN_REGION))
+    if sent_at is None or origin is None:
+        return
+    TRANSIT_TIME.observe((origin, region), max(0.0, time.time() - sent_at))
+
+
+class TraceHeaders:
+    """Adds trace headers to headers of messages published by a worker"""
+
+    def get_message_headers(self, worker_ctx):
+        headers = super(TraceHeaders, self).get_message_headers(worker_ctx)
+        headers.update(trace_headers(
+            self.container.config['REGION'], worker_trace_id(worker_ctx)
+        ))
+        return headers
@@ -37,6 +37,22 @@ def config(test_config, rabbit_config, web_config):
     return config
 
 
+@pytest.fixture
+def memory_config(test_config, web_config):
+    """Config of containers talking over kombu's in-memory transport,
+    which does not support publisher confirms
+    """
+    config = test_config.copy()
+    config.update(web_config)
+    config.update({
+        AMQP_URI_CONFIG_KEY: 'memory://',
+        'REGION': 'europe',
+        'REPLY_CONFIRMS': False,
+        'REGION_RPC_CONFIRMS': False,
+    })
+    return config
+
+
 @pytest.fixture
 def create_service_meta(container_factory, config):
 
@@ -66,8 +82,7 @@ def create_service_meta(container_factory, config):
 @pytest.fixture
 def products_service(create_service_meta):
     return create_service_meta(
-        ProductsService, 'dispatch', 'order_product_publisher',
-        'calculate_taxes_publisher'
+        ProductsService, 'dispatch', 'order_product_publisher', 'taxes_rpc'
     )
 
 
@@ -0,0 +1,78 @@
+import pytest
+
+from src.admission import (
+    AdmissionController, LatencyWindow, admission_options
+)
+
+
+def test_latency_window_forgets_old_latencies():
+    window = LatencyWindow(window=5)
+    assert window.mean(now=0) is None
+
+    window.record(0.1, now=0)
+    window.record(0.3, now=2)
+    assert window.mean(now=2) == pytest.approx(0.2)
+    assert window.mean(now=6) == pytest.approx(0.3)
+    assert window.mean(now=8) is None
+
+
+def test_will_admit_within_limits():
+    controller = AdmissionController(
+        max_in_flight=2, max_publish_latency=0.1, max_queue_depth=10,
+        queues=['fed.order_product']
+    )
+    assert controller.admit() is None
+    assert controller.admit(publish_latency=0.05) is None
+
+    controller.queue_depth = 10
+    assert controller.admit() is None
+    assert controller.stats() == {
+        'in_flight': 0, 'queue_depth': 10, 'admitted': 3, 'shed': {}
+    }
+
+
+def test_will_shed_over_limits():
+    controller = AdmissionController(
+        max_in_flight=1, max_publish_latency=0.1, max_queue_depth=10,
+        queues=['fed.order_product']
+    )
+    controller.in_flight = 1
+    assert controller.admit() == (429, 'in_flight')
+
+    controller.in_flight = 0
+    assert controller.admit(publish_latency=0.2) == (503, 'publish_latency')
+
+    controller.queue_depth = 11
+    assert controller.admit() == (503, 'queue_depth')
+    assert controller.stats()['shed'] == {
+        'in_flight': 1, 'publish_latency': 1, 'queue_depth': 1
+    }
+
+
+def test_admission_options():
+    assert admission_options({
+        'MAX_IN_FLIGHT': '100',
+        'MAX_PUBLISH_LATENCY_MS': '250',
+        'MAX_QUEUE_DEPTH': '',
+        'QUEUES': 'fed.order_product, fed.order_product.1',
+        'RETRY_AFTER': None,
+    }) == {
+        'max_in_flight': 100,
+        'max_publish_latency': 0.25,
+        'max_queue_depth': None,
+        'queues': ['fed.order_product', 'fed.order_product.1'],
+        'retry_after': 1,
+    }
+    assert admission_options(None)['max_in_flight'] is None
+
+
+def test_admission_options_watch_all_partitions_of_queues():
+    options = {'QUEUES': 'fed.order_product', 'PARTITIONS': 'ORDER_PARTITIONS'}
+    assert admission_options(options, {
+        'ORDER_PARTITIONS': {'COUNT': 3, 'OWNED': '1'}
+    })['queues'] == [
+        'fed.order_product.0', 'fed.order_product.1', 'fed.order_product.2'
+    ]
+    assert admission_options(options, {
+        'ORDER_PARTITIONS': {'COUNT': ''}
+    })['queues'] == ['fed.order_product']
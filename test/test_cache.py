@@ -0,0 +1,201 @@
+import eventlet
+import pytest
+from mock import Mock, call, patch
+
+from src.cache import ResultCache, ShardedCache, cache_options
+
+
+class TestShardedCache:
+
+    def test_get_counts_hits_and_misses(self):
+        cache = ShardedCache(shards=4)
+        cache[1] = 'one'
+
+        assert cache.get(1) == 'one'
+        assert cache.get(2) is None
+        assert cache.stats.as_dict() == {
+            'hits': 1,
+            'misses': 1,
+            'evictions': 0,
+            'expirations': 0,
+            'hit_ratio': 0.5
+        }
+
+    def test_lru_evicts_least_recently_used(self):
+        cache = ShardedCache(engine='lru', max_size=2)
+        cache[1] = 'one'
+        cache[2] = 'two'
+        cache.get(1)
+        cache[3] = 'three'
+
+        assert dict(cache) == {1: 'one', 3: 'three'}
+        assert cache.stats.evictions == 1
+
+    def test_max_size_is_split_across_shards(self):
+        cache = ShardedCache(max_size=8, shards=4)
+        for key in range(100):
+            cache[key] = key
+
+        assert len(cache) == 8
+        assert cache.stats.evictions == 92
+
+    def test_ttl_expires_entries(self):
+        cache = ShardedCache(engine='ttl', ttl=10)
+        with patch('src.cache.time.monotonic', return_value=100):
+            cache[1] = 'one'
+        with patch('src.cache.time.monotonic', return_value=105):
+            assert cache.get(1) == 'one'
+        with patch('src.cache.time.monotonic', return_value=111):
+            assert cache.get(1) is None
+            assert len(cache) == 0
+        assert cache.stats.expirations == 1
+
+    def test_will_track_evicted_keys(self):
+        cache = ShardedCache(max_size=2)
+        cache[1] = 'one'
+        cache[2] = 'two'
+        cache[3] = 'three'
+        assert not cache.was_evicted(1)
+
+        cache.track_evictions()
+        cache[4] = 'four'
+        assert cache.was_evicted(2)
+        assert not cache.was_evicted(3)
+        assert not cache.was_evicted(5)
+
+        cache[2] = 'two'
+        assert not cache.was_evicted(2)
+        assert cache.was_evicted(3)
+        cache.clear()
+        assert not cache.was_evicted(3)
+
+    def test_ttl_engine_requires_ttl(self):
+        with pytest.raises(ValueError):
+            ShardedCache(engine='ttl')
+
+    def test_unknown_engine(self):
+        with pytest.raises(ValueError) as exc_info:
+            ShardedCache(engine='fifo')
+        assert 'Unknown cache engine: fifo' in str(exc_info.value)
+
+    def test_reconfigure_keeps_entries(self):
+        cache = ShardedCache()
+        for key in range(10):
+            cache[key] = key
+
+        cache.configure(shards=5, max_size=5)
+
+        assert len(cache) == 5
+        assert cache.stats.evictions == 5
+
+    def test_will_pack_values(self):
+        cache = ShardedCache(pack=str)
+        listener = Mock()
+        cache.add_listener(listener)
+        cache[1] = 1
+        assert cache[1] == '1'
+        assert listener.call_args_list == [call(1, None, '1')]
+
+        cache.configure(pack=lambda value: value * 2)
+        assert cache[1] == '11'
+
+    def test_listeners_see_every_change(self):
+        cache = ShardedCache(max_size=2)
+        listener = Mock()
+        cache.add_listener(listener)
+
+        cache[1] = 'one'
+        cache[1] = 'uno'
+        cache[2] = 'two'
+        cache[3] = 'three'
+        del cache[2]
+        cache.configure(max_size=1)
+
+        assert listener.call_args_list == [
+            call(1, None, 'one'),
+            call(1, 'one', 'uno'),
+            call(2, None, 'two'),
+            call(1, 'uno', None),
+            call(3, None, 'three'),
+            call(2, 'two', None),
+        ]
+        assert dict(cache) == {3: 'three'}
+
+    def test_listeners_see_expirations(self):
+        cache = ShardedCache(engine='ttl', ttl=10)
+        listener = Mock()
+        cache.add_listener(listener)
+        with patch('src.cache.time.monotonic', return_value=100):
+            cache[1] = 'one'
+        with patch('src.cache.time.monotonic', return_value=111):
+            assert cache.get(1) is None
+
+        assert listener.call_args_list == [
+            call(1, None, 'one'),
+            call(1, 'one', None),
+        ]
+
+
+def test_cache_options_from_env_strings():
+    assert cache_options({
+        'ENGINE': 'TTL', 'MAX_SIZE': '100', 'TTL': '1.5', 'SHARDS': '4'
+    }) == {'engine': 'ttl', 'max_size': 100, 'ttl': 1.5, 'shards': 4}
+    assert cache_options(None) == {
+        'engine': 'lru', 'max_size': None, 'ttl': None, 'shards': 1
+    }
+
+
+class TestResultCache:
+
+    def test_caches_results(self):
+        cache = ResultCache(ttl=10)
+        func = Mock(return_value='result')
+
+        assert cache.get_or_call('key', func) == 'result'
+        assert cache.get_or_call('key', func) == 'result'
+        assert func.call_count == 1
+        assert cache.stats() == {
+            'coalesced': 0,
+            'in_flight': 0,
+            'hits': 1,
+            'misses': 1,
+            'evictions': 0,
+            'expirations': 0,
+            'hit_ratio': 0.5,
+            'size': 1
+        }
+
+    def test_coalesces_concurrent_calls(self):
+        cache = ResultCache()
+        calls = []
+
+        def func():
+            calls.append(1)
+            eventlet.sleep(0.01)
+            return 'result'
+
+        pool = eventlet.GreenPool()
+        results = list(pool.imap(
+            lambda _: cache.get_or_call('key', func), range(5)
+        ))
+
+        assert results == ['result'] * 5
+        assert len(calls) == 1
+        assert cache.stats() == {'coalesced': 4, 'in_flight': 0}
+
+    def test_errors_are_passed_to_waiters_and_not_cached(self):
+        cache = ResultCache(ttl=10)
+
+        def func():
+            eventlet.sleep(0.01)
+            raise ValueError('boom')
+
+        def call(_):
+            try:
+                cache.get_or_call('key', func)
+            except ValueError as exc:
+                return str(exc)
+
+        pool = eventlet.GreenPool()
+        assert list(pool.imap(call, range(3))) == ['boom'] * 3
+        assert cache.get_or_call('key', Mock(return_value=1)) == 1
@@ -0,0 +1,85 @@
+import eventlet
+import pytest
+from nameko.constants import AMQP_URI_CONFIG_KEY
+from nameko.testing.services import dummy, entrypoint_hook
+
+from src.container import entrypoint_settings
+from src.messaging import consume, order_queue
+
+
+def test_entrypoint_settings_from_env_strings():
+    assert entrypoint_settings({'ENTRYPOINT_SETTINGS': {
+        'consume_order': {
+            'PREFETCH_COUNT': '10', 'MAX_WORKERS': '2', 'PRIORITY': ''
+        },
+        'calculate_taxes': None
+    }}) == {
+        'consume_order': {
+            'prefetch_count': 10, 'max_workers': 2, 'priority': None
+        }
+    }
+
+
+def test_will_limit_concurrent_workers_per_entrypoint(container_factory):
+    concurrency = {'limited': [0, 0], 'unlimited': [0, 0]}
+
+    def run(method_name):
+        counters = concurrency[method_name]
+        counters[0] += 1
+        counters[1] = max(counters)
+        eventlet.sleep(0.01)
+        counters[0] -= 1
+
+    class Service:
+        name = 'service'
+
+        @dummy
+        def limited(self):
+            run('limited')
+
+        @dummy
+        def unlimited(self):
+            run('unlimited')
+
+    container = container_factory(Service, {
+        'SERVICE_CONTAINER_CLS': 'src.container.ServiceContainer',
+        'ENTRYPOINT_SETTINGS': {'limited': {'MAX_WORKERS': 1}}
+    })
+    container.start()
+
+    def call(method_name):
+        with entrypoint_hook(container, method_name) as entrypoint:
+            entrypoint()
+
+    pool = eventlet.GreenPool()
+    for _ in range(3):
+        pool.spawn(call, 'limited')
+        pool.spawn(call, 'unlimited')
+    pool.waitall()
+
+    assert concurrency['limited'][1] == 1
+    assert concurrency['unlimited'][1] == 3
+
+
+def test_consumer_may_not_prefetch_more_than_its_max_workers(
+    container_factory
+):
+    class Service:
+        name = 'service'
+
+        @consume(order_queue)
+        def consume_order(self, payload):
+            pass
+
+    container = container_factory(Service, {
+        AMQP_URI_CONFIG_KEY: 'memory://',
+        'SERVICE_CONTAINER_CLS': 'src.container.ServiceContainer',
+        'ENTRYPOINT_SETTINGS': {
+            'consume_order': {'PREFETCH_COUNT': 3, 'MAX_WORKERS': 2}
+        }
+    })
+    with pytest.raises(ValueError) as exc_info:
+        container.start()
+    assert str(exc_info.value) == (
+        'PREFETCH_COUNT 3 of consume_order exceeds its MAX_WORKERS 2'
+    )
@@ -0,0 +1,117 @@
+import itertools
+import tracemalloc
+
+import pytest
+from mock import Mock, patch
+
+from src import service as service_module
+from src.dependencies import (
+    CACHE, ENCODED, Cache, Config, encoded_options
+)
+from src.reconcile import Reconciler
+from src.schemas import ProductDelta
+from src.service import (
+    IndexerService, TaxesService, dump_versioned, load_versioned
+)
+
+
+def peak_allocated(func, number=100):
+    """Most memory in bytes allocated at once while calling `func` over
+    and over, after a first call to warm up
+    """
+    func()
+    tracemalloc.start()
+    try:
+        for _ in range(number):
+            func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+@pytest.fixture
+def container(test_config):
+    return Mock(config=dict(test_config, REGION='europe'))
+
+
+def bind(provider, container):
+    provider.container = container
+    provider.setup()
+    return provider
+
+
+def test_config_is_shared_read_only_view(container):
+    config = bind(Config(), container)
+    view = config.get_dependency(Mock())
+
+    assert view is config.get_dependency(Mock())
+    assert view['REGION'] == 'europe'
+    with pytest.raises(TypeError):
+        view['REGION'] = 'asia'
+
+
+def test_encoded_bodies_are_bounded_when_compact():
+    config = {'MAX_SIZE': '1000000'}
+    assert encoded_options(config, False)['max_size'] == 1000000
+    assert encoded_options(config, True)['max_size'] == 10000
+    assert encoded_options(
+        dict(config, ENCODED_MAX_SIZE='500'), False
+    )['max_size'] == 500
+
+
+def test_workers_share_dependencies(container):
+    for provider in (
+        Cache(), Reconciler(dump_versioned, load_versioned)
+    ):
+        bind(provider, container)
+        assert provider.get_dependency(Mock()) is provider.get_dependency(
+            Mock()
+        )
+
+
+def test_calculate_taxes_allocates_less_per_message(container):
+    config = bind(Config(), container)
+    service = TaxesService()
+
+    def handle(inject):
+        def handle_message():
+            service.config = inject()
+            service.calculate_taxes({'order_id': 1})
+        return handle_message
+
+    shared = peak_allocated(handle(lambda: config.get_dependency(None)))
+    copied = peak_allocated(handle(container.config.copy))
+    assert shared < copied
+
+
+class FreshSchema:
+    """Schema built for every message, as handlers used to"""
+
+    def load(self, data):
+        return ProductDelta(strict=True).load(data).data
+
+
+def test_product_updated_allocates_less_per_message(container, monkeypatch):
+    cache = bind(Cache(), container)
+    service = IndexerService()
+    versions = itertools.count(1)
+
+    def handle(inject):
+        def handle_message():
+            service.cache = inject()
+            service.handle_product_updated({
+                'id': 1, 'version': next(versions), 'quantity': 5
+            })
+        return handle_message
+
+    product = {'id': 1, 'name': 'Tesla', 'price': 100.0, 'quantity': 100}
+    with patch.dict(CACHE, {1: product}), patch.dict(ENCODED):
+        shared = peak_allocated(handle(lambda: cache.get_dependency(None)))
+
+        monkeypatch.setattr(
+            service_module, 'product_delta_schema', FreshSchema()
+        )
+        fresh = peak_allocated(
+            handle(lambda: Cache.CacheApi(CACHE, ENCODED))
+        )
+    assert shared < fresh
@@ -0,0 +1,175 @@
+import pytest
+
+from src.cache import ShardedCache
+from src.digest import CacheDigest
+
+
+def encode(value):
+    return {'value': value}
+
+
+def decode(data):
+    return data['value']
+
+
+@pytest.fixture
+def master():
+    cache = ShardedCache()
+    digest = CacheDigest(encode, buckets=64, fanout=8)
+    digest.attach(cache)
+    return cache, digest
+
+
+@pytest.fixture
+def replica():
+    cache = ShardedCache()
+    digest = CacheDigest(encode, buckets=64, fanout=8)
+    digest.attach(cache)
+    return cache, digest
+
+
+def call_counting(digest, requests):
+    def call(request):
+        requests.append(request)
+        return digest.answer(request)
+    return call
+
+
+def test_digest_does_not_depend_on_write_order():
+    first, second = ShardedCache(), ShardedCache()
+    first_digest = CacheDigest(encode, buckets=64, fanout=8)
+    second_digest = CacheDigest(encode, buckets=64, fanout=8)
+    first_digest.attach(first)
+    for key in range(100):
+        first[key] = key
+    for key in reversed(range(100)):
+        second[key] = key
+    second[5] = 'changed'
+    second[5] = 5
+    second_digest.attach(second)
+
+    assert first_digest.ranges() == second_digest.ranges()
+
+    del second[5]
+    assert first_digest.ranges() != second_digest.ranges()
+
+
+def test_repair_transfers_divergent_buckets_only(master, replica):
+    master_cache, master_digest = master
+    replica_cache, replica_digest = replica
+    for key in range(1000):
+        master_cache[key] = key
+        replica_cache[key] = key
+    master_cache[10] = 'updated'
+    master_cache[1000] = 1000
+    replica_cache[2000] = 2000
+
+    requests = []
+    divergent, repaired, deleted = replica_digest.repair(
+        call_counting(master_digest, requests), decode
+    )
+
+    assert (divergent, repaired, deleted) == (3, 2, 0)
+    assert requests[1]['buckets'] == sorted(
+        replica_digest.bucket(key) for key in (10, 1000, 2000)
+    )
+    assert requests[2]['keys'] == [2000]
+
+    # deleted once it is still missing in the next round
+    assert replica_digest.repair(master_digest.answer, decode) == (1, 0, 1)
+    assert dict(replica_cache) == dict(master_cache)
+    assert replica_digest.ranges() == master_digest.ranges()
+
+    requests = []
+    assert replica_digest.repair(
+        call_counting(master_digest, requests), decode
+    ) == (0, 0, 0)
+    assert len(requests) == 1
+
+
+def test_repair_keeps_newer_entries(master, replica):
+    master_cache, master_digest = master
+    replica_cache, replica_digest = replica
+    master_cache[1] = 1
+    master_cache[2] = 3
+    replica_cache[1] = 2
+    replica_cache[2] = 2
+
+    assert replica_digest.repair(
+        master_digest.answer, decode, version=lambda value: value
+    ) == (2, 1, 0)
+    assert dict(replica_cache) == {1: 2, 2: 3}
+
+
+def test_repair_does_not_restore_evicted_entries(master):
+    master_cache, master_digest = master
+    replica_cache = ShardedCache(max_size=2)
+    replica_cache.track_evictions()
+    replica_digest = CacheDigest(encode, buckets=64, fanout=8)
+    replica_digest.attach(replica_cache)
+    for key in range(3):
+        master_cache[key] = key
+        replica_cache[key] = key
+
+    assert replica_digest.repair(master_digest.answer, decode)[1:] == (0, 0)
+    assert dict(replica_cache) == {1: 1, 2: 2}
+
+
+def test_repair_keeps_entries_missing_on_other_side(master, replica):
+    master_cache, master_digest = master
+    replica_cache, replica_digest = replica
+
+    def repair():
+        return replica_digest.repair(
+            master_digest.answer, decode, version=lambda value: value
+        )
+
+    # updated meanwhile, so the other side must have it by now
+    replica_cache[1] = 1
+    assert repair() == (1, 0, 0)
+    replica_cache[1] = 2
+    assert repair() == (1, 0, 0)
+    master_cache[1] = 2
+
+    # reached the other side by the next round
+    replica_cache[2] = 2
+    assert repair() == (1, 0, 0)
+    master_cache[2] = 2
+    assert repair() == (0, 0, 0)
+    assert dict(replica_cache) == {1: 2, 2: 2}
+
+
+def test_repair_keeps_entries_evicted_on_other_side(replica):
+    master_cache = ShardedCache(max_size=1)
+    master_cache.track_evictions()
+    master_digest = CacheDigest(encode, buckets=64, fanout=8)
+    master_digest.attach(master_cache)
+    replica_cache, replica_digest = replica
+    for key in range(2):
+        master_cache[key] = key
+        replica_cache[key] = key
+
+    for _ in range(3):
+        assert replica_digest.repair(master_digest.answer, decode)[2] == 0
+    assert dict(replica_cache) == {0: 0, 1: 1}
+
+
+def test_layout_must_match(master):
+    _, master_digest = master
+    with pytest.raises(ValueError):
+        master_digest.answer({'layout': [128, 8], 'ranges': []})
+
+
+def test_reconfigure_redigests_attached_cache(master):
+    master_cache, master_digest = master
+    for key in range(10):
+        master_cache[key] = key
+
+    master_digest.configure(encode, buckets=32, fanout=4)
+
+    other = CacheDigest(encode, buckets=32, fanout=4)
+    other.attach(ShardedCache())
+    for key in range(10):
+        other.cache[key] = key
+    assert master_digest.layout == [32, 4]
+    assert master_digest.ranges() == other.ranges()
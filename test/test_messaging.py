@@ -0,0 +1,205 @@
+from operator import itemgetter
+
+import eventlet
+from eventlet.event import Event
+from kombu import Connection
+from mock import patch
+from nameko.constants import AMQP_URI_CONFIG_KEY
+from nameko.testing.services import entrypoint_hook
+from nameko.testing.utils import get_extension
+
+from src.cache import ShardedCache
+from src.dependencies import CACHE
+from src.digest import CacheDigest
+from src.messaging import (
+    ROUTING_KEY_CACHE_DIGEST, ROUTING_KEY_CACHE_DIGEST_REPLY,
+    ROUTING_KEY_ORDER_PRODUCT, DynamicConsumer, RegionRpc, consume_and_reply,
+    consume_partitioned, order_queue, orders_exchange
+)
+from src.service import (
+    IndexerService, ProductsService, TaxesService, dump_versioned,
+    load_versioned
+)
+
+
+class SlowTaxesService(TaxesService):
+
+    @consume_and_reply()
+    def calculate_taxes(self, payload):
+        eventlet.sleep(0.5)
+        return {'tax': 'slow'}
+
+
+class OrdersService(object):
+    name = 'orders'
+
+    handled = []
+    released = Event()
+
+    @consume_partitioned(
+        queue=order_queue, config_key='ORDER_BATCH',
+        partitions_key='ORDER_PARTITIONS', key=itemgetter('product_id')
+    )
+    def consume_order(self, payloads):
+        self.handled.append(payloads)
+        if payloads[0]['product_id'] == 1:
+            self.released.wait()
+
+
+class LimitedOrdersService(object):
+    name = 'orders'
+
+    running = [0, 0]
+    handled = []
+
+    @consume_partitioned(
+        queue=order_queue, config_key='ORDER_BATCH',
+        partitions_key='ORDER_PARTITIONS', key=itemgetter('product_id')
+    )
+    def consume_order(self, payloads):
+        self.running[0] += 1
+        self.running[1] = max(self.running)
+        eventlet.sleep(0.1)
+        self.running[0] -= 1
+        self.handled.extend(payloads)
+
+
+# cache of the master region, whose process is not this one
+MASTER_CACHE = ShardedCache()
+MASTER_DIGEST = CacheDigest(dump_versioned)
+MASTER_DIGEST.attach(MASTER_CACHE)
+
+
+class MasterIndexerService(IndexerService):
+
+    @consume_and_reply(
+        ROUTING_KEY_CACHE_DIGEST, ROUTING_KEY_CACHE_DIGEST_REPLY
+    )
+    def serve_cache_digest(self, payload):
+        return MASTER_DIGEST.answer(payload)
+
+
+def test_rpc_and_reply_consumer_share_inflight_requests(
+    container_factory, memory_config
+):
+    container = container_factory(ProductsService, memory_config)
+
+    rpc = get_extension(container, RegionRpc, attr_name='taxes_rpc')
+    consumer = get_extension(
+        container, DynamicConsumer, method_name='consume_tax_calculation'
+    )
+    assert rpc.inflight is consumer.inflight
+
+
+def test_will_receive_reply_to_region_rpc(container_factory, memory_config):
+    products = container_factory(ProductsService, memory_config)
+    taxes = container_factory(TaxesService, memory_config)
+    products.start()
+    taxes.start()
+
+    rpc = get_extension(products, RegionRpc, attr_name='taxes_rpc')
+    assert rpc.call_async('europe', {'order_id': 1}).result() == {
+        'tax': 'You do not owe taxes in region europe for order id 1'
+    }
+
+
+def test_replies_of_running_workers_are_sent_on_stop(
+    container_factory, memory_config
+):
+    products = container_factory(ProductsService, memory_config)
+    taxes = container_factory(SlowTaxesService, memory_config)
+    products.start()
+    taxes.start()
+
+    rpc = get_extension(products, RegionRpc, attr_name='taxes_rpc')
+    reply = rpc.call_async('europe', {'order_id': 1})
+    eventlet.sleep(0.1)
+
+    with eventlet.Timeout(5):
+        taxes.stop()
+        assert reply.result() == {'tax': 'slow'}
+
+
+def test_will_reconcile_cache_with_master_region(
+    container_factory, memory_config
+):
+    master = container_factory(MasterIndexerService, memory_config)
+    replica = container_factory(
+        IndexerService, dict(memory_config, REGION='asia')
+    )
+    master.start()
+    replica.start()
+
+    product = {'id': 1, 'name': 'Tesla', 'price': '100.0', 'quantity': 100}
+    with patch.dict(CACHE), patch.dict(MASTER_CACHE):
+        CACHE[1] = load_versioned(dict(product, version=0))
+        CACHE[2] = load_versioned(dict(product, id=2, version=0))
+        MASTER_CACHE[1] = load_versioned(dict(product, version=3))
+
+        with entrypoint_hook(replica, 'reconcile_cache') as reconcile_cache:
+            reconcile_cache()
+
+        assert CACHE[1]['version'] == 3
+        # only deleted once missing on master in the next round too
+        assert CACHE[2]['version'] == 0
+
+
+def publish_orders(config, orders):
+    with Connection(config[AMQP_URI_CONFIG_KEY]) as connection:
+        producer = connection.Producer(serializer='json')
+        for product_id, quantity in orders:
+            producer.publish(
+                {'product_id': product_id, 'quantity': quantity},
+                exchange=orders_exchange,
+                routing_key=ROUTING_KEY_ORDER_PRODUCT
+            )
+
+
+def test_orders_of_other_products_are_handled_in_parallel(
+    container_factory, memory_config
+):
+    memory_config['ORDER_BATCH'] = {'MAX_SIZE': 1}
+    container = container_factory(OrdersService, memory_config)
+    container.start()
+
+    publish_orders(memory_config, ((1, 1), (1, 2), (2, 1)))
+
+    handled = OrdersService.handled
+    with eventlet.Timeout(10):
+        while len(handled) < 2:
+            eventlet.sleep(0.01)
+        # product 2 is not held up by the running worker of product 1
+        assert handled == [
+            [{'product_id': 1, 'quantity': 1}],
+            [{'product_id': 2, 'quantity': 1}],
+        ]
+
+        OrdersService.released.send()
+        while len(handled) < 3:
+            eventlet.sleep(0.01)
+        assert handled[2] == [{'product_id': 1, 'quantity': 2}]
+
+
+def test_batches_over_max_workers_wait_outside_of_worker_pool(
+    container_factory, memory_config
+):
+    memory_config['ORDER_BATCH'] = {'MAX_SIZE': 1}
+    memory_config['max_workers'] = 2
+    memory_config['ENTRYPOINT_SETTINGS'] = {
+        'consume_order': {'PREFETCH_COUNT': 6, 'MAX_WORKERS': 1}
+    }
+    container = container_factory(LimitedOrdersService, memory_config)
+    container.start()
+
+    publish_orders(memory_config, ((index, 1) for index in range(6)))
+
+    with eventlet.Timeout(10):
+        while container._worker_pool.running() == 0:
+            eventlet.sleep(0.01)
+        # held back batches do not take slots of the pool
+        assert container._worker_pool.running() == 1
+
+        # stopping waits for all of them to be handled
+        container.stop()
+    assert LimitedOrdersService.running == [0, 1]
+    assert len(LimitedOrdersService.handled) == 6
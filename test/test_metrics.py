@@ -0,0 +1,110 @@
+import pytest
+
+from src.metrics import (
+    HANDLER_TIME, METRICS, Metric, MetricsRegistry, QUEUE_WAIT, WORKERS,
+    WORKER_ERRORS, WorkerTimer, current_labels, sample, timed
+)
+
+
+@pytest.fixture
+def enabled():
+    METRICS.reset()
+    METRICS.enabled = True
+    yield
+    METRICS.enabled = False
+    METRICS.reset()
+
+
+def test_render_counter_and_gauge():
+    registry = MetricsRegistry()
+    counter = registry.counter('hits_total', 'Hits', ('name',))
+    registry.gauge('unused', 'Not rendered until it has a value')
+    counter.inc(('a"b',))
+    counter.inc(('a"b',), 2)
+    registry.add_collector('size', lambda: [
+        sample('size', 'gauge', 'Size', 1.5)
+    ])
+
+    assert registry.render() == (
+        '# HELP hits_total Hits\n'
+        '# TYPE hits_total counter\n'
+        'hits_total{name="a\\"b"} 3\n'
+        '# HELP size Size\n'
+        '# TYPE size gauge\n'
+        'size 1.5\n'
+    )
+
+
+def test_render_histogram():
+    metric = Metric('latency', 'histogram', 'Latency', ('op',), (0.1, 1.0))
+    for value in (0.05, 0.5, 0.5, 5):
+        metric.observe(('get',), value)
+
+    assert metric.render() == [
+        '# HELP latency Latency',
+        '# TYPE latency histogram',
+        'latency_bucket{op="get",le="0.1"} 1',
+        'latency_bucket{op="get",le="1.0"} 3',
+        'latency_bucket{op="get",le="+Inf"} 4',
+        'latency_sum{op="get"} 6.05',
+        'latency_count{op="get"} 4',
+    ]
+
+
+def test_timed_is_noop_while_disabled():
+    metric = Metric('time', 'histogram', 'Time', ('a', 'b', 'op'))
+    func = timed(metric, 'call')(lambda value: value)
+
+    assert func(1) == 1
+    assert metric.values == {}
+
+
+def test_timed_labels_with_current_worker(enabled):
+    metric = Metric('time', 'histogram', 'Time', ('a', 'b', 'op'))
+    func = timed(metric, 'call')(lambda value: value)
+    timer = WorkerTimer(None, ('products', 'get_product'))
+
+    with timer.running():
+        assert current_labels() == ('products', 'get_product')
+        func(1)
+
+    assert metric.values[('products', 'get_product', 'call')].count == 1
+
+
+def test_worker_timer(enabled):
+    def handle_result(worker_ctx, result, exc_info):
+        return result * 2, exc_info
+
+    timer = WorkerTimer(handle_result, ('products', 'consume_order'))
+
+    def fail():
+        raise ValueError()
+
+    with timer.running():
+        assert timer.time_method(lambda: 2)() == 2
+        with pytest.raises(ValueError):
+            timer.time_method(fail)()
+        assert timer(None, 2, None) == (4, None)
+
+    labels = ('products', 'consume_order')
+    assert QUEUE_WAIT.values[labels].count == 1
+    assert HANDLER_TIME.values[labels].count == 2
+    assert WORKER_ERRORS.values[labels] == 1
+    assert WORKERS.values[labels] == 1
+    assert WorkerTimer(None, labels)(None, 1, None) == (1, None)
+
+
+def test_render_summary():
+    metric = Metric('transit', 'summary', 'Transit', ('origin',), window=3)
+    for value in (9.0, 1.0, 2.0, 3.0):
+        metric.observe(('asia',), value)
+
+    assert metric.render() == [
+        '# HELP transit Transit',
+        '# TYPE transit summary',
+        'transit{origin="asia",quantile="0.5"} 2.0',
+        'transit{origin="asia",quantile="0.9"} 3.0',
+        'transit{origin="asia",quantile="0.99"} 3.0',
+        'transit_sum{origin="asia"} 15.0',
+        'transit_count{origin="asia"} 4',
+    ]
@@ -0,0 +1,49 @@
+from collections import Counter
+
+import pytest
+from kombu import Exchange, Queue
+
+from src.partitions import (
+    jump_hash, partition, partition_options, partition_queue
+)
+
+
+def test_partitions_are_balanced_and_consistent():
+    counts = Counter(partition(key, 8) for key in range(8000))
+    assert sorted(counts) == list(range(8))
+    assert min(counts.values()) > 800
+
+    moved = [
+        key for key in range(8000) if partition(key, 8) != partition(key, 9)
+    ]
+    assert all(partition(key, 9) == 8 for key in moved)
+    assert len(moved) < 8000 / 9 * 1.2
+
+    assert jump_hash(12345, 1) == 0
+    assert partition('1', 4) == partition(1, 4)
+
+
+def test_partition_queue():
+    queue = Queue(
+        exchange=Exchange('orders'), routing_key='order_product',
+        name='fed.order_product'
+    )
+    assert partition_queue(queue, 0, 1) is queue
+
+    partitioned = partition_queue(queue, 3, 4)
+    assert partitioned.name == 'fed.order_product.3'
+    assert partitioned.routing_key == 'order_product.3'
+    assert partitioned.exchange.name == 'orders'
+
+
+def test_partition_options():
+    assert partition_options(None) == {'count': 1, 'owned': [0]}
+    assert partition_options({'COUNT': '4', 'OWNED': ''}) == {
+        'count': 4, 'owned': [0, 1, 2, 3]
+    }
+    assert partition_options({'COUNT': 4, 'OWNED': '3, 1'}) == {
+        'count': 4, 'owned': [1, 3]
+    }
+    assert partition_options({'COUNT': 4, 'OWNED': [2]})['owned'] == [2]
+    with pytest.raises(ValueError):
+        partition_options({'COUNT': 2, 'OWNED': '2'})
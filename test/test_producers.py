@@ -0,0 +1,149 @@
+import socket
+
+import eventlet
+import pytest
+from kombu import Connection, Exchange, Queue
+from kombu.exceptions import EncodeError
+from mock import patch
+
+from src.producers import PersistentProducer
+
+
+exchange = Exchange('test_producer')
+
+
+@pytest.fixture
+def queue():
+    with Connection('memory://') as connection:
+        queue = Queue(
+            'test_producer', exchange=exchange, routing_key='test_producer'
+        )(connection.default_channel)
+        queue.declare()
+        yield queue
+        # the memory transport keeps bindings of deleted queues in their
+        # exchange, which would deliver messages of later tests again
+        queue.delete()
+        exchange(connection.default_channel).delete()
+
+
+def drain(queue):
+    messages = []
+    while True:
+        message = queue.get(no_ack=True)
+        if message is None:
+            return messages
+        messages.append(message.payload)
+
+
+@pytest.fixture
+def producer():
+    producer = PersistentProducer('memory://')
+    producer.start()
+    yield producer
+    producer.stop()
+
+
+def test_concurrent_publishes_share_producer(producer, queue):
+    pool = eventlet.GreenPool()
+    for index in range(20):
+        pool.spawn(
+            producer.publish, {'index': index},
+            exchange=exchange, routing_key='test_producer'
+        )
+    pool.waitall()
+
+    assert sorted(msg['index'] for msg in drain(queue)) == list(range(20))
+
+
+def test_failing_message_does_not_fail_others(producer, queue):
+    with pytest.raises(EncodeError):
+        producer.publish(
+            {'value': object()}, exchange=exchange,
+            routing_key='test_producer'
+        )
+    producer.publish(
+        {'value': 1}, exchange=exchange, routing_key='test_producer'
+    )
+
+    assert drain(queue) == [{'value': 1}]
+
+
+def test_stop_publishes_queued_messages(queue):
+    producer = PersistentProducer('memory://')
+    producer.start()
+    gt = eventlet.spawn(
+        producer.publish, {'value': 1},
+        exchange=exchange, routing_key='test_producer'
+    )
+    eventlet.sleep()
+    producer.stop()
+
+    gt.wait()
+    assert drain(queue) == [{'value': 1}]
+
+
+def test_rounds_are_limited_to_max_batch(queue):
+    producer = PersistentProducer('memory://', max_batch=3, linger=0.05)
+    rounds = []
+    publish_batch = producer._publish_batch
+
+    def record_round(batch):
+        rounds.append(len(batch))
+        publish_batch(batch)
+
+    producer._publish_batch = record_round
+    producer.start()
+    for index in range(7):
+        producer.enqueue(
+            {'index': index}, wait=False,
+            exchange=exchange, routing_key='test_producer'
+        )
+    producer.stop()
+
+    assert rounds == [3, 3, 1]
+    assert [msg['index'] for msg in drain(queue)] == list(range(7))
+
+
+def test_fire_and_forget_failure_is_logged(queue):
+    producer = PersistentProducer('memory://')
+    producer.start()
+    with patch('src.producers.logger') as logger:
+        assert producer.enqueue(
+            {'value': object()}, wait=False,
+            exchange=exchange, routing_key='test_producer'
+        ) is None
+        producer.stop()
+
+    assert drain(queue) == []
+    assert logger.error.call_count == 1
+    assert logger.error.call_args[0][:2] == (
+        'Failed to publish message to %s: %s', 'test_producer'
+    )
+
+
+def test_will_retry_by_policy_on_connection_errors(queue):
+    producer = PersistentProducer('memory://', retry_policy={
+        'max_retries': 2, 'interval_start': 0, 'interval_step': 0
+    })
+    publish_round = producer._publish_round
+    errors = [socket.error('connection lost')] * 2
+
+    def flaky_round(batch):
+        if errors:
+            raise errors.pop()
+        return publish_round(batch)
+
+    producer._publish_round = flaky_round
+    producer.start()
+    producer.publish(
+        {'value': 1}, exchange=exchange, routing_key='test_producer'
+    )
+
+    errors.extend([socket.error('connection lost')] * 3)
+    with pytest.raises(socket.error):
+        producer.publish(
+            {'value': 2}, exchange=exchange, routing_key='test_producer'
+        )
+    producer.stop()
+
+    assert drain(queue) == [{'value': 1}]
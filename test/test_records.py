@@ -0,0 +1,71 @@
+import pickle
+from decimal import Decimal
+
+import pytest
+
+from src.records import ProductRecord, compact_product
+from src.schemas import product_schema
+
+
+@pytest.fixture
+def product():
+    return {
+        'id': 1, 'name': 'Tesla', 'price': Decimal('100.50'), 'quantity': 7
+    }
+
+
+def test_record_reads_as_product(product):
+    record = compact_product(product)
+    assert isinstance(record, ProductRecord)
+    assert record == product
+    assert dict(record) == product
+    assert str(record['price']) == '100.50'
+    assert record.get('version', 0) == 0
+    with pytest.raises(KeyError):
+        record['version']
+    with pytest.raises(KeyError):
+        record['color']
+
+
+def test_record_keeps_version(product):
+    record = compact_product(dict(product, version=3))
+    assert len(record) == 5
+    assert record['version'] == 3
+    assert dict(record, quantity=6) == dict(product, quantity=6, version=3)
+
+
+def test_record_names_are_interned(product):
+    first = compact_product(product)
+    second = compact_product(dict(product, name=''.join(['Tes', 'la'])))
+    assert first['name'] is second['name']
+
+
+def test_record_prices(product):
+    for price in ('-0.001', '12345678901234.5', '1E+3'):
+        record = compact_product(dict(product, price=Decimal(price)))
+        assert str(record['price']) == price
+    assert compact_product(dict(product, price=99.9))['price'] == (
+        Decimal('99.9')
+    )
+
+
+def test_records_pickle(product):
+    record = compact_product(dict(product, version=2))
+    assert pickle.loads(pickle.dumps(record)) == record
+
+
+def test_record_dumps_like_dict(product):
+    assert product_schema.dumps(compact_product(product)) == (
+        product_schema.dumps(product)
+    )
+
+
+@pytest.mark.parametrize('value', [
+    'Tesla',
+    {'id': 1, 'name': 'Tesla'},
+    {'id': 1, 'name': 'Tesla', 'price': 'free', 'quantity': 1},
+    {'id': 1, 'name': 'Tesla', 'price': Decimal('NaN'), 'quantity': 1},
+    {'id': 1, 'name': 'Tesla', 'price': 1, 'quantity': 1, 'color': 'red'},
+])
+def test_other_values_are_not_compacted(value):
+    assert compact_product(value) is value
@@ -0,0 +1,95 @@
+from decimal import Decimal
+
+import pytest
+from marshmallow import ValidationError
+
+from src.schemas import (
+    CompiledSchema, Order, Product, ProductIds, Taxes,
+    order_schema, product_delta_schema, product_schema,
+    product_search_schema, taxes_schema
+)
+
+
+PRODUCTS = [
+    {'id': 1, 'name': 'Tesla', 'price': '100.00', 'quantity': 100},
+    {'id': 1, 'name': 'Tesla', 'price': 100.0, 'quantity': 100, 'extra': 1},
+    {'id': 1, 'name': 'Tesla', 'price': Decimal('1E+2'), 'quantity': 1},
+    {'id': '1', 'name': b'Tesla', 'price': 100, 'quantity': 1.5},
+    {'id': True, 'name': 'Tesla', 'price': 'NaN', 'quantity': 1},
+    {'id': 'x', 'name': 5, 'price': 'abc', 'quantity': None},
+    {'name': 'Tesla'},
+    {},
+    [],
+    None,
+]
+
+
+def outcome(func, *args, **kwargs):
+    try:
+        return func(*args, **kwargs)
+    except ValidationError as exc:
+        return exc.messages
+
+
+@pytest.mark.parametrize('method', ['load', 'dump'])
+@pytest.mark.parametrize('data', PRODUCTS)
+def test_product_schema_matches_marshmallow(method, data):
+    schema = Product(strict=True)
+    expected = outcome(lambda: getattr(schema, method)(data).data)
+    assert outcome(getattr(product_schema, method), data) == expected
+
+
+@pytest.mark.parametrize('method', ['load', 'dump'])
+def test_many_matches_marshmallow(method):
+    schema = Product(strict=True, many=True)
+    for data in (PRODUCTS[:3], PRODUCTS, {}):
+        expected = outcome(lambda: getattr(schema, method)(data).data)
+        assert outcome(
+            getattr(product_schema, method), data, many=True
+        ) == expected
+
+
+@pytest.mark.parametrize('compiled, schema_cls, data', [
+    (order_schema, Order, {'product_id': 1, 'quantity': 2}),
+    (order_schema, Order, {'product_id': 1}),
+    (taxes_schema, Taxes, {'order_id': 1}),
+    (taxes_schema, Taxes, {'order_id': 'one'}),
+])
+def test_order_and_taxes_schemas_match_marshmallow(
+    compiled, schema_cls, data
+):
+    expected = outcome(lambda: schema_cls(strict=True).load(data).data)
+    assert outcome(compiled.load, data) == expected
+
+
+def test_dumps_and_loads():
+    product = {'id': 1, 'name': 'Tesla', 'price': 100.0, 'quantity': 100}
+    assert product_schema.loads(product_schema.dumps(product)) == {
+        'id': 1, 'name': 'Tesla', 'price': Decimal('100.0'), 'quantity': 100
+    }
+
+
+@pytest.mark.parametrize('data', [
+    {'ids': [1, '2']}, {'ids': 'one'}, {}
+])
+def test_unsupported_schema_falls_back_to_marshmallow(data):
+    expected = outcome(lambda: ProductIds(strict=True).load(data).data)
+    assert outcome(CompiledSchema(ProductIds).load, data) == expected
+
+
+def test_product_delta_loads_changed_fields_only():
+    delta = product_delta_schema.load(
+        {'id': 1, 'version': 2, 'price': '1.5'}
+    )
+    assert delta == {'id': 1, 'version': 2, 'price': Decimal('1.5')}
+
+    with pytest.raises(ValidationError):
+        product_delta_schema.load({'id': 1, 'quantity': 1})
+
+
+def test_product_search_fills_defaults():
+    assert product_search_schema.load({'prefix': 'te', 'limit': '5'}) == {
+        'prefix': 'te', 'sort': 'price', 'offset': 0, 'limit': 5
+    }
+    with pytest.raises(ValidationError):
+        product_search_schema.load({'sort': 'id'})
@@ -0,0 +1,141 @@
+from decimal import Decimal
+
+import pytest
+
+from src.cache import ShardedCache
+from src.search import ProductIndex, SortedIndex
+
+
+def product(id, name, price, quantity):
+    return {'id': id, 'name': name, 'price': price, 'quantity': quantity}
+
+
+@pytest.fixture
+def cache():
+    cache = ShardedCache(shards=4)
+    cache[1] = product(1, 'Tesla', Decimal('100.00'), 3)
+    cache[2] = product(2, 'tesla coil', Decimal('5.5'), 40)
+    cache[3] = product(3, 'Bike', Decimal('250'), 0)
+    cache[4] = product(4, 'Telescope', Decimal('100'), 12)
+    return cache
+
+
+@pytest.fixture
+def index(cache):
+    index = ProductIndex()
+    index.attach(cache)
+    return index
+
+
+def ids(result):
+    products, more = result
+    return [product['id'] for product in products], more
+
+
+def test_sorted_index_ranges():
+    sorted_index = SortedIndex()
+    for key, value in [(1, 10), (2, 5), (3, 10), (4, 20)]:
+        sorted_index.add(key, value)
+
+    assert sorted_index.count(5, 10) == 3
+    assert list(sorted_index.irange(10, 10)) == [(10, 1), (10, 3)]
+    assert list(sorted_index.irange(low=11)) == [(20, 4)]
+    assert sorted_index.count(21, 30) == 0
+    assert sorted_index.count(30, 21) == 0
+
+    sorted_index.remove(1, 10)
+    sorted_index.remove(1, 10)
+    assert list(sorted_index.irange(high=10)) == [(5, 2), (10, 3)]
+
+
+def test_sorted_index_chunks(monkeypatch):
+    monkeypatch.setattr(SortedIndex, 'LOAD', 2)
+    sorted_index = SortedIndex()
+    sorted_index.build((key % 7, key) for key in range(10))
+    for key in range(10, 30):
+        sorted_index.add(key, key % 7)
+    for key in range(0, 30, 3):
+        sorted_index.remove(key, key % 7)
+
+    expected = sorted(
+        (key % 7, key) for key in range(30) if key % 3
+    )
+    assert len(sorted_index) == len(expected)
+    assert list(sorted_index.irange()) == expected
+    assert sorted_index.count(2, 4) == len(
+        [entry for entry in expected if 2 <= entry[0] <= 4]
+    )
+    assert list(sorted_index.irange(2, 4, skip=3)) == [
+        entry for entry in expected if 2 <= entry[0] <= 4
+    ][3:]
+    assert list(sorted_index.irange(skip=100)) == []
+
+
+def test_sorted_index_may_change_while_iterating(monkeypatch):
+    monkeypatch.setattr(SortedIndex, 'LOAD', 2)
+    sorted_index = SortedIndex()
+    sorted_index.build((key, key) for key in range(10))
+
+    listed = []
+    for value, key in sorted_index.irange():
+        listed.append(key)
+        if key == 2:
+            for removed in range(3, 7):
+                sorted_index.remove(removed, removed)
+    assert listed == [0, 1, 2, 3, 7, 8, 9]
+
+
+def test_will_search_price_range(index):
+    assert ids(index.search(min_price=100, max_price='250')) == (
+        [1, 4, 3], False
+    )
+    assert ids(index.search(max_price=Decimal('99.99'))) == ([2], False)
+
+
+def test_will_search_low_stock(index):
+    assert ids(index.search(max_quantity=5, sort='quantity')) == (
+        [3, 1], False
+    )
+
+
+def test_will_search_name_prefix(index):
+    assert ids(index.search(prefix='TE', sort='name')) == ([4, 1, 2], False)
+    assert ids(index.search(prefix='tesla')) == ([2, 1], False)
+
+
+def test_will_combine_criteria(index):
+    assert ids(index.search(prefix='te', min_quantity=10)) == ([2, 4], False)
+    assert ids(index.search(
+        min_price=50, max_quantity=20, sort='name'
+    )) == ([3, 4, 1], False)
+
+
+def test_will_page_results(index):
+    assert ids(index.search(min_quantity=0, limit=2)) == ([2, 1], True)
+    assert ids(index.search(min_quantity=0, offset=2, limit=2)) == (
+        [4, 3], False
+    )
+    assert ids(index.search(offset=1, limit=2)) == ([1, 4], True)
+    assert ids(index.search(min_price=50, sort='quantity', offset=1)) == (
+        [1, 4], False
+    )
+
+
+def test_will_follow_cache_changes(cache, index):
+    cache[1] = dict(cache[1], price=Decimal('1'), name='Model S')
+    del cache[2]
+    cache[5] = product(5, 'Tesla Roadster', Decimal('200'), 1)
+
+    assert ids(index.search(prefix='tesla')) == ([5], False)
+    assert ids(index.search(max_price=10)) == ([1], False)
+    assert ids(index.search(max_quantity=3, sort='quantity')) == (
+        [3, 5, 1], False
+    )
+
+    cache.clear()
+    assert ids(index.search(min_price=0)) == ([], False)
+
+
+def test_unknown_sort_field(index):
+    with pytest.raises(ValueError):
+        index.search(sort='id')
@@ -0,0 +1,104 @@
+import pytest
+from mock import patch
+
+from src.selector import RegionSelector, percentile, selector_options
+
+
+REGIONS = ['europe', 'asia', 'america']
+
+
+@pytest.fixture
+def now():
+    with patch('src.selector.time.monotonic', return_value=100) as now:
+        yield now
+
+
+def test_percentile():
+    assert percentile([], 50) is None
+    assert percentile([1, 2, 3, 4], 50) == 2
+    assert percentile([1, 2, 3, 4], 95) == 4
+    assert percentile([1], 1) == 1
+
+
+def test_ranks_by_median_latency(now):
+    selector = RegionSelector(REGIONS)
+    for rtt in (0.1, 0.2, 0.3):
+        selector.record('europe', rtt)
+        selector.record('asia', rtt / 2)
+        selector.record('america', rtt * 2)
+
+    assert selector.ranked() == ['asia', 'europe', 'america']
+    assert selector.nearest() == 'asia'
+
+
+def test_unhealthy_regions_go_last(now):
+    selector = RegionSelector(REGIONS, max_error_rate=0.5)
+    for region in REGIONS:
+        selector.record(region, 0.1)
+    selector.record('europe', 0.01)
+    selector.record_error('asia')
+    selector.record_error('asia')
+
+    assert selector.ranked() == ['europe', 'america', 'asia']
+    assert selector.stats()['regions']['asia']['healthy'] is False
+
+
+def test_regions_without_recent_samples_are_probed(now):
+    selector = RegionSelector(REGIONS, window=10)
+    selector.record('europe', 0.1)
+    selector.record('asia', 0.2)
+    assert selector.nearest() == 'america'
+
+    selector.record('america', 0.3)
+    now.return_value = 105
+    selector.record('america', 0.3)
+    now.return_value = 111
+    assert selector.ranked() == ['europe', 'asia', 'america']
+    assert selector.stats()['regions']['europe']['samples'] == 0
+
+
+def test_keeps_most_recent_samples(now):
+    selector = RegionSelector(REGIONS, hedge_percentile=100, max_samples=3)
+    for rtt in (0.9, 0.8, 0.1, 0.2):
+        selector.record('europe', rtt)
+    selector.record_error('europe')
+
+    assert selector.hedge_delay('europe') == 0.2
+    assert selector.stats()['regions']['europe']['samples'] == 2
+    assert selector.stats()['regions']['europe']['error_rate'] == 1 / 3
+
+
+def test_ranking_is_kept_until_samples_change(now):
+    selector = RegionSelector(REGIONS)
+    selector.record('europe', 0.1)
+    assert selector.ranked() == ['asia', 'america', 'europe']
+
+    with patch('src.selector.sorted', create=True) as sort:
+        assert selector.ranked() == ['asia', 'america', 'europe']
+    assert not sort.called
+
+    for region in ('asia', 'america'):
+        selector.record(region, 0.2)
+    assert selector.nearest() == 'europe'
+
+
+def test_hedge_delay(now):
+    selector = RegionSelector(REGIONS, hedge_percentile=95)
+    assert selector.hedge_delay('europe') is None
+
+    for rtt in range(1, 21):
+        selector.record('europe', rtt / 100)
+    assert selector.hedge_delay('europe') == 0.19
+
+    assert RegionSelector(REGIONS).hedge_delay('europe') is None
+
+
+def test_selector_options_from_env_strings():
+    assert selector_options({
+        'WINDOW': '30', 'MAX_ERROR_RATE': '0.2', 'HEDGE_PERCENTILE': ''
+    }) == {
+        'window': 30.0, 'max_error_rate': 0.2, 'hedge_percentile': 0.0,
+        'max_samples': 1000
+    }
+    assert selector_options({'MAX_ERROR_RATE': 0})['max_error_rate'] == 0
+    assert selector_options({})['max_error_rate'] == 0.5
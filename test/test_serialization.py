@@ -0,0 +1,55 @@
+from decimal import Decimal
+
+import pytest
+from kombu.serialization import dumps, loads
+
+from src import serialization
+from src.serialization import (
+    COMPACT, CONTENT_TYPE, compact_serializer, message_serializer
+)
+
+
+def test_compact_round_trip():
+    body = {'id': 1, 'name': 'Tesla', 'price': Decimal('100.50'), 'ok': None}
+
+    content_type, encoding, data = dumps(body, serializer=COMPACT)
+    assert content_type == 'application/x-compact'
+    assert data[:1] == b'\x00'
+    assert loads(data, content_type, encoding, accept=[content_type]) == dict(
+        body, price='100.50'
+    )
+
+
+def test_compact_compresses_above_threshold():
+    body = [{'id': index, 'name': 'Product'} for index in range(100)]
+
+    _, _, compressed = dumps(body, serializer=compact_serializer(100))
+    assert compressed[:1] == b'\x01'
+    assert loads(
+        compressed, CONTENT_TYPE, 'binary', accept=[CONTENT_TYPE]
+    ) == body
+
+    _, _, plain = dumps(body, serializer=COMPACT)
+    assert len(compressed) < len(plain)
+    _, _, short = dumps(body[:1], serializer=compact_serializer(100))
+    assert short[:1] == b'\x00'
+
+
+def test_compact_rejects_unknown_types():
+    with pytest.raises(TypeError):
+        serialization.compact_dumps({'value': object()})
+
+
+def test_message_serializer_from_config():
+    assert message_serializer({}) == 'json'
+    assert message_serializer({'MESSAGES': {'SERIALIZER': 'compact'}}) == (
+        COMPACT
+    )
+    compressing = message_serializer({'MESSAGES': {
+        'SERIALIZER': 'compact', 'COMPRESS_ABOVE': '1024'
+    }})
+    assert compressing == compact_serializer(1024) != COMPACT
+    assert serialization.accepted() == ['json', COMPACT]
+
+    with pytest.raises(ValueError):
+        message_serializer({'MESSAGES': {'SERIALIZER': 'pickle'}})
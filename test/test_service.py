@@ -1,17 +1,27 @@
 import json
+from decimal import Decimal
+
 import pytest
 
-from mock import call, patch
-from nameko.exceptions import ExtensionNotFound
+from mock import Mock, call, patch
+from nameko.exceptions import ExtensionNotFound, RemoteError
 from nameko.standalone.events import event_dispatcher
 from nameko.testing.services import entrypoint_waiter, entrypoint_hook
 
-from src.dependencies import CACHE
+from src.admission import CONTROLLERS
+from src.cache import ShardedCache, cache_options
+from src.dependencies import CACHE, ENCODED
+from src.digest import CacheDigest
+from src.metrics import METRICS, TRANSIT_TIME
+from src.records import ProductRecord
 from src.messaging import (
     ROUTING_KEY_CALCULATE_TAXES, ROUTING_KEY_CALCULATE_TAXES_REPLY,
-    ROUTING_KEY_ORDER_PRODUCT, orders_exchange
+    ROUTING_KEY_ORDER_PRODUCT, RegionRpcTimeout, orders_exchange
+)
+from src.service import (
+    IndexerService, ProductsService, dump_versioned, load_versioned
 )
-from src.service import ProductsService
+from src.tracing import trace_headers
 
 
 @pytest.fixture
@@ -35,6 +45,27 @@ class TestProductService:
             'price': '100.0', 'name': 'Tesla', 'id': 1, 'quantity': 100
         }
 
+    def test_will_get_not_modified_product(
+        self, products_service, web_session, data
+    ):
+        response = web_session.get('/products/1')
+        etag = response.headers['ETag']
+
+        response = web_session.get(
+            '/products/1', headers={'If-None-Match': etag}
+        )
+        assert response.status_code == 304
+        assert response.headers['ETag'] == etag
+        assert response.content == b''
+
+        CACHE[1] = dict(CACHE[1], quantity=99)
+        response = web_session.get(
+            '/products/1', headers={'If-None-Match': etag}
+        )
+        assert response.status_code == 200
+        assert response.headers['ETag'] != etag
+        assert response.json()['quantity'] == 99
+
     def test_product_not_found(self, products_service, web_session):
         response = web_session.get('/products/1')
         assert response.status_code == 404
@@ -43,6 +74,162 @@ class TestProductService:
             'message': 'Product not found'
         }
 
+    def test_evicted_product_is_unavailable(
+        self, products_service, web_session
+    ):
+        with patch.object(CACHE, 'was_evicted', return_value=True):
+            response = web_session.get('/products/1')
+            assert response.status_code == 503
+            assert response.json() == {
+                'error': 'EVICTED',
+                'message': 'Product was evicted from cache'
+            }
+
+            response = web_session.get('/products?ids=1')
+            assert response.json()['errors'] == [{
+                'id': 1,
+                'error': 'EVICTED',
+                'message': 'Product was evicted from cache'
+            }]
+
+    def test_will_get_many_products(
+        self, products_service, web_session, data
+    ):
+        response = web_session.get('/products?ids=1,2,1')
+        assert response.status_code == 200
+        assert response.json() == {
+            'products': [
+                {'price': '100.0', 'name': 'Tesla', 'id': 1, 'quantity': 100}
+            ],
+            'errors': [
+                {'id': 2, 'error': 'NOT_FOUND', 'message': 'Product not found'}
+            ]
+        }
+
+    def test_will_lookup_many_products(
+        self, products_service, web_session, data
+    ):
+        response = web_session.post(
+            '/products/lookup', data=json.dumps({'ids': [3, 1]})
+        )
+        assert response.status_code == 200
+        assert response.json() == {
+            'products': [
+                {'price': '100.0', 'name': 'Tesla', 'id': 1, 'quantity': 100}
+            ],
+            'errors': [
+                {'id': 3, 'error': 'NOT_FOUND', 'message': 'Product not found'}
+            ]
+        }
+
+    def test_fail_getting_many_products(self, products_service, web_session):
+        response = web_session.get('/products?ids=1,two')
+        assert response.status_code == 400
+        assert response.json() == {
+            'error': 'BAD_REQUEST',
+            'message': {'ids': {'1': ['Not a valid integer.']}}
+        }
+
+        response = web_session.get('/products')
+        assert response.status_code == 400
+        assert response.json() == {
+            'error': 'BAD_REQUEST',
+            'message': {'ids': ['Missing data for required field.']}
+        }
+
+    def test_too_many_products_requested(
+        self, products_service, web_session, config
+    ):
+        max_ids = int(config['PRODUCT_LOOKUP_MAX_IDS'])
+        response = web_session.post(
+            '/products/lookup',
+            data=json.dumps({'ids': list(range(max_ids + 1))})
+        )
+        assert response.status_code == 400
+        assert response.json() == {
+            'error': 'BAD_REQUEST',
+            'message': {
+                'ids': ['Longer than maximum length {}.'.format(max_ids)]
+            }
+        }
+
+    def test_will_search_products(self, products_service, web_session, data):
+        CACHE[2] = {'id': 2, 'name': 'Bike', 'price': 5.0, 'quantity': 2}
+        CACHE[3] = {'id': 3, 'name': 'Boat', 'price': 50.0, 'quantity': 9}
+
+        response = web_session.get('/products/search?max_quantity=10&limit=1')
+        assert response.status_code == 200
+        assert response.json() == {
+            'products': [
+                {'id': 2, 'name': 'Bike', 'price': '5.0', 'quantity': 2}
+            ],
+            'next_offset': 1
+        }
+
+        response = web_session.get(
+            '/products/search?prefix=b&min_price=10&sort=name'
+        )
+        assert [product['id'] for product in response.json()['products']] == [
+            3
+        ]
+        assert response.json()['next_offset'] is None
+
+    def test_fail_searching_products(self, products_service, web_session):
+        response = web_session.get('/products/search?sort=id&limit=x')
+        assert response.status_code == 400
+        assert response.json() == {
+            'error': 'BAD_REQUEST',
+            'message': {
+                'sort': ['Not a valid choice.'],
+                'limit': ['Not a valid integer.']
+            }
+        }
+
+    def test_will_report_cache_stats(
+        self, products_service, web_session, data
+    ):
+        CACHE.stats.reset()
+        web_session.get('/products/1')
+        web_session.get('/products/2')
+        products_service.taxes_rpc.stats.return_value = {'coalesced': 0}
+
+        response = web_session.get('/stats')
+        assert response.status_code == 200
+        assert response.json()['tax_results'] == {'coalesced': 0}
+        assert response.json()['cache'] == {
+            'hits': 1,
+            'misses': 1,
+            'evictions': 0,
+            'expirations': 0,
+            'hit_ratio': 0.5,
+            'size': 1,
+            'max_size': 1000000
+        }
+
+    def test_will_expose_metrics(
+        self, create_service_meta, config, web_session, data, monkeypatch
+    ):
+        monkeypatch.setattr(METRICS, 'enabled', False)
+        METRICS.reset()
+        config['METRICS'] = {'ENABLED': 'true'}
+        create_service_meta(ProductsService, 'dispatch')
+
+        web_session.get('/products/1')
+        response = web_session.get('/metrics')
+        assert response.status_code == 200
+        assert response.headers['Content-Type'].startswith('text/plain')
+
+        lines = response.text.splitlines()
+        labels = 'service="products",entrypoint="get_product"'
+        assert 'workers_total{{{}}} 1'.format(labels) in lines
+        assert 'worker_handler_seconds_count{{{}}} 1'.format(labels) in lines
+        assert (
+            'serialization_seconds_count{{{},operation="dumps"}} 1'.format(
+                labels
+            ) in lines
+        )
+        assert any(line.startswith('cache_hits_total ') for line in lines)
+
     def test_will_add_product(self, products_service, web_session):
         payload = {'price': '100.0', 'name': 'Tesla', 'id': 1, 'quantity': 100}
         response = web_session.post('/products', data=json.dumps(payload))
@@ -51,6 +238,23 @@ class TestProductService:
             call('product_added', payload)
         ]
 
+    def test_will_dispatch_buffered_events(
+        self, create_service_meta, config, web_session, data
+    ):
+        config['PUBLISHING'] = {'BUFFERED': True, 'LINGER_MS': 10}
+        create_service_meta(
+            ProductsService, 'order_product_publisher', 'taxes_rpc'
+        )
+        indexer = create_service_meta(IndexerService)
+
+        payload = {'price': '99.0', 'name': 'Tesla', 'id': 1, 'quantity': 7}
+        with entrypoint_waiter(indexer.container, 'handle_product_added'):
+            response = web_session.post(
+                '/products', data=json.dumps(payload)
+            )
+            assert response.status_code == 200
+        assert CACHE[1]['quantity'] == 7
+
     def test_fail_adding_product(self, products_service, web_session):
         payload = {}
         response = web_session.post('/products', data=json.dumps(payload))
@@ -65,13 +269,47 @@ class TestProductService:
             }
         }
 
+    def test_will_add_products_in_chunks(
+        self, create_service_meta, config, web_session
+    ):
+        config['PRODUCT_BATCH_CHUNK_SIZE'] = 2
+        products_service = create_service_meta(ProductsService, 'dispatch')
+
+        payload = [
+            {'price': '100.0', 'name': 'Tesla', 'id': id_, 'quantity': 100}
+            for id_ in range(1, 6)
+        ]
+        response = web_session.post(
+            '/products/batch', data=json.dumps(payload)
+        )
+        assert response.status_code == 200
+        assert products_service.dispatch.call_args_list == [
+            call('products_added', payload[0:2]),
+            call('products_added', payload[2:4]),
+            call('products_added', payload[4:5]),
+        ]
+
+    def test_fail_adding_products(self, products_service, web_session):
+        payload = [
+            {'price': '100.0', 'name': 'Tesla', 'id': 1, 'quantity': 100},
+            {'price': '100.0', 'name': 'Tesla', 'id': 'two', 'quantity': 1}
+        ]
+        response = web_session.post(
+            '/products/batch', data=json.dumps(payload)
+        )
+        assert response.status_code == 400
+        assert response.json() == {
+            'error': 'BAD_REQUEST',
+            'message': {'1': {'id': ['Not a valid integer.']}}
+        }
+        assert not products_service.dispatch.called
+
     def test_will_order_product(self, products_service, web_session):
         payload = {'product_id': 1, 'quantity': 1}
         response = web_session.post('/orders', data=json.dumps(payload))
         assert response.status_code == 200
         assert [call(
-            {'quantity': 1, 'product_id': 1},
-            routing_key=ROUTING_KEY_ORDER_PRODUCT
+            {'quantity': 1, 'product_id': 1}
         )] == products_service.order_product_publisher.call_args_list
 
     def test_will_fail_ordering_product(self, products_service, web_session):
@@ -87,6 +325,31 @@ class TestProductService:
         }
         assert not products_service.order_product_publisher.called
 
+    def test_will_shed_orders(
+        self, create_service_meta, config, web_session
+    ):
+        config['ADMISSION'] = {
+            'order_product': {'MAX_IN_FLIGHT': 0, 'RETRY_AFTER': 2}
+        }
+        with patch.dict(CONTROLLERS, clear=True):
+            products_service = create_service_meta(
+                ProductsService, 'order_product_publisher'
+            )
+            payload = {'product_id': 1, 'quantity': 1}
+            response = web_session.post('/orders', data=json.dumps(payload))
+            assert response.status_code == 429
+            assert response.headers['Retry-After'] == '2'
+            assert response.json()['error'] == 'TOO_MANY_REQUESTS'
+            assert not products_service.order_product_publisher.called
+
+            response = web_session.get('/stats')
+            assert response.json()['admission']['order_product'] == {
+                'in_flight': 0,
+                'queue_depth': None,
+                'admitted': 0,
+                'shed': {'in_flight': 1}
+            }
+
     def test_will_consume_order(self, products_service, publish, data):
         payload = {'quantity': 1, 'product_id': 1}
         with entrypoint_waiter(
@@ -97,10 +360,61 @@ class TestProductService:
                 exchange=orders_exchange
             )
         assert products_service.dispatch.call_args_list == [
-            call(
-                'product_updated',
-                {'quantity': 99, 'id': 1, 'name': 'Tesla', 'price': '100.0'}
+            call('product_updated', {'quantity': 99, 'id': 1, 'version': 1})
+        ]
+
+    def test_will_record_transit_of_traced_orders(
+        self, create_service_meta, config, publish, data, monkeypatch
+    ):
+        monkeypatch.setattr(METRICS, 'enabled', False)
+        METRICS.reset()
+        config['METRICS'] = {'ENABLED': 'true'}
+        products_service = create_service_meta(ProductsService, 'dispatch')
+        with entrypoint_waiter(
+            products_service.container, 'consume_order'
+        ):
+            publish(
+                {'quantity': 1, 'product_id': 1}, ROUTING_KEY_ORDER_PRODUCT,
+                exchange=orders_exchange,
+                headers=trace_headers('asia', 'trace-1')
             )
+        assert TRANSIT_TIME.values[('asia', 'europe')].count == 1
+        METRICS.reset()
+
+    def test_will_consume_orders_in_batches(
+        self, create_service_meta, config, publish, data
+    ):
+        config['ORDER_BATCH'] = {'MAX_SIZE': 3, 'MAX_WAIT_MS': 1000}
+        products_service = create_service_meta(
+            ProductsService, 'dispatch', 'order_product_publisher'
+        )
+        with entrypoint_waiter(
+            products_service.container, 'consume_order'
+        ):
+            for quantity in (1, 2, 3):
+                publish(
+                    {'quantity': quantity, 'product_id': 1},
+                    ROUTING_KEY_ORDER_PRODUCT, exchange=orders_exchange
+                )
+        assert products_service.dispatch.call_args_list == [
+            call('product_updated', {'quantity': 94, 'id': 1, 'version': 1})
+        ]
+
+    def test_will_route_orders_to_partitions(
+        self, create_service_meta, config, web_session, data
+    ):
+        config['ORDER_BATCH'] = {'MAX_SIZE': 2, 'MAX_WAIT_MS': 1000}
+        config['ORDER_PARTITIONS'] = {'COUNT': 4, 'OWNED': ''}
+        products_service = create_service_meta(ProductsService, 'dispatch')
+        with entrypoint_waiter(
+            products_service.container, 'consume_order'
+        ):
+            for quantity in (1, 2):
+                web_session.post('/orders', data=json.dumps(
+                    {'product_id': 1, 'quantity': quantity}
+                ))
+        assert products_service.dispatch.call_args_list == [
+            call('product_updated', {'quantity': 97, 'id': 1, 'version': 1})
         ]
 
     def test_can_blacklist_consumer(self, container_factory, config):
@@ -116,19 +430,106 @@ class TestProductService:
         assert "No entrypoint for 'consume_order' found" in str(exc_info.value)
 
     def test_will_request_tax_calculation(
-        self, products_service, web_session, config
+        self, products_service, web_session
+    ):
+        tax = {'tax': 'You do not owe taxes in region asia for order id 1'}
+        products_service.taxes_rpc.call.return_value = tax
+
+        response = web_session.post('/tax/asia')
+        assert response.status_code == 200
+        assert response.json() == tax
+        assert [
+            call('asia', {'order_id': 1})
+        ] == products_service.taxes_rpc.call.call_args_list
+
+    def test_will_request_tax_calculation_in_nearest_region(
+        self, products_service, web_session
     ):
-        this_region = config['REGION']
-        tax_region = 'asia'
-        response = web_session.post('/tax/{}'.format(tax_region))
+        tax = {'tax': 'You do not owe taxes in region asia for order id 1'}
+        products_service.taxes_rpc.call.return_value = tax
+
+        response = web_session.post('/tax/nearest')
         assert response.status_code == 200
+        assert response.json() == tax
         assert [
-            call(
-                {'order_id': 1},
-                reply_to='{}_calculate_taxes_reply'.format(this_region),
-                routing_key='{}_calculate_taxes'.format(tax_region)
+            call('nearest', {'order_id': 1})
+        ] == products_service.taxes_rpc.call.call_args_list
+
+    def test_tax_calculation_in_unknown_region(
+        self, products_service, web_session
+    ):
+        response = web_session.post('/tax/mars')
+        assert response.status_code == 404
+        assert response.json() == {
+            'error': 'NOT_FOUND',
+            'message': 'Unknown region mars'
+        }
+        assert not products_service.taxes_rpc.call.called
+
+    def test_tax_calculation_timeout(self, products_service, web_session):
+        products_service.taxes_rpc.call.side_effect = RegionRpcTimeout(
+            'No reply within 5.0 seconds'
+        )
+
+        response = web_session.post('/tax/asia')
+        assert response.status_code == 504
+        assert response.json() == {
+            'error': 'GATEWAY_TIMEOUT',
+            'message': 'No reply within 5.0 seconds'
+        }
+
+    def test_tax_calculation_remote_error(
+        self, products_service, web_session
+    ):
+        products_service.taxes_rpc.call.side_effect = RemoteError(
+            'ValidationError', 'invalid'
+        )
+
+        response = web_session.post('/tax/asia')
+        assert response.status_code == 502
+        assert response.json() == {
+            'error': 'BAD_GATEWAY',
+            'message': 'ValidationError invalid'
+        }
+
+    def test_will_calculate_tax_in_region(
+        self, create_service_meta, taxes_service, web_session, config
+    ):
+        create_service_meta(
+            ProductsService, 'dispatch', 'order_product_publisher'
+        )
+        region = config['REGION']
+
+        response = web_session.post('/tax/{}'.format(region))
+        assert response.status_code == 200
+        assert response.json() == {
+            'tax': 'You do not owe taxes in region {} for order id 1'.format(
+                region
             )
-        ] == products_service.calculate_taxes_publisher.call_args_list
+        }
+
+        response = web_session.get('/stats')
+        stats = response.json()['tax_results']
+        regions = stats.pop('regions')
+        assert stats == {
+            'coalesced': 0,
+            'in_flight': 0,
+            'hits': 0,
+            'misses': 1,
+            'evictions': 0,
+            'expirations': 0,
+            'hit_ratio': 0.0,
+            'size': 1,
+            'hedged': 0
+        }
+        assert regions[region]['samples'] == 1
+        assert regions[region]['error_rate'] == 0.0
+
+        response = web_session.post('/tax/{}'.format(region))
+        assert response.status_code == 200
+        assert response.json()['tax'].endswith('for order id 1')
+        response = web_session.get('/stats')
+        assert response.json()['tax_results']['hits'] == 1
 
     def test_will_consume_tax_calculation_results(
         self, products_service, publish, config
@@ -160,16 +561,128 @@ class TestIndexerService:
         with entrypoint_waiter(container, 'handle_product_added'):
             dispatch('products', 'product_added', payload)
         assert CACHE[payload['id']] == payload
+        value, (etag, body) = ENCODED[payload['id']]
+        assert value is CACHE[payload['id']]
+        assert json.loads(body.decode('utf-8')) == {
+            'price': '101.0', 'name': 'Tesla', 'id': 1, 'quantity': 100
+        }
+
+    def test_will_cache_compact_products(
+        self, create_service_meta, config, data
+    ):
+        config['CACHE'] = dict(config['CACHE'], COMPACT='true')
+        try:
+            container = create_service_meta(IndexerService).container
+            assert isinstance(CACHE[1], ProductRecord)
+
+            dispatch = event_dispatcher(config)
+            with entrypoint_waiter(container, 'handle_product_updated'):
+                dispatch('products', 'product_updated', {
+                    'id': 1, 'version': 1, 'price': '99.90'
+                })
+            assert isinstance(CACHE[1], ProductRecord)
+            assert CACHE[1] == {
+                'id': 1, 'name': 'Tesla', 'price': Decimal('99.90'),
+                'quantity': 100, 'version': 1
+            }
+            value, (etag, body) = ENCODED[1]
+            assert value is CACHE[1]
+            assert json.loads(body.decode('utf-8'))['price'] == '99.90'
+        finally:
+            CACHE.configure(**cache_options(config['CACHE']))
+
+    def test_will_add_products_to_cache(self, indexer_service, config, data):
+        payload = [
+            {'price': 101.0, 'name': 'Tesla', 'id': 1, 'quantity': 100},
+            {'price': 5.0, 'name': 'Bike', 'id': 2, 'quantity': 10}
+        ]
+
+        container = indexer_service.container
+        dispatch = event_dispatcher(config)
+
+        with entrypoint_waiter(container, 'handle_products_added'):
+            dispatch('products', 'products_added', payload)
+        assert CACHE[1] == payload[0]
+        assert CACHE[2] == payload[1]
 
     def test_will_update_cache(self, indexer_service, config, data):
-        payload = {'price': 101.0, 'name': 'Tesla', 'id': 1, 'quantity': 99}
+        payload = {'id': 1, 'version': 1, 'quantity': 99}
 
         container = indexer_service.container
         dispatch = event_dispatcher(config)
 
         with entrypoint_waiter(container, 'handle_product_updated'):
             dispatch('products', 'product_updated', payload)
-        assert CACHE[payload['id']] == payload
+        assert CACHE[1] == {
+            'price': 100.0, 'name': 'Tesla', 'id': 1, 'quantity': 99,
+            'version': 1
+        }
+        value, (etag, body) = ENCODED[1]
+        assert json.loads(body.decode('utf-8'))['quantity'] == 99
+
+    def test_will_drop_stale_updates(self, indexer_service, config, data):
+        container = indexer_service.container
+        dispatch = event_dispatcher(config)
+
+        for version, quantity in ((2, 98), (1, 99), (2, 98)):
+            with entrypoint_waiter(container, 'handle_product_updated'):
+                dispatch('products', 'product_updated', {
+                    'id': 1, 'version': version, 'quantity': quantity
+                })
+        assert CACHE[1]['version'] == 2
+        assert CACHE[1]['quantity'] == 98
+
+    def test_will_reconcile_cache_with_master(
+        self, create_service_meta, data
+    ):
+        master = ShardedCache()
+        master[1] = load_versioned({
+            'price': '100.0', 'name': 'Tesla', 'id': 1, 'quantity': 97,
+            'version': 3
+        })
+        master_digest = CacheDigest(dump_versioned)
+        master_digest.attach(master)
+
+        indexer_service = create_service_meta(IndexerService, 'digest_rpc')
+        indexer_service.digest_rpc.call_async.side_effect = (
+            lambda region, request: Mock(
+                result=lambda: master_digest.answer(request)
+            )
+        )
+
+        with entrypoint_hook(
+            indexer_service.container, 'reconcile_cache'
+        ) as reconcile_cache:
+            reconcile_cache()
+
+        assert CACHE[1]['quantity'] == 97
+        assert CACHE[1]['version'] == 3
+        assert {
+            region for (region, _), _ in
+            indexer_service.digest_rpc.call_async.call_args_list
+        } == {'europe'}
+
+    def test_will_serve_cache_digest(self, indexer_service, data):
+        with entrypoint_hook(
+            indexer_service.container, 'serve_cache_digest'
+        ) as serve_cache_digest:
+            response = serve_cache_digest(
+                {'layout': [4096, 64], 'ranges': [0] * 64}
+            )
+        [[bucket, digest]] = [
+            [bucket, digest] for bucket, digest in response['buckets']
+            if digest
+        ]
+        with entrypoint_hook(
+            indexer_service.container, 'serve_cache_digest'
+        ) as serve_cache_digest:
+            response = serve_cache_digest(
+                {'layout': [4096, 64], 'buckets': [bucket]}
+            )
+        assert response == {'entries': [[1, {
+            'price': '100.0', 'name': 'Tesla', 'id': 1, 'quantity': 100,
+            'version': 0
+        }]]}
 
 
 class TestTaxesService:
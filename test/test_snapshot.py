@@ -0,0 +1,142 @@
+import os
+from decimal import Decimal
+
+import eventlet
+import pytest
+
+from src.cache import ShardedCache
+from src.snapshot import CacheSnapshot, snapshot_options
+
+
+@pytest.fixture
+def snapshot_path(tmpdir):
+    return str(tmpdir.join('cache.snapshot'))
+
+
+def restore(path):
+    cache = ShardedCache()
+    snapshot = CacheSnapshot(cache)
+    snapshot.configure(path)
+    snapshot.load()
+    return cache
+
+
+class TestCacheSnapshot:
+
+    def test_load_without_snapshot_file(self, snapshot_path):
+        assert len(restore(snapshot_path)) == 0
+
+    def test_increments_are_restored(self, snapshot_path):
+        cache = ShardedCache()
+        snapshot = CacheSnapshot(cache)
+        snapshot.configure(snapshot_path)
+        snapshot.load()
+
+        cache[1] = {'id': 1, 'price': Decimal('100.00')}
+        cache[2] = {'id': 2, 'price': Decimal('1.50')}
+        snapshot.write()
+        del cache[2]
+        cache[3] = {'id': 3, 'price': Decimal('3.00')}
+        snapshot.write()
+
+        assert dict(restore(snapshot_path)) == {
+            1: {'id': 1, 'price': Decimal('100.00')},
+            3: {'id': 3, 'price': Decimal('3.00')},
+        }
+
+    def test_only_changed_keys_are_appended(self, snapshot_path):
+        cache = ShardedCache()
+        snapshot = CacheSnapshot(cache)
+        snapshot.configure(snapshot_path)
+        snapshot.load()
+
+        for key in range(100):
+            cache[key] = key
+        snapshot.write()
+        size = len(open(snapshot_path, 'rb').read())
+
+        cache[1] = 'changed'
+        snapshot.write()
+        snapshot.write()
+
+        increment = len(open(snapshot_path, 'rb').read()) - size
+        assert 0 < increment < size / 10
+
+    def test_compaction(self, snapshot_path):
+        cache = ShardedCache()
+        snapshot = CacheSnapshot(cache)
+        snapshot.configure(snapshot_path, compact_every=2)
+        snapshot.load()
+
+        for value in range(5):
+            cache[1] = value
+            snapshot.write()
+
+        assert snapshot._increments == 2
+        assert dict(restore(snapshot_path)) == {1: 4}
+
+    def test_truncated_snapshot_is_loaded_up_to_last_frame(
+        self, snapshot_path
+    ):
+        cache = ShardedCache()
+        snapshot = CacheSnapshot(cache)
+        snapshot.configure(snapshot_path)
+        snapshot.load()
+
+        cache[1] = 'one'
+        snapshot.write()
+        cache[2] = 'two'
+        snapshot.write()
+
+        with open(snapshot_path, 'rb+') as stream:
+            stream.truncate(len(stream.read()) - 3)
+
+        assert dict(restore(snapshot_path)) == {1: 'one'}
+
+    def test_stop_waits_for_compaction(self, snapshot_path, monkeypatch):
+        monkeypatch.setattr('src.snapshot.FRAME_SIZE', 1)
+        cache = ShardedCache()
+        for key in range(10):
+            cache[key] = key
+        snapshot = CacheSnapshot(cache)
+        snapshot.configure(snapshot_path, interval=0, compact_every=0)
+        snapshot.load()
+
+        replaced = []
+        replace = os.replace
+        monkeypatch.setattr(
+            'src.snapshot.os.replace',
+            lambda *args: replaced.append(args) or replace(*args)
+        )
+
+        snapshot.start()
+        for _ in range(3):
+            eventlet.sleep()
+        assert os.path.exists(snapshot_path + '.tmp')
+
+        snapshot.stop()
+        # the compaction in progress finished before the final one
+        assert len(replaced) == 2
+        assert not os.path.exists(snapshot_path + '.tmp')
+        assert dict(restore(snapshot_path)) == dict(cache)
+
+    def test_unfinished_compaction_is_removed(self, snapshot_path):
+        cache = ShardedCache()
+        snapshot = CacheSnapshot(cache)
+        snapshot.configure(snapshot_path)
+        snapshot.load()
+        cache[1] = 'one'
+        snapshot.write()
+        with open(snapshot_path + '.tmp', 'wb') as stream:
+            stream.write(b'partial')
+
+        assert dict(restore(snapshot_path)) == {1: 'one'}
+        assert not os.path.exists(snapshot_path + '.tmp')
+
+
+def test_snapshot_options():
+    assert snapshot_options({
+        'SNAPSHOT_PATH': '/tmp/cache', 'SNAPSHOT_INTERVAL': '0.5',
+        'SNAPSHOT_COMPACT_EVERY': '10'
+    }) == {'path': '/tmp/cache', 'interval': 0.5, 'compact_every': 10}
+    assert snapshot_options({'SNAPSHOT_PATH': ''})['path'] is None
@@ -0,0 +1,71 @@
+import pytest
+from kombu import Exchange, Queue
+from mock import Mock, call, patch
+from nameko.constants import AMQP_URI_CONFIG_KEY
+
+from src.topology import (
+    DECLARED, Topology, is_declared, region_queues, regions
+)
+
+
+def test_regions_from_config():
+    assert regions({}) == ['europe', 'asia', 'america']
+    assert regions({'REGIONS': 'europe, asia'}) == ['europe', 'asia']
+    assert regions({'REGIONS': ['america']}) == ['america']
+
+
+def test_will_declare_once_per_broker():
+    exchange = Exchange('orders')
+    queues = region_queues(exchange, 'calculate_taxes', ['europe', 'asia'])
+    assert [queue.name for queue in queues] == [
+        'fed.europe_calculate_taxes', 'fed.asia_calculate_taxes'
+    ]
+
+    def declare():
+        topology = Topology()
+        topology.container = Mock(config={
+            AMQP_URI_CONFIG_KEY: 'memory://topology'
+        })
+        topology.add(exchange, *queues)
+        topology.add(queues[0])
+        topology.declare()
+
+    with patch('src.topology.get_connection') as get_connection, \
+            patch.object(Exchange, 'declare') as declare_exchange, \
+            patch.object(Queue, 'declare') as declare_queue:
+        declare()
+        assert declare_exchange.call_args_list == [call(nowait=True)]
+        assert declare_queue.call_args_list == [call(nowait=True), call()]
+        assert is_declared('memory://topology', queues[1])
+
+        declare()
+        assert get_connection.call_count == 1
+
+    DECLARED.pop('memory://topology')
+
+
+def test_will_declare_again_after_failure():
+    exchange = Exchange('orders')
+    queue = Queue('fed.retry', exchange=exchange, routing_key='retry')
+    topology = Topology()
+    topology.container = Mock(config={
+        AMQP_URI_CONFIG_KEY: 'memory://topology-retry'
+    })
+    topology.add(exchange, queue)
+
+    with patch('src.topology.get_connection'), \
+            patch.object(Exchange, 'declare'), \
+            patch.object(Queue, 'declare') as declare_queue:
+        declare_queue.side_effect = [IOError('broker down'), None]
+        with pytest.raises(IOError):
+            topology.declare()
+        assert not is_declared('memory://topology-retry', queue)
+
+        topology.declare()
+        assert declare_queue.call_count == 2
+        assert is_declared('memory://topology-retry', queue)
+
+        topology.declare()
+        assert declare_queue.call_count == 2
+
+    DECLARED.pop('memory://topology-retry')